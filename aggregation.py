@@ -0,0 +1,746 @@
+import io
+import os
+import re
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils import clean_str_column
+
+
+def get_class_codes(x: pd.Series, classes: List[str]) -> np.ndarray:
+    """
+    Get the index of each value in `classes`.
+    Values not in `classes` get -1.
+    """
+    return pd.Index(classes).get_indexer(x)
+
+
+def count_confusion_matrix(
+    targets: pd.Series,
+    predictions: pd.Series,
+    classes: Optional[List[str]] = None,
+) -> np.ndarray:
+    """
+    Count the target-prediction combinations in a single vectorized pass.
+
+    Observations where the target or prediction is not
+    in `classes` are excluded before counting.
+    Returns a (num classes x num classes) array with
+    targets in the rows and predictions in the columns.
+    """
+    if classes is None:
+        classes = sorted(set(targets.unique()).union(predictions.unique()))
+    num_classes = len(classes)
+    target_codes = get_class_codes(targets, classes)
+    prediction_codes = get_class_codes(predictions, classes)
+    keep = (target_codes >= 0) & (prediction_codes >= 0)
+    counts = np.bincount(
+        target_codes[keep].astype(np.int64) * num_classes + prediction_codes[keep],
+        minlength=num_classes * num_classes,
+    )
+    return counts.reshape(num_classes, num_classes)
+
+
+def matrix_to_long(
+    matrix: np.ndarray,
+    classes: List[str],
+    target_col: str = "Target",
+    prediction_col: str = "Prediction",
+    n_col: str = "N",
+) -> pd.DataFrame:
+    """
+    Convert a confusion matrix (targets x predictions) to
+    the long format with a row per target-prediction combination.
+    This is the counts format that `plot.R` reads.
+    """
+    num_classes = len(classes)
+    classes = np.asarray(classes, dtype=object)
+    return pd.DataFrame(
+        {
+            target_col: np.repeat(classes, num_classes),
+            prediction_col: np.tile(classes, num_classes),
+            n_col: np.asarray(matrix).ravel(),
+        }
+    )
+
+
+def count_data(
+    targets: pd.Series,
+    predictions: pd.Series,
+    classes: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """
+    Count target-prediction combinations in long format
+    (`Target`, `Prediction`, `N` columns).
+    """
+    if classes is None:
+        classes = sorted(set(targets.unique()).union(predictions.unique()))
+    return matrix_to_long(
+        count_confusion_matrix(targets, predictions, classes=classes),
+        classes=classes,
+    )
+
+
+def select_classes(
+    counts: pd.DataFrame,
+    classes: List[str],
+    target_col: str = "Target",
+    prediction_col: str = "Prediction",
+    n_col: str = "N",
+) -> np.ndarray:
+    """
+    Get the confusion matrix (targets x predictions) for `classes`
+    from counts in long format. Combinations that are not in
+    `counts` get a count of 0.
+    """
+    num_classes = len(classes)
+    target_codes = get_class_codes(counts[target_col], classes)
+    prediction_codes = get_class_codes(counts[prediction_col], classes)
+    keep = (target_codes >= 0) & (prediction_codes >= 0)
+    matrix = np.bincount(
+        target_codes[keep].astype(np.int64) * num_classes + prediction_codes[keep],
+        weights=counts[n_col].to_numpy()[keep],
+        minlength=num_classes * num_classes,
+    )
+    return matrix.round().astype(np.int64).reshape(num_classes, num_classes)
+
+
+def parse_count_matrix(text: str, num_classes: int) -> np.ndarray:
+    """
+    Parse a pasted confusion matrix (targets in rows, predictions in columns).
+    Values can be separated by tabs (e.g. copied from a spreadsheet),
+    commas, semicolons or spaces.
+    """
+    rows = [row for row in re.split(r"[\r\n]+", text.strip()) if row.strip()]
+    try:
+        values = [[float(x) for x in re.split(r"[\t,; ]+", row.strip())] for row in rows]
+    except ValueError as e:
+        raise ValueError(f"The matrix must only contain numbers: {e}") from e
+    if len(values) != num_classes or any(len(row) != num_classes for row in values):
+        raise ValueError(
+            f"The matrix must have {num_classes} rows and {num_classes} columns. "
+            f"Got {len(values)} rows with "
+            f"{', '.join(str(n) for n in sorted(set(len(row) for row in values)))} "
+            "columns."
+        )
+    matrix = np.array(values)
+    if (matrix < 0).any() or (matrix != np.round(matrix)).any():
+        raise ValueError("The counts must be non-negative whole numbers.")
+    return matrix.astype(np.int64)
+
+
+# Ways to rank classes when keeping the top classes
+CLASS_RANKINGS = {
+    "Support": "Number of observations with the class as target",
+    "Confusion mass": "Number of misclassifications involving the class "
+    "(as either target or prediction)",
+}
+
+
+def rank_classes(matrix: np.ndarray, by: str = "Support") -> np.ndarray:
+    """
+    Get the score of each class in a confusion matrix (targets x predictions).
+    See `CLASS_RANKINGS` for the options of `by`.
+    """
+    matrix = np.asarray(matrix)
+    if by == "Support":
+        return matrix.sum(axis=1)
+    if by == "Confusion mass":
+        return matrix.sum(axis=1) + matrix.sum(axis=0) - 2 * np.diag(matrix)
+    raise ValueError(f"Unknown class ranking: {by}")
+
+
+def top_k_classes(
+    matrix: np.ndarray, classes: List[str], k: int, by: str = "Support"
+) -> Tuple[List[str], List[str]]:
+    """
+    Get the `k` classes with the highest score and the excluded classes.
+    Both keep the order of `classes`. Ties are resolved by that order.
+    """
+    scores = rank_classes(matrix, by=by)
+    # Stable sort, so ties keep the class order
+    top = np.sort(np.argsort(-scores, kind="stable")[:k])
+    is_kept = np.zeros(len(classes), dtype=bool)
+    is_kept[top] = True
+    return (
+        [c for c, kept in zip(classes, is_kept) if kept],
+        [c for c, kept in zip(classes, is_kept) if not kept],
+    )
+
+
+def get_other_label(classes: List[str], other_label: str = "Other") -> str:
+    """
+    Get a label for the collapsed classes that is not already a class.
+    """
+    label = other_label
+    while label in classes:
+        label += "*"
+    return label
+
+
+def collapse_classes(
+    matrix: np.ndarray,
+    classes: List[str],
+    keep: List[str],
+    other_label: str = "Other",
+) -> Tuple[np.ndarray, List[str]]:
+    """
+    Collapse the classes that are not in `keep` into a single class.
+    Both the rows (targets) and columns (predictions) of the
+    confusion matrix are summed, so all observations are kept.
+
+    Returns the collapsed matrix and its classes (`keep` and the other class).
+    """
+    other_label = get_other_label(classes, other_label=other_label)
+    num_kept = len(keep)
+    # Index of each class in the collapsed matrix
+    new_codes = pd.Index(keep).get_indexer(classes)
+    new_codes[new_codes < 0] = num_kept
+    # (old classes x new classes) indicator matrix
+    indicator = np.zeros((len(classes), num_kept + 1), dtype=np.int64)
+    indicator[np.arange(len(classes)), new_codes] = 1
+    collapsed = indicator.T @ np.asarray(matrix, dtype=np.int64) @ indicator
+    return collapsed, list(keep) + [other_label]
+
+
+def count_grouped_confusion_matrices(
+    groups: pd.Series,
+    targets: pd.Series,
+    predictions: pd.Series,
+    classes: List[str],
+    weights: Optional[pd.Series] = None,
+) -> Tuple[np.ndarray, List[str]]:
+    """
+    Count the confusion matrix of each group in a single vectorized pass.
+    `weights` are the number of observations of each row (e.g. for grouped
+    counts from `count_chunks()`). By default, each row is an observation.
+
+    Observations where the target or prediction is not in `classes`
+    are excluded before counting. Missing groups are counted as a "nan"
+    group, as when the groups are cleaned with `clean_str_column()`.
+    Returns a (num groups x num classes x num classes) array with
+    targets in the rows and predictions in the columns and the
+    (sorted) group names.
+    """
+    group_codes, group_names = pd.factorize(groups, sort=True, use_na_sentinel=False)
+    num_groups = len(group_names)
+    num_classes = len(classes)
+    target_codes = get_class_codes(targets, classes)
+    prediction_codes = get_class_codes(predictions, classes)
+    keep = (target_codes >= 0) & (prediction_codes >= 0)
+    counts = np.bincount(
+        (group_codes[keep].astype(np.int64) * num_classes + target_codes[keep])
+        * num_classes
+        + prediction_codes[keep],
+        weights=None if weights is None else np.asarray(weights)[keep],
+        minlength=num_groups * num_classes * num_classes,
+    )
+    if weights is not None:
+        counts = counts.round().astype(np.int64)
+    return (
+        counts.reshape(num_groups, num_classes, num_classes),
+        ["nan" if pd.isna(g) else str(g) for g in group_names],
+    )
+
+
+def grouped_matrices_to_long(
+    matrices: np.ndarray,
+    groups: List[str],
+    classes: List[str],
+    group_col: str = "Group",
+) -> pd.DataFrame:
+    """
+    Convert confusion matrices per group to the long format
+    with a row per group-target-prediction combination
+    (`group_col`, `Target`, `Prediction`, `N` columns).
+    """
+    num_groups = len(groups)
+    num_classes = len(classes)
+    classes = np.asarray(classes, dtype=object)
+    return pd.DataFrame(
+        {
+            group_col: np.repeat(
+                np.asarray(groups, dtype=object), num_classes * num_classes
+            ),
+            "Target": np.tile(np.repeat(classes, num_classes), num_groups),
+            "Prediction": np.tile(classes, num_groups * num_classes),
+            "N": np.asarray(matrices).ravel(),
+        }
+    )
+
+
+def get_thresholds(
+    probabilities: np.ndarray, num_thresholds: Optional[int] = None
+) -> np.ndarray:
+    """
+    Get the decision thresholds to sweep.
+    With `num_thresholds`, the thresholds are evenly spaced between 0 and 1
+    (or the range of the probabilities when they are outside [0, 1]).
+    Otherwise, each unique probability is a threshold.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    probabilities = probabilities[~np.isnan(probabilities)]
+    if num_thresholds is None:
+        return np.unique(probabilities)
+    low = min(0.0, probabilities.min())
+    high = max(1.0, probabilities.max())
+    return np.linspace(low, high, num_thresholds)
+
+
+def threshold_confusion_matrices(
+    is_positive: np.ndarray,
+    probabilities: np.ndarray,
+    thresholds: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Count the binary confusion matrix at each decision threshold.
+    An observation is predicted positive when its probability is
+    at least the threshold. Observations with a missing probability are excluded.
+    `weights` are the number of observations of each element (e.g. from
+    `count_probability_chunks()`). By default, each element is an observation.
+
+    The probabilities are sorted once and the positives are cumulatively
+    summed, so each threshold is a lookup (O(n log n) in total).
+
+    Returns a (num thresholds x 2 x 2) array of confusion matrices
+    (targets x predictions) with the negative class first.
+    """
+    is_positive = np.asarray(is_positive, dtype=bool)
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(probabilities), dtype=np.int64)
+    keep = ~np.isnan(probabilities)
+    is_positive = is_positive[keep]
+    probabilities = probabilities[keep]
+    weights = np.asarray(weights, dtype=np.int64)[keep]
+
+    # Sort by descending probability
+    order = np.argsort(-probabilities, kind="stable")
+    sorted_probabilities = probabilities[order]
+    sorted_weights = weights[order]
+    # Number of observations and positives among the first i elements
+    cum_observations = np.concatenate([[0], np.cumsum(sorted_weights)])
+    cum_positives = np.concatenate(
+        [[0], np.cumsum(np.where(is_positive[order], sorted_weights, 0))]
+    )
+
+    # Number of elements with a probability >= each threshold
+    num_above = np.searchsorted(
+        -sorted_probabilities, -np.asarray(thresholds, dtype=np.float64), side="right"
+    )
+    num_predicted_positive = cum_observations[num_above]
+    num_positives = cum_positives[-1]
+    num_negatives = cum_observations[-1] - num_positives
+    true_positives = cum_positives[num_above]
+    false_positives = num_predicted_positive - true_positives
+    false_negatives = num_positives - true_positives
+    true_negatives = num_negatives - false_positives
+    return np.stack(
+        [true_negatives, false_positives, false_negatives, true_positives], axis=1
+    ).reshape(-1, 2, 2)
+
+
+def partial_probability_counts(
+    targets: pd.Series, probabilities: pd.Series
+) -> pd.DataFrame:
+    """
+    Count the observations per target class and unique probability
+    of a chunk of data. Probabilities can be strings (e.g. from csv chunks).
+    Observations with a missing probability are excluded.
+    Returns a data frame with `Target`, `Probability` and `N` columns.
+    """
+    return (
+        pd.DataFrame(
+            {
+                "Target": np.asarray(targets, dtype=object),
+                "Probability": pd.to_numeric(probabilities, errors="coerce").to_numpy(
+                    dtype=np.float64
+                ),
+            }
+        )
+        .groupby(["Target", "Probability"], sort=False)
+        .size()
+        .rename("N")
+        .reset_index()
+    )
+
+
+def merge_probability_counts(partials: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Sum probability counts from multiple chunks.
+    """
+    if not partials:
+        return pd.DataFrame(
+            {
+                "Target": pd.Series([], dtype=object),
+                "Probability": pd.Series([], dtype=np.float64),
+                "N": pd.Series([], dtype=np.int64),
+            }
+        )
+    return (
+        pd.concat(partials, ignore_index=True)
+        .groupby(["Target", "Probability"], sort=False)["N"]
+        .sum()
+        .reset_index()
+    )
+
+
+def count_probability_chunks(
+    chunks: Iterable[pd.DataFrame],
+    target_col: str,
+    prediction_col: str,
+    total_rows: Optional[int] = None,
+    progress_callback: Optional[Callable[[int, float], None]] = None,
+) -> Tuple[pd.DataFrame, int]:
+    """
+    Count the observations per target class and unique probability over
+    chunks of data (e.g. from `data.iter_data_chunks()`), for sweeping
+    decision thresholds without reading all the rows into memory.
+    The counts are merged after each chunk, so memory is bounded by
+    the number of unique probabilities rather than the number of rows.
+
+    `progress_callback` is called like in `count_chunks()`.
+
+    Returns the counts (`Target`, `Probability`, `N` columns) and the number of rows.
+    """
+    counts = merge_probability_counts([])
+    num_rows = 0
+    for chunk in chunks:
+        counts = merge_probability_counts(
+            [
+                counts,
+                partial_probability_counts(
+                    targets=clean_str_column(chunk[target_col]),
+                    probabilities=chunk[prediction_col],
+                ),
+            ]
+        )
+        num_rows += len(chunk)
+        if progress_callback is not None:
+            progress = None
+            if total_rows:
+                progress = min(num_rows / total_rows, 1.0)
+            progress_callback(num_rows, progress)
+    return counts, num_rows
+
+
+def partial_counts(
+    targets: pd.Series, predictions: pd.Series, groups: Optional[pd.Series] = None
+) -> pd.Series:
+    """
+    Count the target-prediction combinations of a chunk of data.
+    Only combinations that occur are included.
+    Returns a series with a (`Target`, `Prediction`) multi-index.
+    With `groups`, the combinations are counted per group
+    and the multi-index is (`Group`, `Target`, `Prediction`).
+    """
+    keys = [targets, predictions]
+    names = ["Target", "Prediction"]
+    if groups is not None:
+        keys.insert(0, groups)
+        names.insert(0, "Group")
+    codes, labels = zip(*(pd.factorize(key) for key in keys))
+    keep = np.logical_and.reduce([key_codes >= 0 for key_codes in codes])
+    dims = tuple(len(key_labels) for key_labels in labels)
+    combination_codes = np.ravel_multi_index(
+        tuple(key_codes[keep].astype(np.int64) for key_codes in codes), dims
+    )
+    num_combinations = int(np.prod(dims, dtype=np.int64))
+    if num_combinations <= 4 * len(combination_codes) + 1024:
+        counts = np.bincount(combination_codes, minlength=num_combinations)
+        present = np.flatnonzero(counts)
+        counts = counts[present]
+    else:
+        # Too many possible combinations to count in an array (e.g. many groups)
+        present, counts = np.unique(combination_codes, return_counts=True)
+    return pd.Series(
+        counts,
+        index=pd.MultiIndex.from_arrays(
+            [
+                np.asarray(key_labels, dtype=object)[key_codes]
+                for key_labels, key_codes in zip(
+                    labels, np.unravel_index(present, dims)
+                )
+            ],
+            names=names,
+        ),
+        name="N",
+    )
+
+
+def merge_partial_counts(
+    partials: List[pd.Series], names: Tuple[str, ...] = ("Target", "Prediction")
+) -> pd.Series:
+    """
+    Sum partial counts from multiple chunks.
+    `names` are the index levels of the counts when there are no chunks.
+    """
+    if not partials:
+        return pd.Series(
+            [],
+            index=pd.MultiIndex.from_arrays([[] for _ in names], names=list(names)),
+            name="N",
+            dtype=np.int64,
+        )
+    num_levels = partials[0].index.nlevels
+    return pd.concat(partials).groupby(level=list(range(num_levels)), sort=False).sum()
+
+
+def partial_counts_to_long(counts: pd.Series) -> pd.DataFrame:
+    """
+    Convert merged partial counts to the long format with all
+    combinations of the present classes (`Target`, `Prediction`, `N` columns).
+    """
+    counts = counts.reset_index()
+    classes = sorted(set(counts["Target"]).union(counts["Prediction"]))
+    return matrix_to_long(select_classes(counts, classes=classes), classes=classes)
+
+
+def _finish_counts(partials: List[pd.Series], grouped: bool) -> pd.DataFrame:
+    if grouped:
+        # Only the combinations that occur in each group
+        return merge_partial_counts(
+            partials, names=("Group", "Target", "Prediction")
+        ).reset_index()
+    return partial_counts_to_long(merge_partial_counts(partials))
+
+
+def _count_chunk(
+    chunk: pd.DataFrame,
+    target_col: str,
+    prediction_col: str,
+    group_col: Optional[str] = None,
+):
+    return partial_counts(
+        targets=clean_str_column(chunk[target_col]),
+        predictions=clean_str_column(chunk[prediction_col]),
+        groups=None if group_col is None else clean_str_column(chunk[group_col]),
+    )
+
+
+def count_chunks(
+    chunks: Iterable[pd.DataFrame],
+    target_col: str,
+    prediction_col: str,
+    total_rows: Optional[int] = None,
+    progress_callback: Optional[Callable[[int, float], None]] = None,
+    group_col: Optional[str] = None,
+) -> Tuple[pd.DataFrame, int]:
+    """
+    Count target-prediction combinations over chunks of data
+    (e.g. from `data.iter_data_chunks()`).
+    With `group_col`, the combinations are counted per group and only the
+    combinations that occur are returned (`Group`, `Target`, `Prediction`,
+    `N` columns). Group names are cleaned like the classes.
+
+    `progress_callback` is called with the number of rows processed
+    and the fraction of `total_rows` processed (when known) after each chunk.
+
+    Returns the counts in long format and the number of rows.
+    """
+    partials = []
+    num_rows = 0
+    for chunk in chunks:
+        partials.append(_count_chunk(chunk, target_col, prediction_col, group_col))
+        num_rows += len(chunk)
+        if progress_callback is not None:
+            progress = None
+            if total_rows:
+                progress = min(num_rows / total_rows, 1.0)
+            progress_callback(num_rows, progress)
+    return _finish_counts(partials, grouped=group_col is not None), num_rows
+
+
+def count_csv_in_chunks(
+    data,
+    target_col: str,
+    prediction_col: str,
+    chunksize: int = 1_000_000,
+    progress_callback: Optional[Callable[[int, float], None]] = None,
+    group_col: Optional[str] = None,
+) -> Tuple[pd.DataFrame, int]:
+    """
+    Count target-prediction combinations of a csv file
+    (path or file-like object) without loading it all into memory.
+
+    Values are read as strings and cleaned with `clean_str_column()`.
+    Missing values (e.g. empty cells) become the class "nan",
+    like when the data is read into memory.
+    `progress_callback` is called with the number of rows processed
+    and the fraction of the file processed (when the size is known)
+    after each chunk.
+    With `group_col`, the combinations are counted per group and only the
+    combinations that occur are returned (`Group`, `Target`, `Prediction`,
+    `N` columns). Group names are cleaned like the classes.
+
+    Returns the counts in long format and the number of rows.
+    """
+    total_bytes = _get_size(data)
+    if hasattr(data, "seek"):
+        data.seek(0)
+    partials = []
+    num_rows = 0
+    with pd.read_csv(
+        data,
+        usecols=_get_count_columns(target_col, prediction_col, group_col),
+        dtype=str,
+        chunksize=chunksize,
+    ) as reader:
+        for chunk in reader:
+            partials.append(_count_chunk(chunk, target_col, prediction_col, group_col))
+            num_rows += len(chunk)
+            if progress_callback is not None:
+                progress = None
+                if total_bytes and hasattr(data, "tell"):
+                    progress = min(data.tell() / total_bytes, 1.0)
+                progress_callback(num_rows, progress)
+    return _finish_counts(partials, grouped=group_col is not None), num_rows
+
+
+def _get_count_columns(target_col, prediction_col, group_col=None) -> List[str]:
+    return list(
+        dict.fromkeys(
+            [target_col, prediction_col] + ([group_col] if group_col is not None else [])
+        )
+    )
+
+
+def _get_size(data) -> Optional[int]:
+    if isinstance(data, (str, os.PathLike)):
+        return os.path.getsize(data)
+    if hasattr(data, "seek") and hasattr(data, "tell"):
+        position = data.tell()
+        size = data.seek(0, io.SEEK_END)
+        data.seek(position)
+        return size
+    return None
+
+
+def split_file_by_lines(path, split_size: int) -> List[Tuple[int, int]]:
+    """
+    Split a file (after the header line) into byte ranges of
+    approximately `split_size` bytes that start and end at line breaks.
+    Note: Assumes that quoted fields do not contain line breaks.
+    """
+    file_size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.readline()  # Skip the header
+        start = f.tell()
+        ranges = []
+        while start < file_size:
+            f.seek(min(start + split_size, file_size))
+            f.readline()  # Move to the end of the current line
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _count_byte_range(
+    path,
+    start: int,
+    end: int,
+    columns: List[str],
+    target_col,
+    prediction_col,
+    group_col=None,
+) -> Tuple[pd.Series, int]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        chunk = pd.read_csv(
+            io.BytesIO(f.read(end - start)),
+            header=None,
+            names=columns,
+            usecols=_get_count_columns(target_col, prediction_col, group_col),
+            dtype=str,
+        )
+    return _count_chunk(chunk, target_col, prediction_col, group_col), len(chunk)
+
+
+def count_csv_parallel(
+    path,
+    target_col: str,
+    prediction_col: str,
+    num_workers: Optional[int] = None,
+    split_size: int = 64 * 1024**2,
+    progress_callback: Optional[Callable[[int, float], None]] = None,
+    executor: Optional[Executor] = None,
+    group_col: Optional[str] = None,
+) -> Tuple[pd.DataFrame, int]:
+    """
+    Count target-prediction combinations of a csv file on disk
+    by splitting it into byte ranges that are counted in a pool of processes.
+
+    Peak memory is bounded by `split_size` per worker rather than the file size.
+    Values are cleaned like in `count_csv_in_chunks()`, so the counts are the same.
+    `progress_callback` is called with the number of rows processed
+    and the fraction of the file processed after each split.
+    `executor`: A (shared) process pool to count the splits in. By default,
+        a pool of `num_workers` processes is started for the call.
+        Files with a single split are counted in this process.
+    With `group_col`, the combinations are counted per group and only the
+    combinations that occur are returned (`Group`, `Target`, `Prediction`,
+    `N` columns). Group names are cleaned like the classes.
+
+    Returns the counts in long format and the number of rows.
+    """
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    for col in _get_count_columns(target_col, prediction_col, group_col):
+        if col not in columns:
+            raise ValueError(f"`{col}` is not a column in {path}.")
+    ranges = split_file_by_lines(path, split_size=split_size)
+    total_bytes = sum(end - start for start, end in ranges)
+
+    if len(ranges) <= 1:
+        partials = []
+        num_rows = 0
+        for start, end in ranges:
+            counts, num_rows = _count_byte_range(
+                path, start, end, columns, target_col, prediction_col, group_col
+            )
+            partials.append(counts)
+        if progress_callback is not None:
+            progress_callback(num_rows, 1.0)
+        return _finish_counts(partials, grouped=group_col is not None), num_rows
+
+    partials = []
+    num_rows = 0
+    bytes_done = 0
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+    try:
+        futures = {
+            executor.submit(
+                _count_byte_range,
+                path,
+                start,
+                end,
+                columns,
+                target_col,
+                prediction_col,
+                group_col,
+            ): end - start
+            for start, end in ranges
+        }
+        try:
+            for future in as_completed(futures):
+                counts, chunk_rows = future.result()
+                partials.append(counts)
+                num_rows += chunk_rows
+                bytes_done += futures[future]
+                if progress_callback is not None:
+                    progress_callback(num_rows, bytes_done / max(total_bytes, 1))
+        except BaseException:
+            # E.g. a stopped script run - don't leave the splits in a shared pool
+            for future in futures:
+                future.cancel()
+            raise
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+    return _finish_counts(partials, grouped=group_col is not None), num_rows
@@ -3,23 +3,88 @@ App for plotting confusion matrix with `cvms::plot_confusion_matrix()`.
 
 """
 
+import contextvars
+import multiprocessing
+import os
 import pathlib
+import shutil
 import tempfile
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
 import streamlit as st  # Import last
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+import numpy as np
 import pandas as pd
 from pandas.api.types import is_float_dtype
-from itertools import combinations
 
 from utils import (
-    call_subprocess,
+    PlotRenderCancelledError,
+    PlotRenderError,
+    PlotWorkerPool,
+    show_plotting_error,
     clean_string_for_non_alphanumerics,
     clean_str_column,
     min_max_scale_list,
 )
-from data import read_data, read_data_cached, DownloadHeader, generate_data
+from aggregation import (
+    CLASS_RANKINGS,
+    collapse_classes,
+    parse_count_matrix,
+    top_k_classes,
+    count_chunks,
+    count_csv_in_chunks,
+    count_csv_parallel,
+    count_data,
+    count_grouped_confusion_matrices,
+    count_probability_chunks,
+    get_thresholds,
+    partial_probability_counts,
+    grouped_matrices_to_long,
+    matrix_to_long,
+    select_classes,
+    threshold_confusion_matrices,
+)
+from components import add_toggle_horizontal
+from metrics import (
+    record_span,
+    set_gauges,
+    span,
+    start_metrics_server,
+    start_trace,
+)
+from scheduler import QueueFullError, RenderCancelledError, RenderScheduler
+from workspaces import WorkspaceManager, WorkspaceQuotaError
+from data import (
+    DATA_FILE_TYPES,
+    HANDOFF_FORMATS,
+    write_plot_data,
+    read_data_cached,
+    read_column_names_cached,
+    iter_data_chunks,
+    get_file_type,
+    get_num_rows,
+    DownloadHeader,
+    generate_data_cached,
+)
 from design import design_section
+from image_cache import ImageCache, get_preview_width
+from export import (
+    EXPORT_FORMATS,
+    EXPORT_PRESETS,
+    PREVIEW_SCALING,
+    build_exports,
+    build_preview_exports,
+    zip_files,
+)
+from python_plotting import (
+    get_shared_intensity_lims,
+    get_unsupported_features,
+    render_with_engine,
+    resolve_engine,
+)
+from render_cache import RenderCache, make_render_key, plotting_code_version
+from settings import DesignSettings, DesignSettingsError
 from text_sections import (
+    get_cvms_version,
     intro_text,
     columns_text,
     upload_predictions_text,
@@ -40,22 +105,643 @@ st.markdown(
 )
 
 
-# Create temporary directory
+# Directory with the session workspaces
+# E.g. a tmpfs (like `/dev/shm`) to keep the files in memory
+WORKSPACES_DIR = os.environ.get(
+    "WORKSPACES_DIR",
+    str(pathlib.Path(tempfile.gettempdir()) / "plot_confusion_matrix_workspaces"),
+)
+
+# Disk quota per session and the time before
+# an unused workspace is removed
+WORKSPACE_QUOTA_MB = int(os.environ.get("WORKSPACE_QUOTA_MB", 200))
+WORKSPACE_TTL_SECONDS = int(os.environ.get("WORKSPACE_TTL_SECONDS", 3600))
+
+
+# Workspaces with the files of each session
+# Shared by all sessions
 @st.cache_resource
-def set_tmp_dir():
+def get_workspace_manager():
     """
     Must cache to avoid regenerating!
     Must be the same throughout the iterations!
     """
-    temp_dir = tempfile.TemporaryDirectory()
-    return temp_dir, temp_dir.name
+    return WorkspaceManager(
+        root_dir=WORKSPACES_DIR,
+        quota_bytes=WORKSPACE_QUOTA_MB * 1024**2,
+        ttl_seconds=WORKSPACE_TTL_SECONDS,
+    )
+
+
+# Format for handing the data to the plotting script
+# Either "feather" (binary, requires the R `arrow` package) or "csv"
+DATA_HANDOFF_FORMAT = os.environ.get("DATA_HANDOFF_FORMAT", "feather")
+
+
+# Number of plots rendered at the same time
+# and the number of render jobs that can wait
+NUM_PLOT_WORKERS = int(os.environ.get("NUM_PLOT_WORKERS", 2))
+MAX_QUEUED_RENDERS = int(os.environ.get("MAX_QUEUED_RENDERS", 20))
+
+# Default engine for rendering the plots
+# The Python engine (matplotlib) avoids R for the common designs
+PLOT_ENGINES = {"R (cvms)": "r", "Python (faster)": "python"}
+PLOT_ENGINE = os.environ.get("PLOT_ENGINE", "r")
+
+
+# Start plotting workers
+# Shared by all sessions
+@st.cache_resource
+def get_plot_worker_pool():
+    """
+    R processes with the plotting packages loaded.
+    Avoids starting R for every plot.
+    """
+    return PlotWorkerPool(
+        num_workers=NUM_PLOT_WORKERS, max_jobs=100, max_memory_mb=1024
+    )
+
+
+# Queue of render jobs
+# Shared by all sessions
+@st.cache_resource
+def get_render_scheduler():
+    """
+    Limits the number of concurrent renders to the number of
+    plotting workers and lets the sessions take turns.
+    """
+    return RenderScheduler(
+        max_concurrent=NUM_PLOT_WORKERS,
+        max_queued=MAX_QUEUED_RENDERS,
+        max_queued_per_session=1,
+    )
+
+
+# Number of processes for counting large csv files
+# and the file size (MB) from which they are used
+COUNT_WORKERS = int(os.environ.get("COUNT_WORKERS", 2))
+PARALLEL_COUNT_MIN_MB = int(os.environ.get("PARALLEL_COUNT_MIN_MB", 64))
+
+
+# Processes for counting large csv files
+# Shared by all sessions
+@st.cache_resource
+def get_count_executor():
+    """
+    The processes are spawned rather than forked,
+    as the server process has many threads.
+    """
+    return ProcessPoolExecutor(
+        max_workers=COUNT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+# Cache of rendered plots
+# Shared by all sessions and kept between server restarts
+@st.cache_resource
+def get_render_cache():
+    return RenderCache(
+        cache_dir=pathlib.Path(tempfile.gettempdir()) / "plot_confusion_matrix_cache",
+        max_size_bytes=500 * 1024**2,
+        # Not failures of the render itself - another waiting session renders instead
+        retry_errors=(QueueFullError, RenderCancelledError, PlotRenderCancelledError),
+    )
+
+
+# Rendered images in memory (with previews and greyscale versions)
+# Shared by all sessions
+@st.cache_resource
+def get_image_cache():
+    return ImageCache(max_entries=32)
+
+
+@st.cache_resource
+def get_plotting_code_version():
+    return plotting_code_version(
+        paths=["plot.R", "plot_functions.R", "python_plotting.py"],
+        extra=get_cvms_version(),
+    )
+
+
+# Port of the Prometheus metrics endpoint (0 to disable)
+# and whether to show the timings of the last render in the app
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+SHOW_DEBUG_PANEL = os.environ.get("SHOW_DEBUG_PANEL", "0") == "1"
+
+
+@st.cache_resource
+def get_metrics_server():
+    """
+    Serves the metrics at `http://127.0.0.1:<METRICS_PORT>/metrics`.
+    """
+    if not METRICS_PORT:
+        return None
+
+    def collect():
+        set_gauges(
+            "render_cache", get_render_cache().stats(), help="Render cache statistics."
+        )
+        set_gauges(
+            "render_scheduler",
+            get_render_scheduler().stats(),
+            help="Render queue statistics.",
+        )
+        set_gauges(
+            "workspaces",
+            get_workspace_manager().stats(),
+            help="Session workspace statistics.",
+        )
+
+    try:
+        return start_metrics_server(port=METRICS_PORT, collectors=[collect])
+    except OSError as e:
+        print(f"Failed to start metrics server on port {METRICS_PORT}: {e}")
+        return None
+
+
+get_metrics_server()
+
+
+def get_session_id():
+    ctx = get_script_run_ctx()
+    return "default" if ctx is None else ctx.session_id
+
+
+# Files of this session
+workspace = get_workspace_manager().get(get_session_id())
+data_store_path = workspace.path / f"data{HANDOFF_FORMATS[DATA_HANDOFF_FORMAT]}"
+design_settings_store_path = workspace.path / "design_settings.json"
+conf_mat_path = workspace.path / "confusion_matrix.png"
+conf_mat_jpg_path = conf_mat_path.with_suffix(".jpg")
+conf_mat_preview_path = workspace.path / "confusion_matrix_preview.png"
+conf_mat_preview_jpg_path = conf_mat_preview_path.with_suffix(".jpg")
+exports_dir_path = workspace.path / "exports"
+exports_dir_path.mkdir(exist_ok=True)
+# Plots rendered ahead of time (e.g. for neighbouring thresholds)
+prerender_dir_path = workspace.path / "prerender"
+
+
+def check_workspace_quota():
+    """
+    Stop when the files of this session take up too much disk space.
+    """
+    try:
+        get_workspace_manager().record_usage(workspace)
+    except WorkspaceQuotaError as e:
+        st.error(f"{e} Please try again with smaller data or fewer exports.")
+        print(f"Workspace quota exceeded: {get_workspace_manager().stats()}")
+        st.stop()
+
+
+def cancel_stale_render(render_key):
+    """
+    Cancel the session's in-flight render when it is for other inputs
+    (e.g. the design settings were changed and submitted again).
+    """
+    pending = st.session_state.get("pending_render")
+    if pending is not None and pending["key"] != render_key:
+        get_render_scheduler().cancel(pending["ticket"])
+        del st.session_state["pending_render"]
+
+
+def show_previous_plot():
+    """
+    Show the last successfully rendered plot while a new one is rendering.
+    """
+    previous_image = get_image_cache().get(st.session_state.get("last_render_key"))
+    if previous_image is None:
+        return
+    _, col, _ = st.columns([2, st.session_state.get("image_col_size", 8.0), 2])
+    with col:
+        st.image(
+            previous_image.preview(
+                width=get_preview_width(st.session_state.get("image_col_size", 8.0))
+            ),
+            caption="Previous plot (updating...)",
+        )
+
+
+def queued_render(plotting_job, render_key, show_previous=True):
+    """
+    Render the plot in the background through the render queue.
+    Shows the position in the queue and the previous plot while waiting.
+
+    The script run can be interrupted (e.g. by a new submission) while
+    waiting. The job keeps running and the next run picks it up again
+    when its inputs are the same, or cancels it when they have changed.
+    """
+    scheduler = get_render_scheduler()
+    cancel_stale_render(render_key)
+    pending = st.session_state.get("pending_render")
+    if pending is not None and pending["ticket"].status != "cancelled":
+        ticket = pending["ticket"]
+    else:
+        # Run in a copy of this context, so the spans
+        # are added to the trace of this script run
+        context = contextvars.copy_context()
+        ticket = scheduler.submit(
+            session_id=get_session_id(),
+            fn=lambda cancel_event: context.run(
+                render_with_engine,
+                plotting_job,
+                worker_pool=get_plot_worker_pool(),
+                cancel_event=cancel_event,
+            ),
+        )
+        st.session_state["pending_render"] = {"key": render_key, "ticket": ticket}
+
+    status_placeholder = st.empty()
+    previous_plot_placeholder = st.empty()
+    if show_previous:
+        with previous_plot_placeholder.container():
+            show_previous_plot()
+    while not ticket.wait(timeout=0.25):
+        position = scheduler.position(ticket)
+        if position is not None and position > 0:
+            status_placeholder.info(
+                f"Waiting for other plots to finish. Position in queue: {position}"
+            )
+        else:
+            status_placeholder.info("Rendering plot...")
+    status_placeholder.empty()
+    previous_plot_placeholder.empty()
+    st.session_state.pop("pending_render", None)
+    if ticket.run_seconds is not None:
+        record_span("render_queue_wait", wall_seconds=ticket.wait_seconds, cpu_seconds=0)
+        print(
+            f"Render waited {ticket.wait_seconds:.2f}s and ran {ticket.run_seconds:.2f}s. "
+            f"Render scheduler: {scheduler.stats()}"
+        )
+    return ticket.get_result()
+
+
+def render_plot(plotting_job, render_key, out_paths, show_previous=True):
+    """
+    Render plot with the plotting workers or get it from the render cache.
+    """
+    try:
+        get_render_cache().get_or_render(
+            key=render_key,
+            render_fn=lambda: queued_render(
+                plotting_job, render_key=render_key, show_previous=show_previous
+            ),
+            out_paths=out_paths,
+        )
+    except QueueFullError:
+        st.error(
+            "The server is busy with other plots right now, "
+            "so your plot could not be queued. Please try again in a moment."
+        )
+        print(f"Render queue full: {get_render_scheduler().stats()}")
+        st.stop()
+    except (RenderCancelledError, PlotRenderCancelledError):
+        # A newer render from this session replaced this one
+        st.stop()
+    except PlotRenderError as e:
+        show_plotting_error(e.output)
+        print(e.output)
+        print(f"Plotting job: {plotting_job}")
+        raise e
+
+
+def cancel_stale_prerenders(keep_keys):
+    """
+    Cancel the session's background renders that are not for `keep_keys`.
+    The inputs of a render are removed once it has finished.
+    """
+    prerenders = st.session_state.get("prerenders", {})
+    for key, ticket in list(prerenders.items()):
+        if key not in keep_keys:
+            get_render_scheduler().cancel(ticket)
+        if ticket.done.is_set():
+            shutil.rmtree(prerender_dir_path / key, ignore_errors=True)
+            del prerenders[key]
+
+
+def prerender_plot(render, data, settings, render_key_args, extra=None):
+    """
+    Render a plot in the background, so it is in the render cache
+    when it is requested. `render` is the render that is displayed and
+    `data` are the counts to plot with its job instead.
+
+    The data and settings are written to a directory named by the render key,
+    which is not touched until the render has finished, as the session's
+    own files change on every rerun.
+    The render is skipped when it is already cached or pending.
+    Background renders only start when no other renders are waiting.
+    """
+    render_cache = get_render_cache()
+    prerenders = st.session_state.setdefault("prerenders", {})
+    prerender_dir_path.mkdir(parents=True, exist_ok=True)
+    fd, tmp_data_path = tempfile.mkstemp(
+        dir=prerender_dir_path, suffix=data_store_path.suffix
+    )
+    os.close(fd)
+    tmp_data_path = pathlib.Path(tmp_data_path)
+    write_plot_data(data, tmp_data_path)
+    render_key = make_render_key(
+        **{**render_key_args, "data_path": tmp_data_path}, extra=extra
+    )
+    if render_key in prerenders or render_cache.contains(render_key):
+        tmp_data_path.unlink()
+        return
+
+    job_dir_path = prerender_dir_path / render_key
+    job_dir_path.mkdir(exist_ok=True)
+    data_path = job_dir_path / data_store_path.name
+    os.replace(tmp_data_path, data_path)
+    settings_path = job_dir_path / design_settings_store_path.name
+    with open(settings_path, "w") as f:
+        f.write(settings.to_json())
+
+    def in_job_dir(path):
+        return str(job_dir_path / pathlib.Path(path).name)
+
+    plotting_job = {
+        **render["job"],
+        "data_path": str(data_path),
+        "settings_path": str(settings_path),
+        "out_path": in_job_dir(render["job"]["out_path"]),
+    }
+    if "exports" in plotting_job:
+        plotting_job["exports"] = [
+            {**export, "path": in_job_dir(export["path"])}
+            for export in plotting_job["exports"]
+        ]
+    out_paths = {
+        path.name: job_dir_path / path.name
+        for path in [render["png_path"], render["jpg_path"]]
+    }
+    worker_pool = get_plot_worker_pool()
+    try:
+        ticket = get_render_scheduler().submit(
+            session_id=get_session_id(),
+            fn=lambda cancel_event: render_cache.get_or_render(
+                key=render_key,
+                render_fn=lambda: render_with_engine(
+                    plotting_job, worker_pool=worker_pool, cancel_event=cancel_event
+                ),
+                out_paths=out_paths,
+            ),
+            background=True,
+        )
+    except QueueFullError:
+        shutil.rmtree(job_dir_path, ignore_errors=True)
+        return
+    prerenders[render_key] = ticket
+
+
+# Number of rows to read from large files
+# for selecting columns and previewing the data
+NUM_SAMPLE_ROWS = 1000
+
+
+def count_upload_in_parallel(
+    data, target_col, prediction_col, group_col, progress_callback
+):
+    """
+    Count an uploaded csv file in the counting processes.
+    The file is written to the workspace for the processes to read
+    and removed again after counting.
+    """
+    fd, upload_path = tempfile.mkstemp(dir=workspace.path, prefix=".upload.", suffix=".csv")
+    try:
+        data.seek(0)
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(data, f)
+        return count_csv_parallel(
+            upload_path,
+            target_col=target_col,
+            prediction_col=prediction_col,
+            progress_callback=progress_callback,
+            executor=get_count_executor(),
+            group_col=group_col,
+        )
+    finally:
+        os.remove(upload_path)
+
+
+def get_streamed_counts(
+    data, target_col, prediction_col, group_col=None, probabilities=False
+):
+    """
+    Count the target-prediction combinations of a large file in chunks.
+    With `group_col`, the combinations are counted per group
+    (`Group`, `Target`, `Prediction`, `N` columns).
+    With `probabilities`, the observations are counted per target class and
+    unique probability instead (see `count_probability_chunks()`).
+    The counts are stored in the session state to avoid counting again
+    on every rerun.
+    """
+    key = (data.name, data.size, target_col, prediction_col, group_col, probabilities)
+    if st.session_state.get("streamed_counts_key") != key:
+        progress_bar = st.progress(0.0, text="Counting target-prediction combinations")
+
+        def update_progress(num_rows, progress):
+            progress_bar.progress(
+                progress if progress is not None else 0.0,
+                text=f"Counted {num_rows:,} rows",
+            )
+
+        with span("count_streamed", file_type=get_file_type(data)):
+            if probabilities:
+                st.session_state["streamed_counts"] = count_probability_chunks(
+                    iter_data_chunks(
+                        data, columns=list(dict.fromkeys([target_col, prediction_col]))
+                    ),
+                    target_col=target_col,
+                    prediction_col=prediction_col,
+                    total_rows=get_num_rows(data),
+                    progress_callback=update_progress,
+                )
+            elif (
+                get_file_type(data) == "csv"
+                and COUNT_WORKERS > 1
+                and data.size >= PARALLEL_COUNT_MIN_MB * 1024**2
+            ):
+                st.session_state["streamed_counts"] = count_upload_in_parallel(
+                    data,
+                    target_col=target_col,
+                    prediction_col=prediction_col,
+                    group_col=group_col,
+                    progress_callback=update_progress,
+                )
+            elif get_file_type(data) == "csv":
+                st.session_state["streamed_counts"] = count_csv_in_chunks(
+                    data,
+                    target_col=target_col,
+                    prediction_col=prediction_col,
+                    group_col=group_col,
+                    progress_callback=update_progress,
+                )
+            else:
+                st.session_state["streamed_counts"] = count_chunks(
+                    iter_data_chunks(
+                        data,
+                        columns=list(
+                            dict.fromkeys(
+                                [target_col, prediction_col]
+                                + ([group_col] if group_col is not None else [])
+                            )
+                        ),
+                    ),
+                    target_col=target_col,
+                    prediction_col=prediction_col,
+                    group_col=group_col,
+                    total_rows=get_num_rows(data),
+                    progress_callback=update_progress,
+                )
+        st.session_state["streamed_counts_key"] = key
+        progress_bar.empty()
+    return st.session_state["streamed_counts"]
+
+
+# Offer to keep only the top classes when there are more classes than this
+MANY_CLASSES = 10
+
+# Maximum number of groups (facets) to plot
+MAX_GROUPS = 36
+
+
+def top_classes_section(get_counts, classes):
+    """
+    Let the user keep the top-k classes and collapse the rest into an "Other" class.
+    Works on the aggregated counts (`Target`, `Prediction`, `N` columns from
+    `get_counts()`), so changing k does not require reading the data again.
 
+    Returns the collapsed counts and classes or `None` and
+    the original classes when not enabled.
+    """
+    with st.expander("Many classes? Keep only the top classes"):
+        st.write(
+            "Plots with many classes are slow to render and hard to read. "
+            "Keep the top classes and collapse the rest into a single class. "
+            "All observations are kept."
+        )
+        use_top_k = add_toggle_horizontal(
+            label="Collapse the other classes", key="use_top_k", default=False
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            k = st.number_input(
+                "Number of classes to keep",
+                min_value=2,
+                max_value=len(classes) - 1,
+                value=min(MANY_CLASSES, len(classes) - 1),
+            )
+        with col2:
+            rank_by = st.selectbox(
+                "Rank classes by",
+                options=list(CLASS_RANKINGS.keys()),
+                help="\n\n".join(
+                    f"**{name}**: {description}."
+                    for name, description in CLASS_RANKINGS.items()
+                ),
+            )
+        if not use_top_k:
+            return None, classes
+
+        matrix = select_classes(get_counts(), classes=classes)
+        kept_classes, excluded_classes = top_k_classes(
+            matrix, classes=classes, k=k, by=rank_by
+        )
+        collapsed_matrix, collapsed_classes = collapse_classes(
+            matrix, classes=classes, keep=kept_classes
+        )
+        st.write(
+            f"**Collapsed into *{collapsed_classes[-1]}* "
+            f"({len(excluded_classes)} classes)**: " + ", ".join(excluded_classes)
+        )
+    return matrix_to_long(collapsed_matrix, classes=collapsed_classes), collapsed_classes
+
+
+# Maximum number of thresholds to scrub between
+MAX_THRESHOLDS = 1001
+
+
+def threshold_section(probability_counts, classes, data_key):
+    """
+    Let the user choose the thresholds for binary probability predictions
+    and scrub between them. The confusion matrices at all the thresholds are
+    counted in a single pass over the counts per target class and unique
+    probability (see `threshold_confusion_matrices()`) and stored in the
+    session state, so scrubbing does not count again.
+
+    Returns the thresholds, their confusion matrices (targets x predictions),
+    the index of the selected threshold and the classes of the matrices
+    (negative, positive).
+    """
+    st.subheader("Decision threshold")
+    st.write(
+        "The predictions are probabilities, so they are converted to predicted "
+        "classes with a decision threshold. Observations are predicted as the "
+        "positive class when their probability is at least the threshold. "
+        "Move the slider to see the confusion matrix at other thresholds."
+    )
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        positive_class = st.selectbox(
+            "Positive class",
+            options=classes,
+            index=len(classes) - 1,
+            help="The class that the probabilities are the probabilities of.",
+        )
+    with col2:
+        use_unique = (
+            st.selectbox(
+                "Thresholds",
+                options=["Evenly spaced", "Every unique probability"],
+            )
+            == "Every unique probability"
+        )
+    with col3:
+        num_thresholds = st.number_input(
+            "# Thresholds",
+            min_value=2,
+            max_value=MAX_THRESHOLDS,
+            value=101,
+            disabled=use_unique,
+        )
+
+    key = (data_key, positive_class, use_unique, num_thresholds)
+    if st.session_state.get("threshold_sweep_key") != key:
+        with span("threshold_sweep"):
+            probabilities = probability_counts["Probability"].to_numpy()
+            thresholds = get_thresholds(
+                probabilities, num_thresholds=None if use_unique else num_thresholds
+            )
+            if len(thresholds) > MAX_THRESHOLDS:
+                # Keep evenly spaced quantiles of the unique probabilities
+                thresholds = thresholds[
+                    np.linspace(0, len(thresholds) - 1, MAX_THRESHOLDS)
+                    .round()
+                    .astype(np.int64)
+                ]
+            matrices = threshold_confusion_matrices(
+                is_positive=(
+                    probability_counts["Target"] == positive_class
+                ).to_numpy(),
+                probabilities=probabilities,
+                thresholds=thresholds,
+                weights=probability_counts["N"].to_numpy(),
+            )
+        st.session_state["threshold_sweep"] = (thresholds, matrices)
+        st.session_state["threshold_sweep_key"] = key
+    thresholds, matrices = st.session_state["threshold_sweep"]
+    if use_unique and len(thresholds) == MAX_THRESHOLDS:
+        st.caption(
+            f"There are too many unique probabilities, so {MAX_THRESHOLDS} "
+            "of them are used as thresholds."
+        )
 
-temp_dir, temp_dir_path = set_tmp_dir()
-gen_data_store_path = pathlib.Path(f"{temp_dir_path}/generated_data.csv")
-data_store_path = pathlib.Path(f"{temp_dir_path}/data.csv")
-design_settings_store_path = pathlib.Path(f"{temp_dir_path}/design_settings.json")
-conf_mat_path = pathlib.Path(f"{temp_dir_path}/confusion_matrix.png")
+    threshold_index = st.select_slider(
+        "Threshold",
+        options=list(range(len(thresholds))),
+        value=int(np.abs(thresholds - 0.5).argmin()),
+        format_func=lambda i: f"{thresholds[i]:.4g}",
+    )
+    negative_class = [c for c in classes if c != positive_class][0]
+    return thresholds, matrices, threshold_index, [negative_class, positive_class]
 
 
 def input_choice_callback():
@@ -67,14 +753,18 @@ def input_choice_callback():
     st.session_state["input_type"] = None
     st.session_state["num_resets"] = 0
 
-    to_delete = ["classes", "count_data", "uploaded_design_settings"]
+    to_delete = [
+        "classes",
+        "count_data",
+        "uploaded_design_settings",
+        "streamed_counts",
+        "streamed_counts_key",
+    ]
     for key in to_delete:
         if key in st.session_state:
             st.session_state.pop(key)
 
     # Remove old tmp files
-    if gen_data_store_path.exists():
-        gen_data_store_path.unlink()
     if data_store_path.exists():
         data_store_path.unlink()
     if conf_mat_path.exists():
@@ -84,6 +774,9 @@ def input_choice_callback():
     st.session_state["design_reset_mode"] = False
 
 
+# Collect the timings of this script run
+trace = start_trace()
+
 # Text
 intro_text()
 
@@ -112,7 +805,12 @@ if st.session_state.get("input_type") is None:
 if input_choice == "Upload predictions":
     with st.form(key="data_form"):
         upload_predictions_text()
-        data_path = st.file_uploader("Upload a dataset", type=["csv"])
+        data_path = st.file_uploader("Upload a dataset", type=DATA_FILE_TYPES)
+        stream_data = add_toggle_horizontal(
+            label="Large file: Count in chunks",
+            key="stream_data",
+            default=False,
+        )
         if st.form_submit_button(label="Use data"):
             if data_path:
                 st.session_state["step"] = 1
@@ -123,23 +821,44 @@ if input_choice == "Upload predictions":
                 )
 
     if st.session_state["step"] >= 1:
-        # Read and store (tmp) data
-        df = read_data_cached(data_path)
+        data_columns = read_column_names_cached(data_path)
         with st.form(key="column_form"):
             columns_text()
-            target_col = st.selectbox("Targets column", options=list(df.columns))
-            prediction_col = st.selectbox(
-                "Predictions column", options=list(df.columns)
+            target_col = st.selectbox("Targets column", options=data_columns)
+            prediction_col = st.selectbox("Predictions column", options=data_columns)
+            group_col = st.selectbox(
+                "Group column",
+                options=["--"] + data_columns,
+                help="Optional! A confusion matrix is plotted per group "
+                "(e.g. per fold or site) with a shared color scale.",
             )
 
             if st.form_submit_button(label="Set columns"):
                 st.session_state["step"] = 2
 
+        if st.session_state["step"] >= 2:
+            if group_col == "--":
+                group_col = None
+            # Read and store (tmp) data
+            # Only the selected columns are read
+            # For large files, we only read the first rows here
+            # and count the rest in chunks
+            df = read_data_cached(
+                data_path,
+                nrows=NUM_SAMPLE_ROWS if stream_data else None,
+                columns=list(
+                    dict.fromkeys(
+                        [target_col, prediction_col]
+                        + ([group_col] if group_col is not None else [])
+                    )
+                ),
+            )
+
 # Load data
 elif input_choice == "Upload counts":
     with st.form(key="data_form"):
         upload_counts_text()
-        data_path = st.file_uploader("Upload your counts", type=["csv"])
+        data_path = st.file_uploader("Upload your counts", type=DATA_FILE_TYPES)
         if st.form_submit_button(label="Use counts"):
             if data_path:
                 st.session_state["step"] = 1
@@ -148,23 +867,15 @@ elif input_choice == "Upload counts":
                 st.write("Please upload a file first.")
 
     if st.session_state["step"] >= 1:
-        # Read and store (tmp) data
-        st.session_state["count_data"] = read_data_cached(data_path)
+        data_columns = read_column_names_cached(data_path)
         with st.form(key="column_form"):
             columns_text()
-            target_col = st.selectbox(
-                "Targets column", options=list(st.session_state["count_data"].columns)
-            )
-            prediction_col = st.selectbox(
-                "Predictions column",
-                options=list(st.session_state["count_data"].columns),
-            )
-            n_col = st.selectbox(
-                "Counts column", options=list(st.session_state["count_data"].columns)
-            )
+            target_col = st.selectbox("Targets column", options=data_columns)
+            prediction_col = st.selectbox("Predictions column", options=data_columns)
+            n_col = st.selectbox("Counts column", options=data_columns)
             sub_col = st.selectbox(
                 "Sub column",
-                options=["--"] + list(st.session_state["count_data"].columns),
+                options=["--"] + data_columns,
                 help="Optional! This column will replace the bottom text in the middle of the tiles.",
             )
 
@@ -172,6 +883,15 @@ elif input_choice == "Upload counts":
                 st.session_state["step"] = 2
 
         if st.session_state["step"] >= 2:
+            # Read and store (tmp) data
+            # Only the selected columns are read
+            selected_columns = [target_col, prediction_col, n_col]
+            if sub_col != "--":
+                selected_columns.append(sub_col)
+            st.session_state["count_data"] = read_data_cached(
+                data_path, columns=list(dict.fromkeys(selected_columns))
+            )
+
             # Ensure targets and predictions are clean strings
             st.session_state["count_data"][target_col] = clean_str_column(
                 st.session_state["count_data"][target_col]
@@ -185,12 +905,6 @@ elif input_choice == "Upload counts":
 
 # Generate data
 elif input_choice == "Generate":
-
-    def reset_generation_callback():
-        p = pathlib.Path(gen_data_store_path)
-        if p.exists():
-            p.unlink()
-
     with st.form(key="generate_form"):
         generate_data_text()
         col1, col2, col3 = st.columns(3)
@@ -206,24 +920,20 @@ elif input_choice == "Generate":
                 "# Observations",
                 value=30,
                 min_value=2,
-                max_value=10000,
+                max_value=10_000_000,
                 help="Number of observations to generate data for.",
             )
         with col3:
             seed = st.number_input("Random Seed", value=42, min_value=0)
-        if st.form_submit_button(
-            label="Generate data", on_click=reset_generation_callback
-        ):
+        if st.form_submit_button(label="Generate data"):
             st.session_state["step"] = 2
 
     if st.session_state["step"] >= 2:
-        generate_data(
-            out_path=gen_data_store_path,
+        df = generate_data_cached(
             num_classes=num_classes,
             num_observations=num_observations,
             seed=seed,
         )
-        df = read_data(gen_data_store_path)
         target_col = "Target"
         prediction_col = "Predicted Class"
 
@@ -242,64 +952,116 @@ elif input_choice == "Enter counts":
             label="Populate matrix", on_click=repopulate_matrix_callback
         ):
             # Extract class names from comma-separated list
+            # Duplicates and empty names are removed
             # TODO: Allow white space in classes?
             st.session_state["classes"] = [
-                clean_string_for_non_alphanumerics(s) for s in classes_joined.split(",")
+                c
+                for c in dict.fromkeys(
+                    clean_string_for_non_alphanumerics(s)
+                    for s in classes_joined.split(",")
+                )
+                if c
             ]
+            num_classes = len(st.session_state["classes"])
 
-            # Calculate all pairs of predictions and targets
-            all_pairs = list(combinations(st.session_state["classes"], 2))
-            all_pairs += [(pair[1], pair[0]) for pair in all_pairs]
-            all_pairs += [(c, c) for c in st.session_state["classes"]]
-
-            # Prepopulate the matrix
-            st.session_state["count_data"] = pd.DataFrame(
-                all_pairs, columns=["Target", "Prediction"]
+            # Prepopulate the matrix (targets x predictions)
+            st.session_state["count_matrix"] = np.zeros(
+                (num_classes, num_classes), dtype=np.int64
+            )
+            st.session_state["sub_matrix"] = np.full(
+                (num_classes, num_classes), "", dtype=object
             )
-            st.session_state["count_data"]["Sub"] = ""
-            st.session_state["count_data"]["N"] = 0
 
             st.session_state["step"] = 1
 
     if st.session_state["step"] >= 1:
+        classes = st.session_state["classes"]
+        use_sub_grid = add_toggle_horizontal(
+            label="Add texts to replace the counts in the tiles",
+            key="use_sub_grid",
+            default=False,
+        )
         with st.form(key="enter_counts_form"):
             st.write(
-                "Fill in the counts by pressing each cell in the `N` column and inputting the counts. "
-            )
-            st.markdown(
-                "(**Optional**) If you wish to specify the bottom text in the middle of the tiles, "
-                "you can fill in the `Sub` column.",
-                help="The `sub` column text replaces the bottom text (counts by default). "
-                "The design settings for the replaced element (e.g. counts) are used for this text instead.",
+                "Fill in the counts by pressing each cell of the matrix. "
+                "The rows are the targets and the columns are the predictions. "
+                "You can also paste a range of cells from a spreadsheet."
             )
             st.info(
                 "Note: Please click outside the cell before "
                 "pressing `Generate data` to register your change."
             )
 
-            new_counts = st.data_editor(
-                st.session_state["count_data"],
-                hide_index=True,
+            new_count_matrix = st.data_editor(
+                pd.DataFrame(
+                    st.session_state["count_matrix"],
+                    index=pd.Index(classes, name="Target"),
+                    columns=classes,
+                ),
                 column_config={
-                    "Target": st.column_config.TextColumn(disabled=True),
-                    "Prediction": st.column_config.TextColumn(disabled=True),
-                    "Sub": st.column_config.TextColumn(
-                        help="This text replaces the bottom text (in the middle of the tiles). "
-                        "By default, the counts are replaced. "
-                        "Note that the settings for this text are named "
-                        "by the text element it replaces (e.g. **Fonts**>>*Counts*)."
-                    ),
-                    "N": st.column_config.NumberColumn(
-                        disabled=False, min_value=0, step=1
-                    ),
+                    c: st.column_config.NumberColumn(min_value=0, step=1)
+                    for c in classes
                 },
             )
 
+            with st.expander("Paste the whole matrix"):
+                pasted_matrix = st.text_area(
+                    "Matrix",
+                    help="One row per target class and one column per predicted class "
+                    "(in the order of the classes). Values can be separated by tabs "
+                    "(e.g. copied from a spreadsheet), commas or spaces. "
+                    "When specified, this replaces the counts above.",
+                )
+
+            if use_sub_grid:
+                st.markdown(
+                    "**Tile texts**: Text that replaces the bottom text "
+                    "in the middle of each tile.",
+                    help="The text replaces the bottom text (counts by default). "
+                    "The design settings for the replaced element (e.g. counts) "
+                    "are used for this text instead "
+                    "(e.g. **Fonts**>>*Counts*).",
+                )
+                new_sub_matrix = st.data_editor(
+                    pd.DataFrame(
+                        st.session_state["sub_matrix"],
+                        index=pd.Index(classes, name="Target"),
+                        columns=classes,
+                    ),
+                    column_config={c: st.column_config.TextColumn() for c in classes},
+                )
+
             if st.form_submit_button(
                 label="Generate data",
             ):
-                st.session_state["count_data"] = new_counts
-                st.session_state["step"] = 2
+                try:
+                    if pasted_matrix.strip():
+                        count_matrix = parse_count_matrix(
+                            pasted_matrix, num_classes=len(classes)
+                        )
+                    else:
+                        count_matrix = (
+                            new_count_matrix.fillna(0).to_numpy().astype(np.int64)
+                        )
+                except ValueError as e:
+                    st.error(f"Could not use the pasted matrix: {e}")
+                else:
+                    st.session_state["count_matrix"] = count_matrix
+                    if use_sub_grid:
+                        st.session_state["sub_matrix"] = (
+                            new_sub_matrix.fillna("").astype(str).to_numpy(dtype=object)
+                        )
+                    # Convert to the long format in one go
+                    count_data = matrix_to_long(count_matrix, classes=classes)
+                    count_data.insert(
+                        2,
+                        "Sub",
+                        st.session_state["sub_matrix"].ravel()
+                        if use_sub_grid
+                        else "",
+                    )
+                    st.session_state["count_data"] = count_data
+                    st.session_state["step"] = 2
 
     if st.session_state["step"] >= 2:
         DownloadHeader.header_and_data_download(
@@ -318,48 +1080,183 @@ elif input_choice == "Enter counts":
 
 if st.session_state["step"] >= 2:
     data_is_ready = False
+    # Counts of all target-prediction combinations (when available)
+    all_counts = None
+    # Counts per group of large files (counted in chunks)
+    group_counts = None
+    predictions_are_probabilities = False
+    # Optional column to plot a confusion matrix per group
+    if "group_col" not in locals():
+        group_col = None
     if st.session_state["input_type"] == "data":
         # Remove unused columns
-        df = df.loc[:, [target_col, prediction_col]]
+        df = df.loc[
+            :,
+            list(
+                dict.fromkeys(
+                    [target_col, prediction_col]
+                    + ([group_col] if group_col is not None else [])
+                )
+            ),
+        ]
 
         predictions_are_probabilities = is_float_dtype(df[prediction_col])
+        if predictions_are_probabilities and group_col is not None:
+            st.warning("The group column is not used when the predictions are probabilities.")
+            group_col = None
+            df = df.loc[:, [target_col, prediction_col]]
+        # Large files are counted in chunks instead of read into memory
+        is_streamed = input_choice == "Upload predictions" and stream_data
         if predictions_are_probabilities:
-            st.error(
-                "Predictions should be the predicted classes - not probabilities. "
-            )
-            data_is_ready = False
+            # Ensure targets are clean strings
+            df[target_col] = clean_str_column(df[target_col])
+            # Count the observations per target class and unique probability
+            # for the threshold sweep
+            if is_streamed:
+                probability_counts, num_rows = get_streamed_counts(
+                    data=data_path,
+                    target_col=target_col,
+                    prediction_col=prediction_col,
+                    probabilities=True,
+                )
+            else:
+                probability_counts = partial_probability_counts(
+                    targets=df[target_col], probabilities=df[prediction_col]
+                )
+                num_rows = len(df)
+            if probability_counts["Target"].nunique() != 2:
+                st.error(
+                    "Predictions should be the predicted classes - not probabilities. "
+                    "Probabilities are only supported for binary classification "
+                    "(two classes in the targets column)."
+                )
+                data_is_ready = False
+            else:
+                data_is_ready = True
         else:
             data_is_ready = True
 
         if data_is_ready:
-            # Ensure targets and predictions are clean strings
-            df[target_col] = clean_str_column(df[target_col])
-            df[prediction_col] = clean_str_column(df[prediction_col])
-
-            # Save to tmp directory to allow reading in R script
-            df.to_csv(data_store_path, index=False)
+            if not predictions_are_probabilities:
+                # Ensure targets and predictions are clean strings
+                df[target_col] = clean_str_column(df[target_col])
+                df[prediction_col] = clean_str_column(df[prediction_col])
+            if group_col is not None:
+                df[group_col] = clean_str_column(df[group_col])
+                if is_streamed:
+                    group_counts, num_rows = get_streamed_counts(
+                        data=data_path,
+                        target_col=target_col,
+                        prediction_col=prediction_col,
+                        group_col=group_col,
+                    )
+                    num_groups = group_counts["Group"].nunique()
+                else:
+                    num_groups = df[group_col].nunique()
+                if num_groups > MAX_GROUPS:
+                    st.error(
+                        f"The group column has {num_groups} groups. "
+                        f"Please select a column with at most {MAX_GROUPS} groups."
+                    )
+                    data_is_ready = False
 
-            # Extract unique classes
-            st.session_state["classes"] = sorted(
-                [str(c) for c in df[target_col].unique()]
-            )
+            if predictions_are_probabilities:
+                st.session_state["classes"] = sorted(
+                    probability_counts["Target"].unique()
+                )
+                data_shape = (num_rows, df.shape[1])
+            elif is_streamed:
+                if group_col is None:
+                    all_counts, num_rows = get_streamed_counts(
+                        data=data_path,
+                        target_col=target_col,
+                        prediction_col=prediction_col,
+                    )
+                # Extract unique classes (present as targets)
+                target_counts = (
+                    all_counts if group_counts is None else group_counts
+                ).groupby("Target")["N"].sum()
+                st.session_state["classes"] = sorted(
+                    target_counts.index[target_counts > 0]
+                )
+                data_shape = (num_rows, df.shape[1])
+            else:
+                # Extract unique classes
+                st.session_state["classes"] = sorted(
+                    [str(c) for c in df[target_col].unique()]
+                )
+                data_shape = df.shape
 
             st.subheader("The data")
             col1, col2, col3 = st.columns([3, 2, 3])
             with col2:
                 st.dataframe(df.head(5), hide_index=True)
-                st.write(f"{df.shape} (Showing first 5 rows)")
+                st.write(f"{data_shape} (Showing first 5 rows)")
+
+            if predictions_are_probabilities:
+                (
+                    thresholds,
+                    threshold_matrices,
+                    threshold_index,
+                    threshold_classes,
+                ) = threshold_section(
+                    probability_counts=probability_counts,
+                    classes=st.session_state["classes"],
+                    data_key=(data_path.name, data_path.size, target_col, prediction_col),
+                )
+                all_counts = matrix_to_long(
+                    threshold_matrices[threshold_index], classes=threshold_classes
+                )
 
     else:
         count_data_clean = st.session_state["count_data"].copy()
-        if not any(count_data_clean["Sub"]):
+        if "Sub" in count_data_clean and not any(count_data_clean["Sub"]):
             del count_data_clean["Sub"]
-        count_data_clean.to_csv(data_store_path, index=False)
+        write_plot_data(count_data_clean, data_store_path)
+        check_workspace_quota()
         data_is_ready = True
 
+    # The classes to plot (may be collapsed below)
+    plot_classes = st.session_state.get("classes")
+    if data_is_ready and len(plot_classes) > MANY_CLASSES:
+        if group_col is not None:
+            # The classes are collapsed in the total counts, not per group
+            get_all_counts = None
+        elif st.session_state["input_type"] == "data":
+            if all_counts is None:
+                get_all_counts = lambda: count_data(
+                    targets=df[target_col],
+                    predictions=df[prediction_col],
+                    classes=st.session_state["classes"],
+                )
+            else:
+                get_all_counts = lambda: all_counts
+        elif "Sub" not in count_data_clean and (
+            "sub_col" not in locals() or sub_col is None or sub_col == "--"
+        ):
+            get_all_counts = lambda: count_data_clean[
+                [target_col, prediction_col, n_col]
+            ].set_axis(["Target", "Prediction", "N"], axis=1)
+        else:
+            # The sub column texts can't be collapsed
+            get_all_counts = None
+
+        if get_all_counts is not None:
+            collapsed_counts, plot_classes = top_classes_section(
+                get_counts=get_all_counts, classes=plot_classes
+            )
+            if collapsed_counts is not None:
+                if st.session_state["input_type"] == "data":
+                    all_counts = collapsed_counts
+                else:
+                    write_plot_data(collapsed_counts, data_store_path)
+                    target_col = "Target"
+                    prediction_col = "Prediction"
+                    n_col = "N"
+
     if data_is_ready:
         # Check the number of classes
-        num_classes = len(st.session_state["classes"])
+        num_classes = len(plot_classes)
         if num_classes < 2:
             # TODO Handle better than throwing error?
             raise ValueError(
@@ -372,6 +1269,7 @@ if st.session_state["step"] >= 2:
         design_ready, selected_classes = design_section(
             num_classes=num_classes,
             design_settings_store_path=design_settings_store_path,
+            classes=plot_classes,
         )
 
         # design_ready tells us whether to proceed or wait
@@ -387,44 +1285,256 @@ if st.session_state["step"] >= 2:
 
             st.markdown("---")
 
-            selected_classes_string = ",".join([f"'{c}'" for c in selected_classes])
-
-            plotting_args = [
-                "--data_path",
-                f"'{data_store_path}'",
-                "--out_path",
-                f"'{conf_mat_path}'",
-                "--settings_path",
-                f"'{design_settings_store_path}'",
-                "--target_col",
-                f"'{target_col}'",
-                "--prediction_col",
-                f"'{prediction_col}'",
-                "--classes",
-                f"{selected_classes_string}",
-            ]
+            if st.session_state["input_type"] == "data":
+                # Count the target-prediction combinations for the selected classes
+                # and save to tmp directory to allow reading in R script
+                # The R script then only needs to read the small counts table
+                with span("count_data"):
+                    if group_col is not None:
+                        if group_counts is not None:
+                            # Large files were counted per group in chunks
+                            group_matrices, groups = count_grouped_confusion_matrices(
+                                groups=group_counts["Group"],
+                                targets=group_counts["Target"],
+                                predictions=group_counts["Prediction"],
+                                classes=selected_classes,
+                                weights=group_counts["N"],
+                            )
+                        else:
+                            # Count all groups in a single pass
+                            group_matrices, groups = count_grouped_confusion_matrices(
+                                groups=df[group_col],
+                                targets=df[target_col],
+                                predictions=df[prediction_col],
+                                classes=selected_classes,
+                            )
+                        # The column name is used in the facet titles
+                        facet_col = group_col
+                        if facet_col in ["Target", "Prediction", "N"]:
+                            facet_col += " (group)"
+                        selected_counts = grouped_matrices_to_long(
+                            group_matrices,
+                            groups=groups,
+                            classes=selected_classes,
+                            group_col=facet_col,
+                        )
+                    elif all_counts is not None:
+                        selected_counts = matrix_to_long(
+                            select_classes(all_counts, classes=selected_classes),
+                            classes=selected_classes,
+                        )
+                    else:
+                        selected_counts = count_data(
+                            targets=df[target_col],
+                            predictions=df[prediction_col],
+                            classes=selected_classes,
+                        )
+                write_plot_data(selected_counts, data_store_path)
+                check_workspace_quota()
+                target_col = "Target"
+                prediction_col = "Prediction"
+                n_col = "N"
+
+            plotting_job = {
+                "data_path": str(data_store_path),
+                "out_path": str(conf_mat_path),
+                "settings_path": str(design_settings_store_path),
+                "target_col": target_col,
+                "prediction_col": prediction_col,
+                "n_col": n_col,
+                "classes": ",".join(selected_classes),
+                "data_are_counts": True,
+            }
 
             if "sub_col" in locals() and sub_col is not None and sub_col != "--":
-                plotting_args += ["--sub_col", f"{sub_col}"]
+                plotting_job["sub_col"] = sub_col
+            if group_col is not None:
+                plotting_job["group_col"] = facet_col
+
+            try:
+                if not design_settings_store_path.exists():
+                    # The workspace was removed while the session was inactive
+                    with open(design_settings_store_path, "w") as f:
+                        f.write(
+                            DesignSettings.from_dict(
+                                st.session_state["selected_design_settings"]
+                            ).to_json()
+                        )
+                settings = DesignSettings.load(design_settings_store_path)
+            except DesignSettingsError as e:
+                st.error(f"The design settings are invalid:\n{e}")
+                st.stop()
+            design_settings = settings.to_dict()
+            if group_col is not None:
+                # The facets share the color scale
+                plotting_job["intensity_lims"] = get_shared_intensity_lims(
+                    group_matrices, intensity_by=design_settings["intensity_by"]
+                )
 
-            if st.session_state["input_type"] == "counts":
-                # The input data are counts
-                plotting_args += ["--n_col", f"{n_col}", "--data_are_counts"]
+            # Log which settings changed since the last plot
+            last_settings = st.session_state.get("last_design_settings")
+            if last_settings is not None and last_settings != settings:
+                st.session_state["design_settings_diff"] = settings.diff(last_settings)
+                print(
+                    f"Design settings changed: {st.session_state['design_settings_diff']}"
+                )
+            st.session_state["last_design_settings"] = settings
+
+            render_key_args = {
+                "data_path": data_store_path,
+                "design_settings": settings.digest(),
+                "classes": selected_classes,
+                "columns": {
+                    col: plotting_job.get(col)
+                    for col in [
+                        "target_col",
+                        "prediction_col",
+                        "n_col",
+                        "sub_col",
+                        "group_col",
+                    ]
+                },
+                "version": get_plotting_code_version(),
+            }
 
-            plotting_args = " ".join(plotting_args)
+            col1, col2, col3, col4 = st.columns([1, 5, 3, 3])
+            with col2:
+                preview_mode = add_toggle_horizontal(
+                    label="Fast preview (lower resolution)",
+                    key="preview_mode",
+                    default=True,
+                )
+            with col3:
+                plotting_job["engine"] = PLOT_ENGINES[
+                    st.selectbox(
+                        "Renderer",
+                        options=list(PLOT_ENGINES.keys()),
+                        index=list(PLOT_ENGINES.values()).index(PLOT_ENGINE),
+                        key="plot_engine",
+                        help="The Python renderer is faster but its plots differ slightly "
+                        "from cvms. Plots of predictions (not counts) are rendered "
+                        "with R.",
+                    )
+                ]
+            with col4:
+                request_full_quality = st.button(
+                    "Render full quality",
+                    disabled=not preview_mode,
+                    help="Render the plot at the designed resolution for download.",
+                )
 
-            call_subprocess(
-                f"Rscript plot.R {plotting_args}",
-                message="Plotting script",
-                return_output=True,
-                encoding="UTF-8",
+            render_key_args["engine"] = resolve_engine(plotting_job, design_settings)
+            if (
+                plotting_job["engine"] == "python"
+                and render_key_args["engine"] != "python"
+            ):
+                st.caption(
+                    "Rendered with R, as the Python renderer does not support: "
+                    + ", ".join(get_unsupported_features(plotting_job, design_settings))
+                    + ". Turn these off in the design to render with Python."
+                )
+
+            # Previews and full-quality plots are cached separately
+            full_render_key = make_render_key(**render_key_args)
+            preview_render_key = make_render_key(
+                **render_key_args, extra={"preview_scaling": PREVIEW_SCALING}
             )
+            full_render = {
+                "key": full_render_key,
+                "job": plotting_job,
+                "png_path": conf_mat_path,
+                "jpg_path": conf_mat_jpg_path,
+            }
+            preview_render = {
+                "key": preview_render_key,
+                "job": {
+                    **plotting_job,
+                    "out_path": str(conf_mat_preview_path),
+                    "exports": build_preview_exports(
+                        png_path=conf_mat_preview_path,
+                        jpg_path=conf_mat_preview_jpg_path,
+                        design_settings=design_settings,
+                    ),
+                },
+                "png_path": conf_mat_preview_path,
+                "jpg_path": conf_mat_preview_jpg_path,
+            }
+
+            image_cache = get_image_cache()
+
+            def get_rendered_image(render, show_previous=True):
+                rendered_image = image_cache.get(render["key"])
+                if rendered_image is None:
+                    with span("render_total"):
+                        render_plot(
+                            plotting_job=render["job"],
+                            render_key=render["key"],
+                            out_paths={
+                                render["png_path"].name: render["png_path"],
+                                render["jpg_path"].name: render["jpg_path"],
+                            },
+                            show_previous=show_previous,
+                        )
+                    # Load once into memory for the viewer and download button
+                    with span("load_image"):
+                        rendered_image = image_cache.load(
+                            render["key"],
+                            png_path=render["png_path"],
+                            jpg_path=render["jpg_path"],
+                        )
+                return rendered_image
+
+            displayed_render = preview_render if preview_mode else full_render
+            cancel_stale_prerenders(keep_keys=[displayed_render["key"]])
+            cancel_stale_render(displayed_render["key"])
+            rendered_image = get_rendered_image(displayed_render)
+            st.session_state["last_render_key"] = displayed_render["key"]
+
+            if predictions_are_probabilities:
+                # Render the neighbouring thresholds in the background,
+                # so scrubbing to them is fast
+                for neighbour_index in [threshold_index - 1, threshold_index + 1]:
+                    if not 0 <= neighbour_index < len(thresholds):
+                        continue
+                    neighbour_counts = matrix_to_long(
+                        threshold_matrices[neighbour_index], classes=threshold_classes
+                    )
+                    prerender_plot(
+                        render=displayed_render,
+                        data=matrix_to_long(
+                            select_classes(neighbour_counts, classes=selected_classes),
+                            classes=selected_classes,
+                        ),
+                        settings=settings,
+                        render_key_args=render_key_args,
+                        extra=(
+                            {"preview_scaling": PREVIEW_SCALING}
+                            if displayed_render is preview_render
+                            else None
+                        ),
+                    )
+                check_workspace_quota()
+
+            # The download is always the full-quality plot
+            full_image = image_cache.get(full_render_key)
+            if full_image is None and request_full_quality:
+                full_image = get_rendered_image(full_render, show_previous=False)
+            st.session_state["last_render_trace"] = trace
 
             (
                 image_col_size,
                 st.session_state["show_greyscale"],
             ) = DownloadHeader.slider_and_image_download(
                 filepath=conf_mat_path,
+                data=(
+                    full_image.png_bytes
+                    if full_image is not None
+                    else rendered_image.png_bytes
+                ),
+                download_disabled=full_image is None,
+                download_help="Download plot"
+                if full_image is not None
+                else "Press `Render full quality` to enable the download.",
                 download_label="Download plot",
                 slider_label="Zoom",
                 toggle_label="Show greyscale",
@@ -455,10 +1565,11 @@ if st.session_state["step"] >= 2:
             with col2:
                 st.write(" ")
                 st.write(" ")
-                image = Image.open(str(conf_mat_path)[:-3] + "jpg")
+                preview_width = get_preview_width(st.session_state["image_col_size"])
                 st.image(
-                    image,
-                    caption="Confusion Matrix",
+                    rendered_image.preview(width=preview_width),
+                    caption="Confusion Matrix"
+                    + (" (Preview)" if displayed_render is preview_render else ""),
                     clamp=False,
                     channels="RGB",
                     output_format="auto",
@@ -467,9 +1578,8 @@ if st.session_state["step"] >= 2:
                 if st.session_state["show_greyscale"]:
                     # Convert the image to grayscale
                     st.write(" ")
-                    image = image.convert("CMYK").convert("L")
                     st.image(
-                        image,
+                        rendered_image.greyscale_preview(width=preview_width),
                         caption="Greyscale version for assessing colors in print",
                         clamp=False,
                         channels="RGB",
@@ -478,9 +1588,118 @@ if st.session_state["step"] >= 2:
                 st.write(" ")
                 st.write("Note: The downloadable file has a transparent background.")
 
+            st.write(" ")
+            with st.expander("Export bundle"):
+                st.write(
+                    "Export the plot in multiple formats and sizes at once. "
+                    "The sizes scale the width, height and DPI together, "
+                    "so the layout stays as designed."
+                )
+                with st.form(key="export_form"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        export_formats = st.multiselect(
+                            "Formats",
+                            options=list(EXPORT_FORMATS.keys()),
+                            default=["PNG (transparent)", "PDF"],
+                        )
+                    with col2:
+                        export_presets = st.multiselect(
+                            "Sizes",
+                            options=list(EXPORT_PRESETS.keys()),
+                            default=["As designed"],
+                        )
+                    use_fast_raster_device = add_toggle_horizontal(
+                        label="Use faster raster device (ragg)",
+                        key="use_fast_raster_device",
+                        default=True,
+                    )
+                    use_facet_pages = False
+                    if group_col is not None:
+                        use_facet_pages = add_toggle_horizontal(
+                            label="PDF with a page per group (instead of a grid)",
+                            key="use_facet_pages",
+                            default=False,
+                        )
+                    create_bundle = st.form_submit_button("Create export bundle")
+
+                if create_bundle:
+                    if not export_formats or not export_presets:
+                        st.error("Please select at least one format and one size.")
+                    else:
+                        # Remove files from previous bundles
+                        shutil.rmtree(exports_dir_path, ignore_errors=True)
+                        exports_dir_path.mkdir()
+                        exports = build_exports(
+                            out_dir=exports_dir_path,
+                            formats=export_formats,
+                            presets=export_presets,
+                            design_settings=design_settings,
+                        )
+                        export_job = {**plotting_job, "exports": exports}
+                        if use_fast_raster_device:
+                            export_job["raster_device"] = "ragg"
+                        if use_facet_pages:
+                            export_job["facet_pages"] = True
+                        export_paths = {
+                            pathlib.Path(export["path"]).name: pathlib.Path(
+                                export["path"]
+                            )
+                            for export in exports
+                        }
+                        render_plot(
+                            plotting_job=export_job,
+                            render_key=make_render_key(
+                                **render_key_args,
+                                extra={
+                                    "exports": [
+                                        {
+                                            **export,
+                                            "path": pathlib.Path(export["path"]).name,
+                                        }
+                                        for export in exports
+                                    ],
+                                    "raster_device": export_job.get("raster_device"),
+                                    "facet_pages": export_job.get("facet_pages"),
+                                },
+                            ),
+                            out_paths=export_paths,
+                            show_previous=False,
+                        )
+                        check_workspace_quota()
+                        st.download_button(
+                            label="Download bundle (.zip)",
+                            data=zip_files(list(export_paths.values())),
+                            file_name="confusion_matrix_exports.zip",
+                            mime="application/zip",
+                        )
+
 else:
     st.write("Please upload data.")
 
+if SHOW_DEBUG_PANEL and st.session_state.get("last_render_trace"):
+    with st.expander("Debug: Timings of the last render"):
+        st.write(
+            "Stages starting with `r_` were timed by the R process. "
+            "Render stages are only included when the plot was not cached."
+        )
+        st.dataframe(
+            pd.DataFrame(st.session_state["last_render_trace"]), hide_index=True
+        )
+        if st.session_state.get("design_settings_diff"):
+            st.write("Design settings changed since the previous plot:")
+            st.dataframe(
+                pd.DataFrame(
+                    [
+                        {"Setting": name, "Before": str(before), "After": str(after)}
+                        for name, (before, after) in st.session_state[
+                            "design_settings_diff"
+                        ].items()
+                    ]
+                ),
+                hide_index=True,
+            )
+
 # Spacing
 for _ in range(5):
     st.write(" ")
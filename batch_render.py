@@ -0,0 +1,370 @@
+"""
+Render confusion matrix plots for many prediction/count files without the app.
+
+Examples:
+    python batch_render.py --input_dir predictions/ --settings_path design_settings.json \
+        --out_dir plots/ --target_col Target --prediction_col Prediction --num_workers 4
+
+    python batch_render.py --manifest manifest.json --settings_path design_settings.json \
+        --out_dir plots/
+
+The manifest is a json list (or csv table) with one entry per plot. Entries have a `path`
+and optionally `name`, `target_col`, `prediction_col`, `n_col` (the file has counts),
+`sub_col` and `classes` (comma-separated). Missing fields use the command line values.
+
+The design settings file has the same format as the one downloaded from the app.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+from aggregation import (
+    count_chunks,
+    count_csv_parallel,
+    matrix_to_long,
+    select_classes,
+)
+from data import (
+    DATA_FILE_TYPES,
+    HANDOFF_FORMATS,
+    get_file_type,
+    iter_data_chunks,
+    read_data,
+    write_plot_data,
+)
+from export import EXPORT_FORMATS, build_exports
+from python_plotting import (
+    PLOT_ENGINES,
+    render_job,
+    render_with_engine,
+    resolve_engine,
+)
+from settings import DesignSettings, DesignSettingsError
+from utils import PlotRenderError, PlotWorkerPool, clean_str_column
+
+ITEM_FIELDS = ["target_col", "prediction_col", "n_col", "sub_col", "classes"]
+
+
+def find_inputs(input_dir) -> list:
+    input_dir = pathlib.Path(input_dir)
+    paths = sorted(
+        p
+        for p in input_dir.rglob("*")
+        if p.is_file() and p.suffix.lstrip(".").lower() in DATA_FILE_TYPES
+    )
+    return [
+        {
+            "path": str(p),
+            # Unique names for files in subdirectories
+            "name": "__".join(p.relative_to(input_dir).with_suffix("").parts),
+        }
+        for p in paths
+    ]
+
+
+def read_manifest(manifest_path) -> list:
+    manifest_path = pathlib.Path(manifest_path)
+    if manifest_path.suffix == ".csv":
+        items = pd.read_csv(manifest_path, dtype=str, keep_default_na=False)
+        items = [
+            {k: v for k, v in item.items() if v != ""}
+            for item in items.to_dict(orient="records")
+        ]
+    else:
+        with open(manifest_path, "r") as f:
+            items = json.load(f)
+    for item in items:
+        if "path" not in item:
+            raise ValueError(f"Manifest entry has no `path`: {item}")
+        item.setdefault("name", pathlib.Path(item["path"]).stem)
+    return items
+
+
+def prepare_counts(
+    item: dict, counts_path: pathlib.Path, process_pool=None
+) -> dict:
+    """
+    Count (or read) the data for a plot and write the counts table for `plot.R`.
+    Csv files of predictions are split and counted in `process_pool` when specified.
+    Returns the plotting job arguments for the counts table.
+    """
+    classes = item.get("classes")
+    if classes is not None:
+        classes = [c.strip() for c in classes.split(",")]
+
+    if item.get("n_col") is not None:
+        # The file already has counts
+        columns = [item["target_col"], item["prediction_col"], item["n_col"]]
+        if item.get("sub_col") is not None:
+            columns.append(item["sub_col"])
+        counts = read_data(item["path"], columns=list(dict.fromkeys(columns)))
+        for col in [item["target_col"], item["prediction_col"]]:
+            counts[col] = clean_str_column(counts[col])
+        if classes is None:
+            classes = sorted(counts[item["target_col"]].unique())
+        write_plot_data(counts, counts_path)
+        job = {
+            "target_col": item["target_col"],
+            "prediction_col": item["prediction_col"],
+            "n_col": item["n_col"],
+        }
+        if item.get("sub_col") is not None:
+            job["sub_col"] = item["sub_col"]
+        num_rows = len(counts)
+    else:
+        if process_pool is not None and get_file_type(item["path"]) == "csv":
+            all_counts, num_rows = count_csv_parallel(
+                item["path"],
+                target_col=item["target_col"],
+                prediction_col=item["prediction_col"],
+                executor=process_pool,
+            )
+        else:
+            all_counts, num_rows = count_chunks(
+                iter_data_chunks(
+                    item["path"],
+                    columns=list(
+                        dict.fromkeys([item["target_col"], item["prediction_col"]])
+                    ),
+                ),
+                target_col=item["target_col"],
+                prediction_col=item["prediction_col"],
+            )
+        if classes is None:
+            # Classes present as targets
+            target_counts = all_counts.groupby("Target")["N"].sum()
+            classes = sorted(target_counts.index[target_counts > 0])
+        write_plot_data(
+            matrix_to_long(select_classes(all_counts, classes=classes), classes=classes),
+            counts_path,
+        )
+        job = {"target_col": "Target", "prediction_col": "Prediction", "n_col": "N"}
+
+    job["classes"] = ",".join(classes)
+    job["num_rows"] = num_rows
+    return job
+
+
+def render_item(
+    item: dict,
+    pool: PlotWorkerPool,
+    settings_path,
+    design_settings: dict,
+    out_dir: pathlib.Path,
+    formats: list,
+    raster_device,
+    handoff_format: str = "csv",
+    engine: str = "r",
+    process_pool=None,
+) -> dict:
+    result = {"name": item["name"], "path": item["path"], "status": "ok"}
+    start = time.perf_counter()
+    try:
+        counts_path = (
+            out_dir / ".counts" / f"{item['name']}{HANDOFF_FORMATS[handoff_format]}"
+        )
+        if process_pool is None or (
+            item.get("n_col") is None and get_file_type(item["path"]) == "csv"
+        ):
+            job = prepare_counts(
+                item, counts_path=counts_path, process_pool=process_pool
+            )
+        else:
+            # Count in a worker process, as the pandas work holds the GIL
+            job = process_pool.submit(
+                prepare_counts, item, counts_path=counts_path
+            ).result()
+        result["num_rows"] = job.pop("num_rows")
+        result["aggregate_seconds"] = time.perf_counter() - start
+
+        exports = build_exports(
+            out_dir=out_dir,
+            formats=formats,
+            presets=["As designed"],
+            design_settings=design_settings,
+            file_stem=item["name"],
+        )
+        job.update(
+            {
+                "data_path": str(counts_path),
+                "out_path": exports[0]["path"],
+                "settings_path": str(settings_path),
+                "data_are_counts": True,
+                "exports": exports,
+                "engine": engine,
+            }
+        )
+        if raster_device is not None:
+            job["raster_device"] = raster_device
+
+        result["engine"] = resolve_engine(job, design_settings)
+        render_start = time.perf_counter()
+        if result["engine"] == "python" and process_pool is not None:
+            # Render in a worker process, as matplotlib holds the GIL
+            job.pop("engine")
+            process_pool.submit(render_job, job).result()
+        else:
+            render_with_engine(job, worker_pool=pool)
+        result["render_seconds"] = time.perf_counter() - render_start
+        result["outputs"] = [export["path"] for export in exports]
+    except PlotRenderError as e:
+        result["status"] = "failed"
+        result["error"] = e.output
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["total_seconds"] = time.perf_counter() - start
+    return result
+
+
+def main(args=None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        "--input_dir",
+        help="Directory with prediction or count files (csv, parquet, feather, arrow).",
+    )
+    inputs.add_argument(
+        "--manifest", help="Json or csv file with a list of files to plot."
+    )
+    parser.add_argument(
+        "--settings_path", required=True, help="Design settings (.json)."
+    )
+    parser.add_argument("--out_dir", required=True, help="Directory to save plots in.")
+    parser.add_argument("--target_col", default="Target")
+    parser.add_argument("--prediction_col", default="Prediction")
+    parser.add_argument(
+        "--n_col", default=None, help="Counts column. When set, the files are counts."
+    )
+    parser.add_argument("--sub_col", default=None)
+    parser.add_argument(
+        "--classes", default=None, help="Comma-separated classes to use (in order)."
+    )
+    parser.add_argument(
+        "--formats",
+        default="PNG (transparent)",
+        help=f"Comma-separated export formats. Options: {', '.join(EXPORT_FORMATS)}.",
+    )
+    parser.add_argument(
+        "--num_workers", type=int, default=2, help="Number of R plotting workers."
+    )
+    parser.add_argument(
+        "--count_workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes for counting and for rendering with Python.",
+    )
+    parser.add_argument(
+        "--raster_device",
+        default=None,
+        help="Set to 'ragg' to use the faster ragg raster devices.",
+    )
+    parser.add_argument(
+        "--handoff_format",
+        default="feather",
+        choices=list(HANDOFF_FORMATS),
+        help="Format of the counts passed to R. Feather requires the R `arrow` package.",
+    )
+    parser.add_argument(
+        "--engine",
+        default="r",
+        choices=PLOT_ENGINES,
+        help="Render with R (cvms) or in-process with Python (matplotlib). "
+        "Designs the Python engine does not support are rendered with R.",
+    )
+    args = parser.parse_args(args)
+
+    out_dir = pathlib.Path(args.out_dir)
+    (out_dir / ".counts").mkdir(parents=True, exist_ok=True)
+    try:
+        design_settings = DesignSettings.load(args.settings_path).to_dict()
+    except DesignSettingsError as e:
+        parser.error(f"Invalid design settings in {args.settings_path}:\n{e}")
+    except (OSError, ValueError) as e:
+        parser.error(f"Failed to read the design settings: {e}")
+    formats = [f.strip() for f in args.formats.split(",")]
+    for format_name in formats:
+        if format_name not in EXPORT_FORMATS:
+            parser.error(f"Unknown format: {format_name}")
+
+    items = (
+        find_inputs(args.input_dir)
+        if args.input_dir is not None
+        else read_manifest(args.manifest)
+    )
+    for item in items:
+        for field in ITEM_FIELDS:
+            if item.get(field) is None:
+                item[field] = getattr(args, field)
+
+    start = time.perf_counter()
+    pool = PlotWorkerPool(num_workers=args.num_workers)
+    # For counting and Python renders
+    # Spawned, as the render threads are running when the processes start
+    process_pool = ProcessPoolExecutor(
+        max_workers=args.count_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    try:
+        # The threads wait for the R workers and the processes
+        with ThreadPoolExecutor(
+            max_workers=max(args.num_workers, args.count_workers)
+        ) as executor:
+            results = list(
+                executor.map(
+                    lambda item: render_item(
+                        item,
+                        pool=pool,
+                        settings_path=pathlib.Path(args.settings_path).resolve(),
+                        design_settings=design_settings,
+                        out_dir=out_dir,
+                        formats=formats,
+                        raster_device=args.raster_device,
+                        handoff_format=args.handoff_format,
+                        engine=args.engine,
+                        process_pool=process_pool,
+                    ),
+                    items,
+                )
+            )
+    finally:
+        pool.shutdown()
+        process_pool.shutdown(cancel_futures=True)
+
+    summary = {
+        "settings_path": args.settings_path,
+        "num_workers": args.num_workers,
+        "engine": args.engine,
+        "total_seconds": time.perf_counter() - start,
+        "succeeded": sum(r["status"] == "ok" for r in results),
+        "failed": sum(r["status"] != "ok" for r in results),
+        "results": results,
+    }
+    with open(out_dir / "summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    for r in results:
+        timing = f"{r['total_seconds']:.2f}s"
+        print(f"{r['status']:>6} | {timing:>8} | {r['name']}")
+        if r["status"] != "ok":
+            error_lines = (r["error"] or "").strip().splitlines()
+            print(f"         {error_lines[-1] if error_lines else 'Unknown error'}")
+    print(
+        f"Rendered {summary['succeeded']}/{len(results)} plots "
+        f"in {summary['total_seconds']:.2f}s with {args.num_workers} workers. "
+        f"Summary: {out_dir / 'summary.json'}"
+    )
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
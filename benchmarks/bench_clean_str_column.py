@@ -0,0 +1,66 @@
+"""
+Benchmark of `utils.clean_str_column()` against the previous
+row-by-row implementation on large, low-cardinality columns.
+
+Run from the repository root:
+    python benchmarks/bench_clean_str_column.py --num_rows 5000000 --num_classes 20
+
+"""
+
+import argparse
+import pathlib
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from utils import clean_str_column  # noqa: E402
+
+
+def legacy_clean_string_for_non_alphanumerics(s):
+    pattern1 = re.compile(r"[^0-9a-zA-Z\s]+")
+    pattern2 = re.compile(r"\s+")
+    s = pattern1.sub("", s)
+    s = pattern2.sub(" ", s)
+    return s.strip()
+
+
+def legacy_clean_str_column(x):
+    return x.astype(str).apply(lambda x: legacy_clean_string_for_non_alphanumerics(x))
+
+
+def make_column(num_rows, num_classes, seed=1):
+    rng = np.random.default_rng(seed)
+    labels = np.array([f" class-{i}  (#{i})" for i in range(num_classes)], dtype=object)
+    return pd.Series(labels[rng.integers(0, num_classes, size=num_rows)])
+
+
+def time_fn(fn, x, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn(x)
+        timings.append(time.perf_counter() - start)
+    return min(timings), out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num_rows", type=int, default=5_000_000)
+    parser.add_argument("--num_classes", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    x = make_column(args.num_rows, args.num_classes)
+    for name, column in [("object", x), ("category", x.astype("category"))]:
+        legacy_time, legacy_out = time_fn(legacy_clean_str_column, column, args.repeats)
+        new_time, new_out = time_fn(clean_str_column, column, args.repeats)
+        assert legacy_out.equals(new_out), "Outputs differ"
+        print(
+            f"{name:>8} | rows: {args.num_rows:,} | classes: {args.num_classes} | "
+            f"legacy: {legacy_time:.3f}s | unique-based: {new_time:.3f}s | "
+            f"speedup: {legacy_time / new_time:.1f}x"
+        )
@@ -0,0 +1,333 @@
+"""
+Benchmark of the ingest -> aggregate -> render pipeline on synthetic data.
+
+Each stage is timed separately for every combination of row and class counts:
+    read_data:         Read the target and prediction columns of a csv file
+    clean_str_column:  Clean the target and prediction columns
+    class_extraction:  Get the sorted unique target classes
+    count_data:        Count the target-prediction combinations
+    count_streamed:    Count the csv file in chunks (the large-file path)
+    count_parallel:    Count the csv file in `--count_workers` processes
+    csv_handoff:       Write the counts for the R script
+    render:            Render the plot in a (warm) R plotting worker
+                       with sums, arrows, 3D effect and zero shading
+
+Rendering requires R with the plotting packages and is enabled with `--render`.
+
+Run from the repository root:
+    python benchmarks/bench_pipeline.py --num_rows 1e3,1e5,1e6 --num_classes 2,20,200 \
+        --out bench_results.json
+
+Compare with a stored baseline (exits with status 1 on regressions):
+    python benchmarks/bench_pipeline.py --out bench_results.json --baseline baseline.json
+
+Compare existing results without running the benchmark:
+    python benchmarks/bench_pipeline.py --from_results bench_results.json --baseline baseline.json
+
+"""
+
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+# Don't log the spans of the instrumented stages
+os.environ.setdefault("METRICS_LOG_SPANS", "0")
+from aggregation import (  # noqa: E402
+    count_csv_in_chunks,
+    count_csv_parallel,
+    count_data,
+)
+from data import read_data  # noqa: E402
+from utils import PlotWorker, clean_str_column  # noqa: E402
+
+# Common, relatively expensive design settings for the render stage
+RENDER_SETTINGS_PATH = (
+    ROOT_DIR / "template_resources" / "design_settings.blues_nc3_sums_1.1.json"
+)
+RENDER_SETTINGS_OVERRIDES = {
+    "show_sums": True,
+    "show_arrows": True,
+    "amount_3d_effect": 1,
+    "show_zero_shading": True,
+}
+
+# Rows generated and written per chunk
+WRITE_CHUNK_SIZE = 5_000_000
+
+
+def parse_int_list(s):
+    # Allow scientific notation like 1e6
+    return [int(float(x)) for x in s.split(",")]
+
+
+def write_synthetic_csv(path, num_rows, num_classes, seed=1):
+    """
+    Write a csv file with "Target" and "Prediction" columns.
+    Predictions are correct for ~70% of the rows.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.array([f"class {i + 1}" for i in range(num_classes)], dtype=object)
+    for start in range(0, num_rows, WRITE_CHUNK_SIZE):
+        size = min(WRITE_CHUNK_SIZE, num_rows - start)
+        targets = rng.integers(0, num_classes, size=size)
+        predictions = np.where(
+            rng.random(size) < 0.7, targets, rng.integers(0, num_classes, size=size)
+        )
+        pd.DataFrame(
+            {"Target": labels[targets], "Prediction": labels[predictions]}
+        ).to_csv(path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+
+
+def time_stage(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        timings.append(time.perf_counter() - start)
+    return timings, out
+
+
+def run_benchmark(args):
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix="bench_pipeline_"))
+    results = []
+
+    worker = None
+    if args.render:
+        with open(RENDER_SETTINGS_PATH, "r") as f:
+            design_settings = {**json.load(f), **RENDER_SETTINGS_OVERRIDES}
+        settings_path = tmp_dir / "design_settings.json"
+        with open(settings_path, "w") as f:
+            json.dump(design_settings, f)
+        worker = PlotWorker(script_path="plot_worker.R")
+        # Startup is not part of the render timings
+        worker.start()
+
+    def add_result(num_rows, num_classes, stage, timings):
+        result = {
+            "num_rows": num_rows,
+            "num_classes": num_classes,
+            "stage": stage,
+            "min_seconds": min(timings),
+            "median_seconds": statistics.median(timings),
+            "repeats": len(timings),
+        }
+        results.append(result)
+        print(
+            f"rows: {num_rows:>11,} | classes: {num_classes:>4} | {stage:>16} | "
+            f"min: {result['min_seconds']:.4f}s | median: {result['median_seconds']:.4f}s",
+            flush=True,
+        )
+
+    # Started once, so process startup is not part of the timings
+    executor = ProcessPoolExecutor(max_workers=args.count_workers)
+    try:
+        for num_rows in args.num_rows:
+            for num_classes in args.num_classes:
+                data_path = tmp_dir / "data.csv"
+                write_synthetic_csv(data_path, num_rows=num_rows, num_classes=num_classes)
+
+                timings, df = time_stage(
+                    lambda: read_data(
+                        str(data_path), columns=["Target", "Prediction"]
+                    ),
+                    args.repeats,
+                )
+                add_result(num_rows, num_classes, "read_data", timings)
+
+                def clean():
+                    return clean_str_column(df["Target"]), clean_str_column(
+                        df["Prediction"]
+                    )
+
+                timings, (targets, predictions) = time_stage(clean, args.repeats)
+                add_result(num_rows, num_classes, "clean_str_column", timings)
+
+                timings, classes = time_stage(
+                    lambda: sorted([str(c) for c in targets.unique()]), args.repeats
+                )
+                add_result(num_rows, num_classes, "class_extraction", timings)
+
+                timings, counts = time_stage(
+                    lambda: count_data(
+                        targets=targets, predictions=predictions, classes=classes
+                    ),
+                    args.repeats,
+                )
+                add_result(num_rows, num_classes, "count_data", timings)
+
+                timings, _ = time_stage(
+                    lambda: count_csv_in_chunks(
+                        str(data_path), target_col="Target", prediction_col="Prediction"
+                    ),
+                    args.repeats,
+                )
+                add_result(num_rows, num_classes, "count_streamed", timings)
+
+                # The splits are small enough that every worker gets some
+                split_size = max(data_path.stat().st_size // args.count_workers + 1, 1024)
+                timings, _ = time_stage(
+                    lambda: count_csv_parallel(
+                        str(data_path),
+                        target_col="Target",
+                        prediction_col="Prediction",
+                        split_size=split_size,
+                        executor=executor,
+                    ),
+                    args.repeats,
+                )
+                add_result(num_rows, num_classes, "count_parallel", timings)
+
+                counts_path = tmp_dir / "counts.csv"
+                timings, _ = time_stage(
+                    lambda: counts.to_csv(counts_path, index=False), args.repeats
+                )
+                add_result(num_rows, num_classes, "csv_handoff", timings)
+
+                if worker is not None:
+                    job = {
+                        "data_path": str(counts_path),
+                        "out_path": str(tmp_dir / "confusion_matrix.png"),
+                        "settings_path": str(settings_path),
+                        "target_col": "Target",
+                        "prediction_col": "Prediction",
+                        "n_col": "N",
+                        "classes": ",".join(classes),
+                        "data_are_counts": True,
+                    }
+                    timings, _ = time_stage(lambda: worker.render(job), args.repeats)
+                    add_result(num_rows, num_classes, "render", timings)
+
+                del df, targets, predictions
+    finally:
+        executor.shutdown()
+        if worker is not None:
+            worker.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            encoding="UTF-8",
+            stderr=subprocess.DEVNULL,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, tolerance, min_difference):
+    """
+    Compare the minimum timings with the baseline.
+    A stage has regressed when it is more than `tolerance` (fraction)
+    and `min_difference` seconds slower than the baseline.
+    Returns the regressions.
+    """
+    baseline_timings = {
+        (r["num_rows"], r["num_classes"], r["stage"]): r["min_seconds"]
+        for r in baseline["results"]
+    }
+    regressions = []
+    print("\nComparison with baseline:")
+    for result in results["results"]:
+        key = (result["num_rows"], result["num_classes"], result["stage"])
+        if key not in baseline_timings:
+            continue
+        base = baseline_timings[key]
+        current = result["min_seconds"]
+        ratio = current / base if base > 0 else float("inf")
+        regressed = current - base > min_difference and ratio > 1 + tolerance
+        if regressed:
+            regressions.append({**result, "baseline_seconds": base, "ratio": ratio})
+        print(
+            f"rows: {key[0]:>11,} | classes: {key[1]:>4} | {key[2]:>16} | "
+            f"baseline: {base:.4f}s | current: {current:.4f}s | "
+            f"ratio: {ratio:.2f}{'  <-- REGRESSION' if regressed else ''}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--num_rows", type=parse_int_list, default="1e3,1e5,1e6")
+    parser.add_argument("--num_classes", type=parse_int_list, default="2,20,200")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--count_workers", type=int, default=4)
+    parser.add_argument(
+        "--render", action="store_true", help="Also benchmark rendering (requires R)."
+    )
+    parser.add_argument("--out", default="bench_results.json", help="Results file.")
+    parser.add_argument("--baseline", default=None, help="Results file to compare with.")
+    parser.add_argument(
+        "--from_results",
+        default=None,
+        help="Compare this results file instead of running the benchmark.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown as a fraction of the baseline timing.",
+    )
+    parser.add_argument(
+        "--min_difference",
+        type=float,
+        default=0.005,
+        help="Slowdowns below this number of seconds are ignored (noise).",
+    )
+    args = parser.parse_args()
+
+    if args.from_results is not None:
+        with open(args.from_results, "r") as f:
+            results = json.load(f)
+    else:
+        results = {
+            "meta": {
+                "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                "git_commit": get_git_commit(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "repeats": args.repeats,
+            },
+            "results": run_benchmark(args),
+        }
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.out}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare_results(
+            results,
+            baseline,
+            tolerance=args.tolerance,
+            min_difference=args.min_difference,
+        )
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed.")
+            sys.exit(1)
+        print("\nNo regressions.")
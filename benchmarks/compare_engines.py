@@ -0,0 +1,189 @@
+"""
+Compare the plots of the Python engine with those of the R engine (plot.R).
+
+Each bundled template is rendered with both engines on the same synthetic counts
+and the images are compared pixel by pixel. A pixel differs when any of its
+channels differs by more than `--pixel_threshold` (0-255). A template fails when
+the fraction of differing pixels is above `--max_diff_fraction`.
+
+Requires R with the plotting packages. Also run as a test (skipped without R):
+    python -m pytest tests/test_compare_engines.py
+
+Run from the repository root:
+    python benchmarks/compare_engines.py --out_dir engine_comparison
+
+The rendered images, diff images and a `comparison.json` summary with the
+differences and render timings are saved in `--out_dir`.
+Exits with status 1 when a template fails.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageChops
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+# Don't log the spans of the instrumented stages
+os.environ.setdefault("METRICS_LOG_SPANS", "0")
+from aggregation import matrix_to_long  # noqa: E402
+from data import write_plot_data  # noqa: E402
+from python_plotting import render_job  # noqa: E402
+from utils import PlotWorker  # noqa: E402
+
+TEMPLATES_DIR = ROOT_DIR / "template_resources"
+
+
+def make_counts(num_classes, num_observations=100, seed=1):
+    """
+    Confusion matrix (targets x predictions) with mostly correct predictions
+    and at least one zero count (for the zero shading).
+    """
+    rng = np.random.default_rng(seed)
+    per_class = num_observations // num_classes
+    matrix = rng.integers(
+        1, per_class // num_classes + 2, size=(num_classes, num_classes)
+    )
+    matrix += np.diag(rng.integers(per_class, 2 * per_class, size=num_classes))
+    matrix[-1, 0] = 0
+    return matrix
+
+
+def compare_images(path_1, path_2, diff_path, pixel_threshold):
+    """
+    Compare two images and save an image of the differing pixels.
+    Returns the fraction of differing pixels and the mean absolute difference.
+    """
+    image_1 = Image.open(path_1).convert("RGB")
+    image_2 = Image.open(path_2).convert("RGB")
+    if image_1.size != image_2.size:
+        raise ValueError(f"Image sizes differ: {image_1.size} and {image_2.size}")
+    diff = np.asarray(ImageChops.difference(image_1, image_2))
+    differs = diff.max(axis=2) > pixel_threshold
+    Image.fromarray(np.where(differs, 0, 255).astype(np.uint8)).save(diff_path)
+    return float(differs.mean()), float(diff.mean())
+
+
+def compare_engines(out_dir, pixel_threshold=32, max_diff_fraction=0.02):
+    """
+    Render the templates with both engines and compare the images.
+    Saves `comparison.json` in `out_dir` and returns the results per template.
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(TEMPLATES_DIR / "manifest.json", "r") as f:
+        templates = json.load(f)["templates"]
+
+    worker = PlotWorker(script_path="plot_worker.R")
+    # Startup is not part of the render timings
+    worker.start()
+    results = []
+    try:
+        for template in templates:
+            stem = pathlib.Path(template["image"]).stem
+            with open(TEMPLATES_DIR / template["settings"], "r") as f:
+                design_settings = json.load(f)
+            settings_path = out_dir / f"{stem}.settings.json"
+            with open(settings_path, "w") as f:
+                json.dump(design_settings, f)
+
+            classes = [f"class {i + 1}" for i in range(template["num_classes"])]
+            data_path = out_dir / f"{stem}.feather"
+            write_plot_data(
+                matrix_to_long(make_counts(len(classes)), classes=classes), data_path
+            )
+
+            timings = {}
+            for engine, render_fn in [
+                ("r", worker.render),
+                ("python", render_job),
+            ]:
+                out_path = out_dir / f"{stem}.{engine}.png"
+                job = {
+                    "data_path": str(data_path),
+                    "out_path": str(out_path),
+                    "settings_path": str(settings_path),
+                    "target_col": "Target",
+                    "prediction_col": "Prediction",
+                    "n_col": "N",
+                    "classes": ",".join(classes),
+                    "data_are_counts": True,
+                    # White background, so transparency doesn't affect the comparison
+                    "exports": [
+                        {
+                            "path": str(out_path),
+                            "width": design_settings["width"],
+                            "height": design_settings["height"],
+                            "dpi": design_settings["dpi"],
+                            "bg": "white",
+                        }
+                    ],
+                }
+                start = time.perf_counter()
+                render_fn(job)
+                timings[engine] = time.perf_counter() - start
+
+            diff_fraction, mean_abs_diff = compare_images(
+                out_dir / f"{stem}.r.png",
+                out_dir / f"{stem}.python.png",
+                diff_path=out_dir / f"{stem}.diff.png",
+                pixel_threshold=pixel_threshold,
+            )
+            result = {
+                "template": template["name"],
+                "diff_fraction": diff_fraction,
+                "mean_abs_diff": mean_abs_diff,
+                "r_seconds": timings["r"],
+                "python_seconds": timings["python"],
+                "passed": diff_fraction <= max_diff_fraction,
+            }
+            results.append(result)
+            print(
+                f"{template['name']:>32} | differing pixels: {diff_fraction:.2%} | "
+                f"mean diff: {mean_abs_diff:.1f} | R: {timings['r']:.2f}s | "
+                f"Python: {timings['python']:.2f}s"
+                f"{'' if result['passed'] else '  <-- FAILED'}",
+                flush=True,
+            )
+    finally:
+        worker.stop()
+
+    with open(out_dir / "comparison.json", "w") as f:
+        json.dump(
+            {
+                "pixel_threshold": pixel_threshold,
+                "max_diff_fraction": max_diff_fraction,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--out_dir", default="engine_comparison")
+    parser.add_argument("--pixel_threshold", type=int, default=32)
+    parser.add_argument("--max_diff_fraction", type=float, default=0.02)
+    args = parser.parse_args()
+
+    results = compare_engines(
+        out_dir=args.out_dir,
+        pixel_threshold=args.pixel_threshold,
+        max_diff_fraction=args.max_diff_fraction,
+    )
+    num_failed = sum(not r["passed"] for r in results)
+    print(f"\n{len(results) - num_failed}/{len(results)} templates within tolerance.")
+    return 1 if num_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,31 +1,316 @@
 import json
+import os
 import pathlib
+import tempfile
+import numpy as np
 import pandas as pd
 import streamlit as st
-from utils import call_subprocess
 
 from components import add_toggle_vertical
+from metrics import span
 
 
-def read_data(data):
+# File types that can be uploaded
+DATA_FILE_TYPES = ["csv", "parquet", "feather", "arrow", "ipc"]
+
+
+def get_file_type(data) -> str:
+    """
+    Get the file type from the extension of a path or uploaded file.
+    """
+    name = getattr(data, "name", data)
+    return pathlib.Path(str(name)).suffix.lstrip(".").lower()
+
+
+def _rewind(data):
+    if hasattr(data, "seek"):
+        data.seek(0)
+    return data
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "Reading parquet, feather and arrow files requires the `pyarrow` package."
+        ) from e
+    return pyarrow
+
+
+def _open_ipc(data, columns=None):
+    """
+    Open an Arrow IPC file (random access format) or stream.
+    With `columns`, the batches only have these columns (in file order),
+    so the other columns are never read or decompressed.
+    """
+    pa = _import_pyarrow()
+    try:
+        open_ipc = pa.ipc.open_file
+        reader = open_ipc(_rewind(data))
+    except pa.ArrowInvalid:
+        open_ipc = pa.ipc.open_stream
+        reader = open_ipc(_rewind(data))
+    if columns is None:
+        return reader
+    included_fields = [reader.schema.get_field_index(column) for column in columns]
+    if -1 in included_fields:
+        missing = [c for c, i in zip(columns, included_fields) if i == -1]
+        raise KeyError(f"Columns not in the data: {missing}")
+    return open_ipc(
+        _rewind(data), options=pa.ipc.IpcReadOptions(included_fields=included_fields)
+    )
+
+
+def _dictionary_encode_strings(table):
+    """
+    Dictionary-encode string columns in an arrow table.
+    They become categoricals in pandas, so labels are only stored once.
+    """
+    pa = _import_pyarrow()
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(
+                i, field.name, pa.compute.dictionary_encode(table.column(i))
+            )
+    return table
+
+
+def _take_rows(batches, nrows):
+    """
+    Take the first `nrows` rows of an iterator of record batches.
+    Stops reading batches once enough rows are taken.
+    Returns `None` when there are no batches.
+    """
+    pa = _import_pyarrow()
+    taken = []
+    num_rows = 0
+    for batch in batches:
+        taken.append(batch.slice(0, nrows - num_rows))
+        num_rows += taken[-1].num_rows
+        if num_rows >= nrows:
+            break
+    if not taken:
+        return None
+    return pa.Table.from_batches(taken)
+
+
+def _iter_ipc_batches(reader):
+    if hasattr(reader, "num_record_batches"):
+        return (reader.get_batch(i) for i in range(reader.num_record_batches))
+    return reader
+
+
+def _read_arrow_table(data, file_type, columns=None, nrows=None):
+    """
+    With `nrows`, only the first record batches (or parquet row groups)
+    are read, so sampling a large file does not read all of it.
+    """
+    pa = _import_pyarrow()
+    if file_type == "parquet":
+        schema = pa.parquet.read_schema(_rewind(data))
+        string_columns = [
+            field.name
+            for field in schema
+            if (columns is None or field.name in columns)
+            and (pa.types.is_string(field.type) or pa.types.is_large_string(field.type))
+        ]
+        if nrows is None:
+            table = pa.parquet.read_table(
+                _rewind(data), columns=columns, read_dictionary=string_columns
+            )
+        else:
+            parquet_file = pa.parquet.ParquetFile(
+                _rewind(data), read_dictionary=string_columns
+            )
+            table = _take_rows(
+                parquet_file.iter_batches(batch_size=max(nrows, 1), columns=columns),
+                nrows=nrows,
+            )
+            if table is None:
+                table = schema.empty_table()
+    elif file_type == "feather" and nrows is None:
+        table = pa.feather.read_table(_rewind(data), columns=columns)
+    else:
+        reader = _open_ipc(data, columns=columns)
+        if nrows is None:
+            table = reader.read_all()
+        else:
+            table = _take_rows(_iter_ipc_batches(reader), nrows=nrows)
+            if table is None:
+                table = reader.schema.empty_table()
+    if columns is not None:
+        # Order the columns as requested
+        table = table.select(columns)
+    return _dictionary_encode_strings(table)
+
+
+def read_column_names(data) -> list:
+    """
+    Get the column names without reading the data.
+    """
+    file_type = get_file_type(data)
+    if file_type == "csv":
+        return list(pd.read_csv(_rewind(data), nrows=0).columns)
+    pa = _import_pyarrow()
+    if file_type == "parquet":
+        return pa.parquet.read_schema(_rewind(data)).names
+    return _open_ipc(data).schema.names
+
+
+@st.cache_data
+def read_column_names_cached(data) -> list:
+    return read_column_names(data)
+
+
+def get_num_rows(data):
+    """
+    Get the number of rows from the file metadata.
+    Returns `None` when not available without reading the file (e.g. csv).
+    """
+    file_type = get_file_type(data)
+    if file_type == "parquet":
+        return _import_pyarrow().parquet.ParquetFile(_rewind(data)).metadata.num_rows
+    if file_type in ["feather", "arrow", "ipc"]:
+        reader = _open_ipc(data)
+        if hasattr(reader, "num_record_batches"):
+            return sum(
+                reader.get_batch(i).num_rows for i in range(reader.num_record_batches)
+            )
+    return None
+
+
+def read_data(data, nrows=None, columns=None):
+    """
+    Read csv, parquet, feather or arrow (IPC) data.
+    Only the `columns` are read when specified.
+    String columns in the columnar formats are kept dictionary-encoded
+    (i.e. as categoricals).
+    """
     if data is not None:
-        df = pd.read_csv(data)
+        file_type = get_file_type(data)
+        with span("read_data", file_type=file_type):
+            if file_type == "csv":
+                df = pd.read_csv(_rewind(data), nrows=nrows, usecols=columns)
+            else:
+                df = _read_arrow_table(
+                    data, file_type=file_type, columns=columns, nrows=nrows
+                ).to_pandas()
         return df
     else:
         return None
 
 
 @st.cache_data
-def read_data_cached(data):
-    return read_data(data)
+def read_data_cached(data, nrows=None, columns=None):
+    return read_data(data, nrows=nrows, columns=columns)
+
+
+def iter_data_chunks(data, columns, chunksize=1_000_000):
+    """
+    Iterate over chunks of the `columns` in a csv, parquet, feather or arrow file.
+    Values in csv files are read as strings.
+    """
+    file_type = get_file_type(data)
+    if file_type == "csv":
+        with pd.read_csv(
+            _rewind(data),
+            usecols=columns,
+            dtype=str,
+            chunksize=chunksize,
+        ) as reader:
+            yield from reader
+        return
+
+    pa = _import_pyarrow()
+    if file_type == "parquet":
+        batches = pa.parquet.ParquetFile(_rewind(data)).iter_batches(
+            batch_size=chunksize, columns=columns
+        )
+    else:
+        batches = _iter_ipc_batches(_open_ipc(data, columns=columns))
+    for batch in batches:
+        table = pa.Table.from_batches([batch]).select(columns)
+        yield _dictionary_encode_strings(table).to_pandas()
 
 
-def generate_data(out_path, num_classes, num_observations, seed) -> None:
-    call_subprocess(
-        f"Rscript generate_data.R --out_path {out_path} --num_classes {num_classes} --num_observations {num_observations} --seed {seed}",
-        message="Data generation script",
-        return_output=True,
-        encoding="UTF-8",
+# Formats for handing the data to the plotting script and their extensions
+HANDOFF_FORMATS = {"csv": ".csv", "feather": ".feather"}
+
+
+def write_plot_data(df: pd.DataFrame, path) -> None:
+    """
+    Write the data for the plotting script in the format given by the extension.
+    Feather (Arrow IPC) files are written uncompressed, so R can memory-map
+    them, and keep the column names and string values exactly.
+
+    The file is written next to `path` and then moved into place, so a
+    plotting worker that is reading (or memory-mapping) the previous
+    file never sees a partially written file.
+    """
+    path = pathlib.Path(path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.stem}.", suffix=path.suffix
+    )
+    os.close(fd)
+    try:
+        if get_file_type(path) == "feather":
+            pa = _import_pyarrow()
+            with span("write_feather"):
+                pa.feather.write_feather(
+                    pa.Table.from_pandas(df, preserve_index=False),
+                    tmp_path,
+                    compression="uncompressed",
+                )
+        else:
+            with span("write_csv"):
+                df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def generate_data(num_classes, num_observations, seed) -> pd.DataFrame:
+    """
+    Generate random targets and (fairly certain) predicted classes.
+
+    Follows `cvms::multiclass_probability_tibble()` with
+    `FUN = (runif(n, min = 1, max = 100)^1.4) / 100`, `apply_softmax = TRUE`,
+    `class_name = "c"` and predicted classes and targets added.
+    Since softmax does not change the order within a row, the predicted
+    class is the argmax of the unnormalized values. The rows are generated in
+    chunks to limit memory usage with many observations.
+    NOTE: Uses the numpy random number generator, so the data differs
+    from the R version for the same seed.
+    """
+    with span("generate_data"):
+        rng = np.random.default_rng(seed)
+        classes = [f"c{i + 1}" for i in range(num_classes)]
+        targets = rng.integers(0, num_classes, size=num_observations)
+        predictions = np.empty(num_observations, dtype=np.int64)
+        chunk_size = max(1, 10_000_000 // num_classes)
+        for start in range(0, num_observations, chunk_size):
+            end = min(start + chunk_size, num_observations)
+            values = rng.uniform(1, 100, size=(end - start, num_classes)) ** 1.4 / 100
+            predictions[start:end] = values.argmax(axis=1)
+        return pd.DataFrame(
+            {
+                "Predicted Class": pd.Categorical.from_codes(
+                    predictions, categories=classes
+                ),
+                "Target": pd.Categorical.from_codes(targets, categories=classes),
+            }
+        )
+
+
+@st.cache_data
+def generate_data_cached(num_classes, num_observations, seed) -> pd.DataFrame:
+    return generate_data(
+        num_classes=num_classes, num_observations=num_observations, seed=seed
     )
 
 
@@ -49,7 +334,15 @@ class DownloadHeader:
         toggle_cols=[2, 5],
         download_help="Download plot",
         key=None,
+        data=None,
+        download_disabled=False,
     ) -> int:
+        """
+        `data`: Bytes of the image file. When specified, these are
+            downloaded instead of reading `filepath`, whose name is still used.
+        `download_disabled`: Whether to disable the download button
+            (e.g. until the full-quality image is rendered).
+        """
         col1, col2, col3, col4 = st.columns([2, 6, 3, 3])
         with col2:
             # Image viewing size slider
@@ -71,15 +364,18 @@ class DownloadHeader:
             )
         with col4:
             st.write("")
-            with open(filepath, "rb") as img:
-                st.download_button(
-                    label=download_label,
-                    data=img,
-                    file_name=pathlib.Path(filepath).name,
-                    mime="image/png",
-                    key=key + "_download" if key is not None else key,
-                    help=download_help,
-                )
+            if data is None:
+                with open(filepath, "rb") as img:
+                    data = img.read()
+            st.download_button(
+                label=download_label,
+                data=data,
+                file_name=pathlib.Path(filepath).name,
+                mime="image/png",
+                key=key + "_download" if key is not None else key,
+                help=download_help,
+                disabled=download_disabled,
+            )
         return image_col_size, toggle_state
 
     @staticmethod
@@ -1,4 +1,5 @@
 from typing import List, Callable, Any, Tuple
+import io
 import json
 import streamlit as st
 from PIL import Image
@@ -7,6 +8,7 @@ from components import add_toggle_horizontal, add_toggle_vertical
 from text_sections import (
     design_text,
 )
+from settings import DesignSettings, DesignSettingsError
 from templates import get_templates
 
 
@@ -35,8 +37,44 @@ def _add_select_box(
 
 templates = get_templates()
 
+# Width of template thumbnails (px)
+# Twice the displayed width for sharp images on high-density screens
+TEMPLATE_THUMBNAIL_WIDTH = 460
 
-def select_settings():
+
+@st.cache_resource
+def get_template_thumbnail(image_path: str) -> bytes:
+    """
+    Create a small WebP version of a template image.
+    Cached for all sessions, so each template image is only read once.
+    """
+    with Image.open(image_path) as image:
+        image.thumbnail(
+            (TEMPLATE_THUMBNAIL_WIDTH, TEMPLATE_THUMBNAIL_WIDTH * 4), Image.LANCZOS
+        )
+        buffer = io.BytesIO()
+        image.save(buffer, format="WEBP", quality=90)
+    return buffer.getvalue()
+
+
+def set_uploaded_settings(settings: dict) -> None:
+    """
+    Validate uploaded (or template) design settings once.
+    Invalid settings are reported together and use the default values.
+    """
+    if not isinstance(settings, dict):
+        st.error("The design settings must be a json object.")
+        return
+    valid_settings, errors = DesignSettings.check_values(settings)
+    if errors:
+        st.warning(
+            "Some of the uploaded settings were invalid and use the default values:\n"
+            + "\n".join(f"- {error}" for error in errors)
+        )
+    st.session_state["uploaded_design_settings"] = valid_settings
+
+
+def select_settings(num_classes):
     def reset_output_callback():
         st.session_state["selected_design_settings"].clear()
         if "uploaded_design_settings" in st.session_state:
@@ -50,21 +88,14 @@ def select_settings():
         with col1:
             # Find template with num classes closest to
             # the number of classes in the data
-            templates_available_num_classes = sorted(
-                set([d["num_classes"] for d in templates.values()])
-            )
-            closest_num_classes_distance = 99999
-            closest_num_classes_idx = -1
-            for idx, n in enumerate(templates_available_num_classes):
-                distance = abs(n - len(st.session_state["classes"]))
-                if distance < closest_num_classes_distance:
-                    closest_num_classes_distance = distance
-                    closest_num_classes_idx = idx
-
+            num_classes_options = [-1] + templates.available_num_classes
+            closest_num_classes = templates.closest_num_classes(num_classes)
             n_classes = st.selectbox(
                 "Number of classes",
-                index=closest_num_classes_idx + 1,
-                options=[-1] + templates_available_num_classes,
+                index=num_classes_options.index(closest_num_classes)
+                if closest_num_classes is not None
+                else 0,
+                options=num_classes_options,
             )
         with col2:
             has_sums = add_toggle_vertical(
@@ -75,20 +106,28 @@ def select_settings():
             )
 
         filtered_templates = {
-            temp_name: temp
-            for temp_name, temp in templates.items()
-            if (n_classes == -1 or temp["num_classes"] == n_classes)
-            and temp["sums"] == has_sums
+            temp["name"]: temp
+            for temp in templates.find(
+                num_classes=None if n_classes == -1 else n_classes, sums=has_sums
+            )
         }
 
+        # Only load the template images when the gallery is shown
+        show_gallery = add_toggle_horizontal(
+            label="Show templates",
+            key="show_template_gallery",
+            default=False,
+        )
+        if not show_gallery:
+            filtered_templates = {}
+
         num_cols = 3
         for i, (temp_name, template) in enumerate(filtered_templates.items()):
             if i % num_cols == 0:
                 cols = st.columns(num_cols)
-            temp_image = Image.open(f"template_resources/{template['image']}")
             with cols[i % 3]:
                 st.image(
-                    temp_image,
+                    get_template_thumbnail(template["image"]),
                     clamp=False,
                     channels="RGB",
                     output_format="auto",
@@ -100,13 +139,7 @@ def select_settings():
                         key=temp_name.replace(" ", "_"),
                         on_click=reset_output_callback,
                     ):
-                        with open(
-                            "template_resources/" + template["settings"],
-                            "r",
-                        ) as jfile:
-                            st.session_state["uploaded_design_settings"] = json.load(
-                                jfile
-                            )
+                        set_uploaded_settings(template["settings"])
 
     with st.expander("Upload settings"):
         uploaded_settings_path = st.file_uploader(
@@ -114,9 +147,10 @@ def select_settings():
         )
         if st.button(label="Apply settings", on_click=reset_output_callback):
             if uploaded_settings_path is not None:
-                st.session_state["uploaded_design_settings"] = json.load(
-                    uploaded_settings_path
-                )
+                try:
+                    set_uploaded_settings(json.load(uploaded_settings_path))
+                except ValueError as e:
+                    st.error(f"Could not read the design settings file: {e}")
 
     _, col2, _ = st.columns([5, 2.5, 5])
     with col2:
@@ -126,33 +160,22 @@ def select_settings():
 def design_section(
     num_classes,
     design_settings_store_path,
+    classes=None,
 ):
+    """
+    `classes`: The classes to select from. Defaults to `st.session_state["classes"]`.
+    """
+    if classes is None:
+        classes = st.session_state["classes"]
     st.session_state["selected_design_settings"] = {}
 
     st.markdown("---")
     design_text()
-    select_settings()
+    select_settings(num_classes=len(classes))
 
     def get_uploaded_setting(key, default, type_=None, options=None):
-        if (
-            "uploaded_design_settings" in st.session_state
-            and key in st.session_state["uploaded_design_settings"]
-        ):
-            out = st.session_state["uploaded_design_settings"][key]
-            if type_ is not None:
-                if not isinstance(out, type_):
-                    st.warning(
-                        f"An uploaded setting ({key}) had the wrong type. Using default value."
-                    )
-                    return default
-            if options is not None:
-                if out not in options:
-                    st.warning(
-                        f"An uploaded setting ({key}) was not a valid choice. Using default value."
-                    )
-                    return default
-            return out
-        return default
+        # The uploaded settings were validated once in `set_uploaded_settings()`
+        return st.session_state.get("uploaded_design_settings", {}).get(key, default)
 
     if st.session_state["design_reset_mode"]:
         if "form_placeholder" in st.session_state:
@@ -166,8 +189,8 @@ def design_section(
             with col1:
                 selected_classes = st.multiselect(
                     "Select classes (min=2, order is respected)",
-                    options=st.session_state["classes"],
-                    default=st.session_state["classes"],
+                    options=classes,
+                    default=classes,
                     help="Select the classes to create the confusion matrix for. "
                     "Any observation with either a target or prediction "
                     "of another class is excluded.",
@@ -833,14 +856,17 @@ def design_section(
 
             if st.form_submit_button(label="Generate plot"):
                 st.session_state["step"] = 3
-                if (
-                    not st.session_state["selected_design_settings"]["show_sums"]
-                    or st.session_state["selected_design_settings"]["sum_tile_palette"]
-                    != st.session_state["selected_design_settings"]["palette"]
-                ):
+                try:
+                    design_settings = DesignSettings.from_dict(
+                        st.session_state["selected_design_settings"]
+                    )
+                except DesignSettingsError:
+                    # Shown below
+                    pass
+                else:
                     # Save settings as json
                     with open(design_settings_store_path, "w") as f:
-                        json.dump(st.session_state["selected_design_settings"], f)
+                        f.write(design_settings.to_json())
                 if not st.session_state["selected_design_settings"][
                     "place_x_axis_above"
                 ]:
@@ -851,27 +877,11 @@ def design_section(
     design_ready = False
     if st.session_state["step"] >= 3:
         design_ready = True
-        if (
-            st.session_state["selected_design_settings"]["show_sums"]
-            and st.session_state["selected_design_settings"]["sum_tile_palette"]
-            == st.session_state["selected_design_settings"]["palette"]
-        ):
-            st.error(
-                "The color palettes (background colors) "
-                "for the tiles and sum tiles are identical. "
-                "Please select a different color palette for "
-                "the sum tiles under **Tiles** >> *Sum tile settings*."
-            )
-            design_ready = False
-        if (
-            st.session_state["selected_design_settings"]["set_intensity_lims"]
-            and not st.session_state["selected_design_settings"]["intensity_max"]
-            > st.session_state["selected_design_settings"]["intensity_min"]
-        ):
-            st.error(
-                "When specifying an intensity range, "
-                "the maximum value must be greater than the minimum value."
-            )
+        try:
+            DesignSettings.from_dict(st.session_state["selected_design_settings"])
+        except DesignSettingsError as e:
+            for error in e.errors:
+                st.error(error)
             design_ready = False
         if len(selected_classes) < 2:
             st.error("At least 2 classes must be selected.")
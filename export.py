@@ -0,0 +1,111 @@
+import io
+import pathlib
+import re
+import zipfile
+from typing import List
+
+# Available export formats
+# The background is `None` for the default (transparent) background
+EXPORT_FORMATS = {
+    "PNG (transparent)": {"extension": "png", "bg": None},
+    "PNG (white)": {"extension": "png", "bg": "white"},
+    "JPG (white)": {"extension": "jpg", "bg": "white"},
+    "TIFF (white)": {"extension": "tiff", "bg": "white"},
+    "SVG": {"extension": "svg", "bg": None},
+    "PDF": {"extension": "pdf", "bg": None},
+}
+
+VECTOR_EXTENSIONS = ["svg", "pdf"]
+
+# Size presets
+# Width, height and DPI are all multiplied by the scaling factor,
+# so the layout (relative size of elements) stays the same as designed
+EXPORT_PRESETS = {
+    "As designed": 1.0,
+    "Slides (0.5x)": 0.5,
+    "Paper (2x)": 2.0,
+    "Poster (4x)": 4.0,
+}
+
+# Scaling of width, height and DPI for fast previews
+# Keeps the layout while rendering far fewer pixels
+PREVIEW_SCALING = 0.5
+
+
+def _slugify(s: str) -> str:
+    return re.sub(r"[^0-9a-z]+", "_", s.lower()).strip("_")
+
+
+def build_exports(
+    out_dir,
+    formats: List[str],
+    presets: List[str],
+    design_settings: dict,
+    file_stem: str = "confusion_matrix",
+) -> List[dict]:
+    """
+    Create the list of exports for `plot.R` with a file per format and preset.
+    Vector formats (SVG, PDF) are only exported for the first preset,
+    as the scaling does not change them.
+    """
+    exports = []
+    exported_vector_formats = set()
+    for preset in presets:
+        scaling = EXPORT_PRESETS[preset]
+        for format_name in formats:
+            export_format = EXPORT_FORMATS[format_name]
+            if export_format["extension"] in VECTOR_EXTENSIONS:
+                if format_name in exported_vector_formats:
+                    continue
+                exported_vector_formats.add(format_name)
+            # E.g. "confusion_matrix_paper_2x_png_white.png"
+            name_parts = [file_stem, _slugify(preset)]
+            if _slugify(format_name) != export_format["extension"]:
+                name_parts.append(_slugify(format_name))
+            file_name = "_".join(name_parts) + f".{export_format['extension']}"
+            exports.append(
+                {
+                    "path": str(pathlib.Path(out_dir) / file_name),
+                    "width": round(design_settings["width"] * scaling),
+                    "height": round(design_settings["height"] * scaling),
+                    "dpi": round(design_settings["dpi"] * scaling),
+                    "bg": export_format["bg"],
+                }
+            )
+    return exports
+
+
+def build_preview_exports(
+    png_path, jpg_path, design_settings: dict, scaling: float = PREVIEW_SCALING
+) -> List[dict]:
+    """
+    Create the exports for a scaled-down render with the same outputs
+    as the default of `plot.R` (transparent png and white jpg).
+    """
+    size = {
+        "width": round(design_settings["width"] * scaling),
+        "height": round(design_settings["height"] * scaling),
+        "dpi": round(design_settings["dpi"] * scaling),
+    }
+    return [
+        {"path": str(png_path), **size, "bg": None},
+        {"path": str(jpg_path), **size, "bg": "white"},
+    ]
+
+
+def zip_files(paths: List[pathlib.Path]) -> bytes:
+    """
+    Zip files in memory.
+    Already compressed image formats are stored without compression.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for path in paths:
+            path = pathlib.Path(path)
+            compression = (
+                zipfile.ZIP_STORED
+                if path.suffix in [".png", ".jpg"]
+                else zipfile.ZIP_DEFLATED
+            )
+            zf.write(path, arcname=path.name, compress_type=compression)
+    return buffer.getvalue()
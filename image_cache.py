@@ -0,0 +1,120 @@
+import io
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from metrics import span
+
+# Approximate width of the main content column (px)
+CONTENT_WIDTH = 704
+
+# Preview widths are rounded to multiples of this
+# to limit the number of cached previews while zooming
+PREVIEW_WIDTH_STEP = 50
+
+
+def get_preview_width(col_size: float, side_col_size: float = 2.0) -> int:
+    """
+    Get the display width (px) of the image column, rounded to `PREVIEW_WIDTH_STEP`.
+    Twice the width is used for sharp previews on high-density screens.
+    """
+    width = 2 * CONTENT_WIDTH * col_size / (col_size + 2 * side_col_size)
+    return max(PREVIEW_WIDTH_STEP, int(round(width / PREVIEW_WIDTH_STEP)) * PREVIEW_WIDTH_STEP)
+
+
+class RenderedImage:
+    """
+    A rendered plot held in memory.
+    The png (for download) and jpg are read once. Previews and
+    greyscale versions are created on first use and then reused.
+    """
+
+    def __init__(self, png_bytes: bytes, jpg_bytes: bytes) -> None:
+        self.png_bytes = png_bytes
+        self.jpg_bytes = jpg_bytes
+        self._image = None
+        self._derived: Dict[Tuple[str, int], bytes] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_files(png_path, jpg_path) -> "RenderedImage":
+        with open(png_path, "rb") as f:
+            png_bytes = f.read()
+        with open(jpg_path, "rb") as f:
+            jpg_bytes = f.read()
+        return RenderedImage(png_bytes=png_bytes, jpg_bytes=jpg_bytes)
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            with span("decode_image"):
+                self._image = Image.open(io.BytesIO(self.jpg_bytes))
+                self._image.load()
+        return self._image
+
+    def _derive(self, kind: str, width: int) -> bytes:
+        with self._lock:
+            key = (kind, width)
+            if key not in self._derived:
+                image = self.image
+                with span("create_preview", kind=kind):
+                    if kind == "greyscale":
+                        image = image.convert("CMYK").convert("L")
+                    if width < image.width:
+                        height = round(image.height * width / image.width)
+                        image = image.resize((width, height), Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    image.save(buffer, format="WEBP", quality=90)
+                    self._derived[key] = buffer.getvalue()
+            return self._derived[key]
+
+    def preview(self, width: int) -> bytes:
+        """
+        WebP version of the plot with at most `width` pixels.
+        """
+        return self._derive("color", width)
+
+    def greyscale_preview(self, width: int) -> bytes:
+        """
+        Greyscale WebP version of the plot with at most `width` pixels.
+        For assessing colors in print.
+        """
+        return self._derive("greyscale", width)
+
+
+class ImageCache:
+    """
+    Process-wide cache of rendered images keyed by render hash.
+    The least recently used images are dropped when
+    more than `max_entries` are cached.
+    """
+
+    def __init__(self, max_entries: int = 32) -> None:
+        self.max_entries = max_entries
+        self.images: "OrderedDict[str, RenderedImage]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.images
+
+    def get(self, key: str) -> Optional[RenderedImage]:
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+            return image
+
+    def load(self, key: str, png_path, jpg_path) -> RenderedImage:
+        """
+        Read the rendered files into memory and cache them under `key`.
+        """
+        image = RenderedImage.from_files(png_path=png_path, jpg_path=jpg_path)
+        with self.lock:
+            self.images[key] = image
+            self.images.move_to_end(key)
+            while len(self.images) > self.max_entries:
+                self.images.popitem(last=False)
+        return image
@@ -0,0 +1,287 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Measure peak Python memory of each span with tracemalloc
+# Slows down allocations, so it is off by default
+TRACE_MEMORY = os.environ.get("METRICS_TRACE_MEMORY", "0") == "1"
+
+# Print a json line for each span
+# Off by default, as some stages run once per chunk of the data
+LOG_SPANS = os.environ.get("METRICS_LOG_SPANS", "0") == "1"
+
+# Histogram buckets (seconds)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+if TRACE_MEMORY and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+
+def get_rss_mb() -> Optional[float]:
+    """
+    Resident memory of this process in MB.
+    Only available on Linux (reads `/proc`).
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_max_rss_mb() -> Optional[float]:
+    """
+    Highest resident memory of this process so far in MB.
+    """
+    if resource is None:
+        return None
+    # Kilobytes on Linux
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # The kernel updates the high-water mark lazily
+    rss_mb = get_rss_mb()
+    return max_rss_mb if rss_mb is None else max(max_rss_mb, rss_mb)
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS) -> None:
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.bucket_counts[i] += 1
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in labels
+        )
+        + "}"
+    )
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms that can be
+    exported in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.gauges: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self.help: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels: Optional[dict]) -> tuple:
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, value: float = 1, labels=None, help="") -> None:
+        with self.lock:
+            self.help.setdefault(name, help)
+            series = self.counters.setdefault(name, {})
+            key = self._key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, labels=None, help="") -> None:
+        with self.lock:
+            self.help.setdefault(name, help)
+            self.gauges.setdefault(name, {})[self._key(labels)] = value
+
+    def observe(self, name: str, value: float, labels=None, help="") -> None:
+        with self.lock:
+            self.help.setdefault(name, help)
+            series = self.histograms.setdefault(name, {})
+            key = self._key(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self.lock:
+            for kind, metrics in [("counter", self.counters), ("gauge", self.gauges)]:
+                for name, series in sorted(metrics.items()):
+                    lines.append(f"# HELP {name} {self.help.get(name, '')}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in sorted(series.items()):
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# HELP {name} {self.help.get(name, '')}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, hist in sorted(series.items()):
+                    for upper, count in zip(hist.buckets, hist.bucket_counts):
+                        bucket_labels = labels + (("le", upper),)
+                        lines.append(
+                            f"{name}_bucket{_format_labels(bucket_labels)} {count}"
+                        )
+                    inf_labels = labels + (("le", "+Inf"),)
+                    lines.append(f"{name}_bucket{_format_labels(inf_labels)} {hist.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {hist.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry
+registry = MetricsRegistry()
+
+# Spans of the current request (e.g. a script run)
+_current_trace: contextvars.ContextVar = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+def start_trace() -> List[dict]:
+    """
+    Start collecting the spans of a request (in this thread/context).
+    Returns the list the spans are added to.
+    """
+    trace = []
+    _current_trace.set(trace)
+    return trace
+
+
+def record_span(
+    stage: str, wall_seconds: float, cpu_seconds: float, **extra
+) -> dict:
+    """
+    Record a measured stage (e.g. reported by the R process).
+    """
+    record = {
+        "stage": stage,
+        "wall_seconds": round(wall_seconds, 6),
+        "cpu_seconds": round(cpu_seconds, 6),
+        **extra,
+    }
+    registry.observe(
+        "stage_wall_seconds",
+        wall_seconds,
+        labels={"stage": stage},
+        help="Wall time of pipeline stages.",
+    )
+    registry.observe(
+        "stage_cpu_seconds",
+        cpu_seconds,
+        labels={"stage": stage},
+        help="CPU time of pipeline stages.",
+    )
+    if record.get("error") is not None:
+        registry.inc(
+            "stage_errors_total",
+            labels={"stage": stage},
+            help="Number of failed pipeline stages.",
+        )
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append(record)
+    if LOG_SPANS:
+        print(json.dumps({"event": "span", **record}))
+    return record
+
+
+@contextlib.contextmanager
+def span(stage: str, **labels):
+    """
+    Measure wall time, CPU time (of this thread) and memory of a stage.
+
+    The memory is the current resident memory when the stage ends (`rss_mb`)
+    and the highest resident memory of the process so far (`max_rss_mb`).
+    Neither is the peak of the stage itself. The peak Python memory of
+    the stage is measured when `METRICS_TRACE_MEMORY=1`.
+    The tracemalloc peak is process-wide, so concurrent stages
+    in other threads are included.
+    """
+    if TRACE_MEMORY:
+        tracemalloc.reset_peak()
+        traced_start, _ = tracemalloc.get_traced_memory()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        extra = {**labels, "rss_mb": get_rss_mb(), "max_rss_mb": get_max_rss_mb()}
+        if TRACE_MEMORY:
+            _, traced_peak = tracemalloc.get_traced_memory()
+            extra["peak_traced_mb"] = round(
+                max(traced_peak - traced_start, 0) / 1024**2, 3
+            )
+        if error is not None:
+            extra["error"] = error
+        record_span(
+            stage,
+            wall_seconds=time.perf_counter() - wall_start,
+            cpu_seconds=time.thread_time() - cpu_start,
+            **extra,
+        )
+
+
+def set_gauges(prefix: str, stats: dict, help: str = "") -> None:
+    """
+    Set a gauge for each numeric value in a stats dict
+    (e.g. from the render cache or scheduler).
+    """
+    for name, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            registry.set(f"{prefix}_{name}", value, help=help)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        for collect in self.server.collectors:
+            collect()
+        body = registry.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't log every scrape
+        pass
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1", collectors=()):
+    """
+    Serve the metrics at `http://<host>:<port>/metrics` in a background thread.
+    `collectors` are called before each scrape to update gauges.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.collectors = list(collectors)
+    thread = threading.Thread(
+        target=server.serve_forever, daemon=True, name="metrics-server"
+    )
+    thread.start()
+    return server
@@ -0,0 +1,827 @@
+import json
+import math
+import pathlib
+import re
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from aggregation import get_class_codes, select_classes
+from data import get_file_type, read_data
+from metrics import span
+from settings import DesignSettings, DesignSettingsError
+from utils import PlotRenderCancelledError, PlotRenderError
+
+# Engines for rendering the plots
+# "python" renders in-process with matplotlib and falls back to R
+# for the jobs it does not support (see `get_unsupported_features()`)
+PLOT_ENGINES = ["r", "python"]
+
+# ColorBrewer palettes with 7 colors, as interpolated by
+# `ggplot2::scale_fill_distiller()` in `cvms::plot_confusion_matrix()`
+BREWER_PALETTES = {
+    "Blues": ["#EFF3FF", "#C6DBEF", "#9ECAE1", "#6BAED6", "#4292C6", "#2171B5", "#084594"],
+    "Greens": ["#EDF8E9", "#C7E9C0", "#A1D99B", "#74C476", "#41AB5D", "#238B45", "#005A32"],
+    "Oranges": ["#FEEDDE", "#FDD0A2", "#FDAE6B", "#FD8D3C", "#F16913", "#D94801", "#8C2D04"],
+    "Greys": ["#F7F7F7", "#D9D9D9", "#BDBDBD", "#969696", "#737373", "#525252", "#252525"],
+    "Purples": ["#F2F0F7", "#DADAEB", "#BCBDDC", "#9E9AC8", "#807DBA", "#6A51A3", "#4A1486"],
+    "Reds": ["#FEE5D9", "#FCBBA1", "#FC9272", "#FB6A4A", "#EF3B2C", "#CB181D", "#99000D"],
+}
+
+# Colors of the total tile and of tiles beyond the intensity limits
+TOTAL_TILE_COLOR = "#F2F2F2"
+BEYOND_LIMS_COLOR = "#BEBEBE"
+ZERO_SHADING_COLOR = "#C8C8C8"
+
+# ggplot2 font sizes are in mm and line widths in multiples of 0.75 pt
+MM_TO_PT = 72.27 / 25.4
+LINE_WIDTH_TO_PT = MM_TO_PT * 72 / 96
+
+# ggplot2 linetypes as matplotlib dash patterns
+LINETYPES = {
+    "solid": "solid",
+    "dashed": (0, (4, 4)),
+    "dotted": (0, (1, 3)),
+    "dotdash": (0, (1, 3, 4, 3)),
+    "longdash": (0, (8, 4)),
+    "twodash": (0, (2, 2, 6, 2)),
+}
+
+# Text positions relative to the tile center (in tiles)
+BOTTOM_TEXT_NUDGE = 0.16
+ROW_PERCENTAGE_NUDGE = 0.41
+COL_PERCENTAGE_NUDGE = 0.39
+
+# Arrows next to the row/column percentages (like the carets of cvms)
+# The width is relative to `arrow_size` times the height of the tiles
+ARROW_WIDTH = 0.375
+ARROW_HEIGHT_RATIO = 0.55
+ARROW_COLOR = "#000000"
+
+# 3D effect (darker tile edges)
+# The edges are darkened up to `EFFECT_3D_ALPHA` over a band of
+# `EFFECT_3D_WIDTH` tiles per amount of effect
+EFFECT_3D_ALPHA = 0.2
+EFFECT_3D_WIDTH = 0.01
+EFFECT_3D_RESOLUTION = 128
+
+# Theme (like `ggplot2::theme_minimal()` with an 11pt base size)
+AXIS_TEXT_COLOR = "#4D4D4D"
+AXIS_TEXT_SIZE = 8.8
+AXIS_TITLE_SIZE = 11
+TITLE_SIZE = 13.2
+CAPTION_SIZE = 8.8
+
+
+def get_unsupported_features(job: dict, design_settings: dict) -> List[str]:
+    """
+    Get the requested features that only the R engine can render.
+    """
+    features = []
+    if not job.get("data_are_counts"):
+        features.append("predictions (not counts)")
+    return features
+
+
+def _read_design_settings(path) -> dict:
+    try:
+        return DesignSettings.load(path).to_dict()
+    except DesignSettingsError as e:
+        raise PlotRenderError(f"Invalid design settings in {path}\n\n{e}") from e
+    except (OSError, ValueError) as e:
+        raise PlotRenderError(
+            f"Failed to read design settings as a json file {path}\n\n{e}"
+        ) from e
+
+
+def resolve_engine(job: dict, design_settings: Optional[dict] = None) -> str:
+    """
+    Get the engine ("r" or "python") that renders a job.
+    Jobs for the Python engine (`job["engine"] == "python"`) are
+    rendered with R when they use features that only R supports.
+    """
+    if job.get("engine", "r") != "python":
+        return "r"
+    if design_settings is None:
+        design_settings = _read_design_settings(job["settings_path"])
+    if get_unsupported_features(job, design_settings):
+        return "r"
+    return "python"
+
+
+def render_with_engine(
+    job: dict, worker_pool, timeout=None, cancel_event=None
+) -> str:
+    """
+    Render a job with the engine in `job["engine"]` (R by default).
+    R jobs are sent to the plotting workers in `worker_pool`.
+    Returns the output of the engine.
+    """
+    job = dict(job)
+    if job.pop("engine", "r") == "python":
+        unsupported = get_unsupported_features(
+            job, _read_design_settings(job["settings_path"])
+        )
+        if not unsupported:
+            return render_job(job, cancel_event=cancel_event)
+        print(
+            "Rendering with R, as the Python engine does not support: "
+            + ", ".join(unsupported)
+        )
+    return worker_pool.render(job, timeout=timeout, cancel_event=cancel_event)
+
+
+def _import_matplotlib():
+    try:
+        import matplotlib.backends.backend_pdf
+        import matplotlib.colors
+        import matplotlib.figure
+        import matplotlib.patches
+    except ImportError as e:
+        raise ImportError(
+            "Rendering with the Python engine requires the `matplotlib` package."
+        ) from e
+    return matplotlib
+
+
+def _get_colormap(colors: List[str]):
+    return _import_matplotlib().colors.LinearSegmentedColormap.from_list(
+        "palette", colors
+    )
+
+
+def _get_palette_colors(design_settings: dict, prefix: str) -> List[str]:
+    """
+    Get the gradient colors for the tiles (`prefix="palette"`)
+    or sum tiles (`prefix="sum_tile_palette"`).
+    """
+    if design_settings.get(f"{prefix}_use_custom"):
+        return [
+            design_settings[f"{prefix}_custom_low"],
+            design_settings[f"{prefix}_custom_high"],
+        ]
+    return BREWER_PALETTES[design_settings[prefix]]
+
+
+def get_intensities(counts: np.ndarray, intensity_by: str) -> np.ndarray:
+    """
+    Get the values that decide the color intensity of the tiles.
+    The log of a zero count is set to 0.
+    """
+    counts = np.asarray(counts, dtype=float)
+    intensity_by = intensity_by.lower()
+    if "normalized" in intensity_by:
+        total = counts.sum()
+        return counts / total * 100 if total > 0 else np.zeros_like(counts)
+    log_fns = {
+        "log counts": np.log,
+        "log2 counts": np.log2,
+        "log10 counts": np.log10,
+    }
+    if intensity_by in log_fns:
+        return np.where(
+            counts > 0, log_fns[intensity_by](np.where(counts > 0, counts, 1)), 0
+        )
+    if intensity_by == "arcsinh counts":
+        return np.arcsinh(counts)
+    return counts
+
+
+def get_tile_colors(
+    intensities: np.ndarray,
+    colors: List[str],
+    darkness: float,
+    lims: Optional[tuple] = None,
+    beyond_lims: str = "truncate",
+) -> np.ndarray:
+    """
+    Map intensities to RGBA colors.
+
+    Like cvms, the upper limit of the color scale is extended based on
+    `darkness`, so the most intense tile does not get the darkest color.
+    """
+    if lims is None:
+        lims = (intensities.min(), intensities.max())
+    low, high = lims
+    upper = high + 10 * (1 - darkness) * (high / 5)
+    if upper > low:
+        scaled = (intensities - low) / (upper - low)
+    else:
+        scaled = np.zeros_like(intensities, dtype=float)
+    tile_colors = _get_colormap(colors)(np.clip(scaled, 0, 1))
+    if beyond_lims == "grey":
+        tile_colors[
+            (intensities < low) | (intensities > high)
+        ] = _import_matplotlib().colors.to_rgba(BEYOND_LIMS_COLOR)
+    return tile_colors
+
+
+def get_shared_intensity_lims(
+    matrices: np.ndarray, intensity_by: str
+) -> Tuple[float, float]:
+    """
+    Get the range of the tile intensities of all the confusion matrices,
+    so the facets share one color scale.
+    """
+    intensities = [get_intensities(matrix, intensity_by) for matrix in matrices]
+    return (
+        float(min(x.min() for x in intensities)),
+        float(max(x.max() for x in intensities)),
+    )
+
+
+def get_3d_effect_overlay(num_tiles: int, amount: int) -> np.ndarray:
+    """
+    Get an RGBA image (for all the tiles) that darkens the tile edges.
+    """
+    positions = (np.arange(num_tiles * EFFECT_3D_RESOLUTION) + 0.5) / EFFECT_3D_RESOLUTION
+    edge_distances = np.minimum(positions % 1, 1 - positions % 1)
+    distances = np.minimum.outer(edge_distances, edge_distances)
+    overlay = np.zeros(distances.shape + (4,), dtype=np.float32)
+    overlay[..., 3] = EFFECT_3D_ALPHA * np.clip(
+        1 - distances / (EFFECT_3D_WIDTH * amount), 0, 1
+    )
+    return overlay
+
+
+def get_arrow_vertices(
+    x: float, y: float, direction: str, width: float
+) -> np.ndarray:
+    """
+    Get the vertices of a triangle centered at (`x`, `y`) that points
+    "up", "down", "left" or "right" (with the y-axis pointing down).
+    """
+    half_width = width / 2
+    half_height = width * ARROW_HEIGHT_RATIO / 2
+    # Pointing down
+    vertices = np.array(
+        [[-half_width, -half_height], [half_width, -half_height], [0, half_height]]
+    )
+    if direction == "up":
+        vertices[:, 1] *= -1
+    elif direction in ("left", "right"):
+        vertices = vertices[:, ::-1]
+        if direction == "left":
+            vertices[:, 0] *= -1
+    return vertices + [x, y]
+
+
+def get_facet_grid(num_facets: int) -> Tuple[int, int]:
+    """
+    Get the number of rows and columns of the grid of facets.
+    Same as `get_facet_grid()` in `plot_functions.R`.
+    """
+    num_cols = math.ceil(math.sqrt(num_facets))
+    return math.ceil(num_facets / num_cols), num_cols
+
+
+def get_facet_title(title_label: str, group_col: str, group: str) -> str:
+    """
+    Same as `get_facet_title()` in `plot_functions.R`.
+    """
+    facet_label = f"{group_col}: {group}"
+    if title_label:
+        return f"{title_label} ({facet_label})"
+    return facet_label
+
+
+def format_number(x: float, digits: int) -> str:
+    """
+    Round and format a number without trailing zeros (like R's `as.character()`).
+    """
+    return np.format_float_positional(round(float(x), digits), trim="-")
+
+
+def _font(design_settings: dict, name: str) -> dict:
+    """
+    Get matplotlib text properties for a font in the design settings
+    (`name` is "top", "bottom" or "percentage").
+    """
+    return {
+        "fontsize": design_settings[f"font_{name}_size"] * MM_TO_PT,
+        "color": design_settings[f"font_{name}_color"],
+        "alpha": design_settings[f"font_{name}_alpha"],
+        "fontweight": "bold" if design_settings[f"font_{name}_bold"] else "normal",
+        "fontstyle": "italic" if design_settings[f"font_{name}_italic"] else "normal",
+    }
+
+
+def _percentage(n: float, total: float) -> Optional[float]:
+    return n / total * 100 if total > 0 else None
+
+
+def _add_affixes(design_settings: dict, name: str, text: str) -> str:
+    """
+    Add the prefix and suffix of a font (e.g. "%" for `name="percentage"`).
+    """
+    return (
+        f"{design_settings[f'font_{name}_prefix']}{text}"
+        f"{design_settings[f'font_{name}_suffix']}"
+    )
+
+
+def plot_confusion_matrix(
+    matrix: np.ndarray,
+    classes: List[str],
+    design_settings: dict,
+    sub_texts: Optional[np.ndarray] = None,
+    intensity_lims: Optional[tuple] = None,
+    title: Optional[str] = None,
+    fig=None,
+):
+    """
+    Plot a confusion matrix like `cvms::plot_confusion_matrix()`.
+
+    `matrix` has the targets in the rows and predictions in the columns.
+    In the plot, the targets are on the x-axis and the predictions on the
+    y-axis (first class at the top). `sub_texts` (same shape as `matrix`)
+    replace the bottom texts of the tiles.
+    `intensity_lims` are used when the design does not set the intensity range
+    (e.g. shared by facets). `title` replaces the title of the design.
+    Draws in `fig` (e.g. a subfigure of a grid) when given.
+    Returns a matplotlib figure at the design size.
+    """
+    mpl = _import_matplotlib()
+    ds = design_settings
+    num_classes = len(classes)
+    # Predictions in the rows, targets in the columns
+    grid = np.asarray(matrix, dtype=float).T
+    total = grid.sum()
+    prediction_sums = grid.sum(axis=1)
+    target_sums = grid.sum(axis=0)
+    digits = int(ds["num_digits"])
+    show_sums = bool(ds["show_sums"])
+    num_tiles = num_classes + int(show_sums)
+
+    # Tile colors
+    lims = (
+        (ds["intensity_min"], ds["intensity_max"])
+        if ds["set_intensity_lims"]
+        else intensity_lims
+    )
+    rgba = np.ones((num_tiles, num_tiles, 4))
+    rgba[:num_classes, :num_classes] = get_tile_colors(
+        get_intensities(grid, ds["intensity_by"]),
+        colors=_get_palette_colors(ds, "palette"),
+        darkness=ds["darkness"],
+        lims=lims,
+        beyond_lims=ds["intensity_beyond_lims"],
+    )
+    if show_sums:
+        sum_intensities = get_intensities(
+            np.concatenate([prediction_sums, target_sums]), ds["intensity_by"]
+        )
+        sum_colors = get_tile_colors(
+            sum_intensities,
+            colors=_get_palette_colors(ds, "sum_tile_palette"),
+            darkness=ds["darkness"],
+        )
+        rgba[:num_classes, num_classes] = sum_colors[:num_classes]
+        rgba[num_classes, :num_classes] = sum_colors[num_classes:]
+        rgba[num_classes, num_classes] = mpl.colors.to_rgba(TOTAL_TILE_COLOR)
+
+    if fig is None:
+        fig = mpl.figure.Figure(
+            figsize=(ds["width"] / ds["dpi"], ds["height"] / ds["dpi"]),
+            dpi=ds["dpi"],
+            layout="constrained",
+        )
+    fig.patch.set_alpha(0)
+    ax = fig.add_subplot()
+    ax.patch.set_alpha(0)
+    ax.imshow(
+        rgba,
+        aspect="auto",
+        interpolation="nearest",
+        extent=(-0.5, num_tiles - 0.5, num_tiles - 0.5, -0.5),
+    )
+    if ds["amount_3d_effect"] > 0:
+        ax.imshow(
+            get_3d_effect_overlay(num_tiles, amount=int(ds["amount_3d_effect"])),
+            aspect="auto",
+            interpolation="bilinear",
+            extent=(-0.5, num_tiles - 0.5, num_tiles - 0.5, -0.5),
+        )
+
+    # Zero shading
+    if ds["show_zero_shading"]:
+        for row, col in zip(*np.nonzero(grid == 0)):
+            ax.add_patch(
+                mpl.patches.Rectangle(
+                    (col - 0.5, row - 0.5),
+                    1,
+                    1,
+                    fill=False,
+                    hatch="/",
+                    hatch_linewidth=0.5,
+                    edgecolor=ZERO_SHADING_COLOR,
+                    linewidth=0,
+                )
+            )
+
+    # Tile borders
+    if ds["show_tile_border"]:
+        border_kwargs = {
+            "colors": ds["tile_border_color"],
+            "linewidths": ds["tile_border_size"] * LINE_WIDTH_TO_PT,
+            "linestyles": LINETYPES.get(ds["tile_border_linetype"], "solid"),
+        }
+        edges = np.arange(num_tiles + 1) - 0.5
+        ax.hlines(edges, -0.5, num_tiles - 0.5, **border_kwargs)
+        ax.vlines(edges, -0.5, num_tiles - 0.5, **border_kwargs)
+
+    # Which texts go on top
+    counts_on_top = ds["counts_on_top"] or not ds["show_normalized"]
+    counts_font = _font(ds, "top" if counts_on_top else "bottom")
+    normalized_font = _font(ds, "bottom" if counts_on_top else "top")
+    percentage_font = _font(ds, "percentage")
+
+    def tile_texts(row, col, n, n_total):
+        counts_text = None
+        normalized_text = None
+        if ds["show_counts"]:
+            counts_text = _add_affixes(ds, "counts", format_number(n, 0))
+        if ds["show_normalized"]:
+            normalized = _percentage(n, n_total) or 0
+            normalized_text = _add_affixes(
+                ds, "normalized", format_number(normalized, digits)
+            )
+        if counts_on_top:
+            top = (counts_text, counts_font)
+            bottom = (normalized_text, normalized_font)
+        else:
+            top = (normalized_text, normalized_font)
+            bottom = (counts_text, counts_font)
+        if sub_texts is not None and row < num_classes and col < num_classes:
+            sub_text = sub_texts[col, row]
+            if sub_text:
+                bottom = (sub_text, bottom[1])
+        if top[0] is None:
+            top, bottom = bottom, (None, None)
+        if top[0] is not None:
+            ax.text(col, row, top[0], ha="center", va="center", **top[1])
+        if bottom[0] is not None:
+            ax.text(
+                col,
+                row + BOTTOM_TEXT_NUDGE,
+                bottom[0],
+                ha="center",
+                va="center",
+                **bottom[1],
+            )
+
+    # The arrows point towards the other tiles of the row/column
+    arrow_width = ARROW_WIDTH * ds["arrow_size"] * num_tiles
+    arrow_nudge = ds["arrow_nudge_from_text"]
+
+    def add_arrow(x, y, direction):
+        ax.add_patch(
+            mpl.patches.Polygon(
+                get_arrow_vertices(x, y, direction=direction, width=arrow_width),
+                closed=True,
+                facecolor=ARROW_COLOR,
+                linewidth=0,
+            )
+        )
+
+    for row in range(num_classes):
+        for col in range(num_classes):
+            n = grid[row, col]
+            if n > 0 or ds["show_zero_text"]:
+                tile_texts(row, col, n, total)
+            if (n == 0 and not ds["show_zero_percentages"]) or (
+                ds["diag_percentages_only"] and row != col
+            ):
+                continue
+            if ds["show_row_percentages"]:
+                row_percentage = _percentage(n, prediction_sums[row])
+                if row_percentage is not None:
+                    ax.text(
+                        col + ROW_PERCENTAGE_NUDGE,
+                        row,
+                        _add_affixes(
+                            ds, "percentage", format_number(row_percentage, digits)
+                        ),
+                        ha="center",
+                        va="center",
+                        rotation=90,
+                        **percentage_font,
+                    )
+                    if ds["show_arrows"]:
+                        x = col + ROW_PERCENTAGE_NUDGE
+                        if col > 0:
+                            add_arrow(x - arrow_nudge, row, "left")
+                        if col < num_classes - 1:
+                            add_arrow(x + arrow_nudge, row, "right")
+            if ds["show_col_percentages"]:
+                col_percentage = _percentage(n, target_sums[col])
+                if col_percentage is not None:
+                    ax.text(
+                        col,
+                        row + COL_PERCENTAGE_NUDGE,
+                        _add_affixes(
+                            ds, "percentage", format_number(col_percentage, digits)
+                        ),
+                        ha="center",
+                        va="center",
+                        **percentage_font,
+                    )
+                    if ds["show_arrows"]:
+                        y = row + COL_PERCENTAGE_NUDGE
+                        if row > 0:
+                            add_arrow(col, y - arrow_nudge, "up")
+                        if row < num_classes - 1:
+                            add_arrow(col, y + arrow_nudge, "down")
+
+    if show_sums:
+        for i in range(num_classes):
+            tile_texts(i, num_classes, prediction_sums[i], total)
+            tile_texts(num_classes, i, target_sums[i], total)
+        ax.text(
+            num_classes,
+            num_classes,
+            format_number(total, 0),
+            ha="center",
+            va="center",
+            **_font(ds, "top"),
+        )
+
+    # Axes
+    tick_labels = list(classes) + ([ds["sum_tile_label"]] if show_sums else [])
+    ax.set_xlim(-0.5, num_tiles - 0.5)
+    ax.set_ylim(num_tiles - 0.5, -0.5)
+    ax.set_xticks(range(num_tiles), tick_labels)
+    ax.set_yticks(
+        range(num_tiles),
+        tick_labels,
+        rotation=90 if ds["rotate_y_text"] else 0,
+        va="center",
+    )
+    ax.tick_params(
+        length=0, labelsize=AXIS_TEXT_SIZE, labelcolor=AXIS_TEXT_COLOR
+    )
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    if ds["place_x_axis_above"]:
+        ax.xaxis.tick_top()
+        ax.xaxis.set_label_position("top")
+    ax.set_xlabel(ds["x_label"], fontsize=AXIS_TITLE_SIZE)
+    ax.set_ylabel(ds["y_label"], fontsize=AXIS_TITLE_SIZE)
+    if title is None:
+        title = ds["title_label"]
+    if title:
+        ax.set_title(title, loc="left", fontsize=TITLE_SIZE)
+    if ds["caption_label"]:
+        fig.supxlabel(ds["caption_label"], x=1, ha="right", fontsize=CAPTION_SIZE)
+    return fig
+
+
+def plot_facets(
+    facets: List[tuple],
+    classes: List[str],
+    design_settings: dict,
+    group_col: str,
+    intensity_lims: Optional[tuple] = None,
+):
+    """
+    Plot the confusion matrices of multiple groups in a grid.
+    `facets` are (group, matrix, sub texts) tuples.
+    Each facet has the design size.
+    """
+    mpl = _import_matplotlib()
+    ds = design_settings
+    num_rows, num_cols = get_facet_grid(len(facets))
+    fig = mpl.figure.Figure(
+        figsize=(
+            num_cols * ds["width"] / ds["dpi"],
+            num_rows * ds["height"] / ds["dpi"],
+        ),
+        dpi=ds["dpi"],
+        layout="constrained",
+    )
+    fig.patch.set_alpha(0)
+    subfigs = fig.subfigures(num_rows, num_cols, squeeze=False).ravel()
+    for subfig, (group, matrix, sub_texts) in zip(subfigs, facets):
+        plot_confusion_matrix(
+            matrix,
+            classes=classes,
+            design_settings=ds,
+            sub_texts=sub_texts,
+            intensity_lims=intensity_lims,
+            title=get_facet_title(ds["title_label"], group_col, group),
+            fig=subfig,
+        )
+    return fig
+
+
+def save_plot_exports(fig, exports: List[dict], cancel_event=None) -> None:
+    """
+    Save a figure to multiple files.
+    `exports` have the same keys as for `plot.R`:
+        path, width (px), height (px), dpi and optionally bg (`None` for transparent)
+    """
+    for export in exports:
+        if cancel_event is not None and cancel_event.is_set():
+            raise PlotRenderCancelledError("Render was cancelled.")
+        extension = get_file_type(export["path"])
+        bg = export.get("bg")
+        if bg is None and extension in ["jpg", "jpeg"]:
+            # No transparency in jpg files
+            bg = "white"
+        fig.set_size_inches(
+            export["width"] / export["dpi"], export["height"] / export["dpi"]
+        )
+        try:
+            fig.savefig(
+                export["path"],
+                dpi=export["dpi"],
+                facecolor="none" if bg is None else bg,
+            )
+        except (OSError, ValueError) as e:
+            raise PlotRenderError(
+                f"{extension}: Failed to save plot to: {export['path']}\n\n{e}"
+            ) from e
+
+
+def save_pdf_pages(figs: list, export: dict, cancel_event=None) -> None:
+    """
+    Save figures as the pages of a single pdf file.
+    `export` has the same keys as in `save_plot_exports()`.
+    """
+    mpl = _import_matplotlib()
+    bg = export.get("bg")
+    try:
+        with mpl.backends.backend_pdf.PdfPages(export["path"]) as pdf:
+            for fig in figs:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise PlotRenderCancelledError("Render was cancelled.")
+                fig.set_size_inches(
+                    export["width"] / export["dpi"], export["height"] / export["dpi"]
+                )
+                pdf.savefig(fig, facecolor="none" if bg is None else bg)
+    except (OSError, ValueError) as e:
+        raise PlotRenderError(
+            f"pdf: Failed to save plot to: {export['path']}\n\n{e}"
+        ) from e
+
+
+def get_default_exports(out_path: str, design_settings: dict) -> List[dict]:
+    """
+    The png (transparent background) and jpg (white background)
+    at the design size. Same as `default_exports()` in `plot_functions.R`.
+    """
+    size = {
+        "width": design_settings["width"],
+        "height": design_settings["height"],
+        "dpi": design_settings["dpi"],
+    }
+    return [
+        {"path": out_path, **size, "bg": None},
+        {"path": str(pathlib.Path(out_path).with_suffix(".jpg")), **size, "bg": "white"},
+    ]
+
+
+def render_job(job: dict, cancel_event: Optional[threading.Event] = None) -> str:
+    """
+    Render a counts job in-process with matplotlib.
+    A job has the same keys as the arguments of `plot.R`.
+    Raises `PlotRenderError` with the same messages as the R engine.
+    """
+    design_settings = _read_design_settings(job["settings_path"])
+
+    target_col = job["target_col"]
+    prediction_col = job["prediction_col"]
+    n_col = job["n_col"]
+    sub_col = job.get("sub_col")
+    group_col = job.get("group_col")
+    try:
+        with span("py_read_data"):
+            df = read_data(
+                job["data_path"],
+                columns=[
+                    col
+                    for col in [target_col, prediction_col, n_col, sub_col, group_col]
+                    if col is not None
+                ],
+            )
+    except (OSError, ValueError) as e:
+        raise PlotRenderError(f"Failed to read data from {job['data_path']}\n\n{e}") from e
+
+    targets = df[target_col].astype(str)
+    predictions = df[prediction_col].astype(str)
+    all_present_classes = sorted(set(targets.unique()).union(predictions.unique()))
+    if job.get("classes"):
+        classes = re.split(r"[,:]", job["classes"])
+        if set(classes).difference(all_present_classes):
+            raise PlotRenderError(
+                "Failed to create plot from confusion matrix.\n\n"
+                "One or more specified classes are not in the data set."
+            )
+    else:
+        classes = all_present_classes
+
+    counts = pd.DataFrame({"Target": targets, "Prediction": predictions, "N": df[n_col]})
+
+    def get_sub_texts(rows):
+        if sub_col is None:
+            return None
+        target_codes = get_class_codes(targets[rows], classes)
+        prediction_codes = get_class_codes(predictions[rows], classes)
+        keep = (target_codes >= 0) & (prediction_codes >= 0)
+        sub_texts = np.full((len(classes), len(classes)), "", dtype=object)
+        sub_texts[target_codes[keep], prediction_codes[keep]] = (
+            df[sub_col][rows].fillna("").astype(str).to_numpy()[keep]
+        )
+        return sub_texts
+
+    # A facet per group (in the order of the data)
+    if group_col is None:
+        facet_rows = {None: np.ones(len(df), dtype=bool)}
+    else:
+        groups = df[group_col].astype(str)
+        facet_rows = {
+            group: (groups == group).to_numpy() for group in pd.unique(groups)
+        }
+    facets = [
+        (group, select_classes(counts[rows], classes=classes), get_sub_texts(rows))
+        for group, rows in facet_rows.items()
+    ]
+
+    intensity_lims = job.get("intensity_lims")
+    if intensity_lims is not None:
+        intensity_lims = tuple(intensity_lims)
+
+    exports = job.get("exports")
+    if job.get("exports_path") is not None:
+        with open(job["exports_path"], "r") as f:
+            exports = json.load(f)
+    if exports is None:
+        exports = get_default_exports(job["out_path"], design_settings)
+
+    # With `facet_pages`, pdf files get a page per group
+    # Other files get a grid of the groups
+    page_exports = []
+    if group_col is not None and job.get("facet_pages"):
+        page_exports = [e for e in exports if get_file_type(e["path"]) == "pdf"]
+    exports = [e for e in exports if e not in page_exports]
+
+    try:
+        with span(
+            "py_plot_confusion_matrix",
+            num_classes=len(classes),
+            num_facets=len(facets),
+        ):
+            if group_col is None:
+                group, matrix, sub_texts = facets[0]
+                fig = plot_confusion_matrix(
+                    matrix,
+                    classes=classes,
+                    design_settings=design_settings,
+                    sub_texts=sub_texts,
+                    intensity_lims=intensity_lims,
+                )
+            elif exports:
+                fig = plot_facets(
+                    facets,
+                    classes=classes,
+                    design_settings=design_settings,
+                    group_col=group_col,
+                    intensity_lims=intensity_lims,
+                )
+                num_rows, num_cols = get_facet_grid(len(facets))
+                # The export sizes are per facet
+                exports = [
+                    {
+                        **export,
+                        "width": export["width"] * num_cols,
+                        "height": export["height"] * num_rows,
+                    }
+                    for export in exports
+                ]
+            if page_exports:
+                pages = [
+                    plot_confusion_matrix(
+                        matrix,
+                        classes=classes,
+                        design_settings=design_settings,
+                        sub_texts=sub_texts,
+                        intensity_lims=intensity_lims,
+                        title=get_facet_title(
+                            design_settings["title_label"], group_col, group
+                        ),
+                    )
+                    for group, matrix, sub_texts in facets
+                ]
+    except (KeyError, TypeError, ValueError) as e:
+        raise PlotRenderError(
+            f"Failed to create plot from confusion matrix.\n\n{type(e).__name__}: {e}"
+        ) from e
+
+    with span("py_savefig", num_exports=len(exports) + len(page_exports)):
+        if exports:
+            save_plot_exports(fig, exports, cancel_event=cancel_event)
+        for export in page_exports:
+            save_pdf_pages(pages, export, cancel_event=cancel_event)
+    return ""
@@ -0,0 +1,279 @@
+import atexit
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+
+def hash_file(path, hasher=None, chunk_size: int = 1 << 20):
+    """
+    Update (or create) a sha256 hasher with the bytes of a file.
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def canonical_json(data) -> str:
+    """
+    Serialize to json with sorted keys and no whitespace,
+    so equal settings give equal strings.
+    """
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def make_render_key(
+    data_path,
+    design_settings,
+    classes: List[str],
+    columns: Dict[str, Optional[str]],
+    version: str,
+    extra: Optional[dict] = None,
+    engine: str = "r",
+) -> str:
+    """
+    Create a content-addressed key for a render.
+
+    `design_settings` can be the settings or their digest
+    (see `DesignSettings.digest()`).
+    `columns` are the target/prediction/n/sub columns and
+    `version` should identify the plotting code (e.g. hash of
+    the R scripts and the cvms version). `extra` can hold other
+    inputs that change the output (e.g. export settings).
+    `engine` is the engine that renders the plot ("r" or "python").
+    """
+    hasher = hash_file(data_path)
+    hasher.update(
+        canonical_json(
+            {
+                "settings": design_settings,
+                "classes": list(classes),
+                "columns": columns,
+                "version": version,
+                "extra": extra,
+                "engine": engine,
+            }
+        ).encode("utf-8")
+    )
+    return hasher.hexdigest()
+
+
+def plotting_code_version(paths: List[str], extra: str = "") -> str:
+    """
+    Hash of the plotting scripts (and e.g. the cvms version).
+    """
+    hasher = hashlib.sha256(extra.encode("utf-8"))
+    for path in paths:
+        hash_file(path, hasher=hasher)
+    return hasher.hexdigest()
+
+
+class _Flight:
+    """
+    An in-progress render that other threads can wait for.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.error = None
+
+
+class RenderCache:
+    """
+    Disk cache of rendered plots keyed by a content hash.
+
+    Entries are directories with the output files (e.g. png and jpg).
+    An index with sizes and access times is stored next to them, so the
+    cache survives server restarts. The least recently used entries
+    are evicted when the total size exceeds `max_size_bytes`.
+    Cache hits only update the access times in memory. The index is saved
+    when entries are added or evicted, at most every `save_interval`
+    seconds after hits, and at exit (see `flush()`).
+
+    Concurrent requests for the same key are coalesced into a single render.
+    Render failures are shared with the waiting requests, except for
+    `retry_errors` (e.g. the render was cancelled), after which one of
+    the waiting requests renders the key instead.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        max_size_bytes: int = 500 * 1024**2,
+        retry_errors: Tuple[Type[Exception], ...] = (),
+        save_interval: float = 30.0,
+    ) -> None:
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.retry_errors = retry_errors
+        self.save_interval = save_interval
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        self.in_flight: Dict[str, _Flight] = {}
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        self.index = self._load_index()
+        # Whether the index has changes that are not saved
+        self.index_is_dirty = False
+        self.last_save = time.monotonic()
+        atexit.register(self.flush)
+
+    def _load_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Drop entries whose files have disappeared
+        return {
+            key: entry
+            for key, entry in index.items()
+            if all((self.cache_dir / key / name).exists() for name in entry["files"])
+        }
+
+    def _save_index(self) -> None:
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        self.index_is_dirty = False
+        self.last_save = time.monotonic()
+
+    def flush(self) -> None:
+        """
+        Save the index when it has unsaved changes (e.g. access times).
+        """
+        with self.lock:
+            if self.index_is_dirty:
+                self._save_index()
+
+    def _copy_out(self, key: str, out_paths: Dict[str, pathlib.Path]) -> None:
+        for name, out_path in out_paths.items():
+            shutil.copyfile(self.cache_dir / key / name, out_path)
+
+    def get(self, key: str, out_paths: Dict[str, pathlib.Path]) -> bool:
+        """
+        Copy the cached files to `out_paths` ({file name: path}).
+        Returns whether the key was in the cache.
+        """
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or not set(out_paths).issubset(entry["files"]):
+                return False
+            entry["last_access"] = time.time()
+            self.index_is_dirty = True
+            if time.monotonic() - self.last_save >= self.save_interval:
+                self._save_index()
+        try:
+            self._copy_out(key, out_paths)
+        except OSError:
+            # Files were removed outside of the cache
+            with self.lock:
+                self.index.pop(key, None)
+                self.index_is_dirty = True
+            return False
+        return True
+
+    def contains(self, key: str) -> bool:
+        """
+        Check whether a key is cached or being rendered.
+        """
+        with self.lock:
+            return key in self.index or key in self.in_flight
+
+    def put(self, key: str, out_paths: Dict[str, pathlib.Path]) -> None:
+        entry_dir = self.cache_dir / key
+        entry_dir.mkdir(exist_ok=True)
+        size = 0
+        for name, out_path in out_paths.items():
+            shutil.copyfile(out_path, entry_dir / name)
+            size += os.path.getsize(entry_dir / name)
+        with self.lock:
+            self.index[key] = {
+                "files": sorted(out_paths),
+                "size": size,
+                "last_access": time.time(),
+            }
+            self._evict()
+            self._save_index()
+
+    def _evict(self) -> None:
+        # Must be called with the lock held
+        total_size = sum(entry["size"] for entry in self.index.values())
+        by_access = sorted(self.index.items(), key=lambda kv: kv[1]["last_access"])
+        for key, entry in by_access:
+            # Always keep the most recent entry
+            if total_size <= self.max_size_bytes or len(self.index) <= 1:
+                break
+            shutil.rmtree(self.cache_dir / key, ignore_errors=True)
+            del self.index[key]
+            total_size -= entry["size"]
+            self.counters["evictions"] += 1
+
+    def get_or_render(
+        self,
+        key: str,
+        render_fn: Callable[[], None],
+        out_paths: Dict[str, pathlib.Path],
+    ) -> bool:
+        """
+        Get the files for `key` from the cache or call `render_fn`
+        to write them to `out_paths` ({file name: path}) and cache them.
+        When another thread is already rendering the same key,
+        we wait for it instead of rendering again.
+
+        Returns whether the files came from the cache.
+        """
+        while True:
+            if self.get(key, out_paths):
+                with self.lock:
+                    self.counters["hits"] += 1
+                return True
+            with self.lock:
+                flight = self.in_flight.get(key)
+                is_leader = flight is None
+                if is_leader:
+                    flight = self.in_flight[key] = _Flight()
+                    self.counters["misses"] += 1
+                else:
+                    self.counters["coalesced"] += 1
+            if is_leader:
+                break
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            # The leader has cached the files or gave up without
+            # a render failure (e.g. it was cancelled) - try again
+
+        try:
+            render_fn()
+            self.put(key, out_paths)
+        except Exception as e:
+            # Control flow exceptions (e.g. a stopped script run)
+            # and `retry_errors` are not shared with the waiting requests
+            if not isinstance(e, self.retry_errors):
+                flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+        return False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.counters,
+                "entries": len(self.index),
+                "size_bytes": sum(entry["size"] for entry in self.index.values()),
+                "in_flight": len(self.in_flight),
+            }
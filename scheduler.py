@@ -0,0 +1,271 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Optional
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class RenderCancelledError(Exception):
+    pass
+
+
+class RenderTicket:
+    """
+    A render job submitted to the `RenderScheduler`.
+    The job function is called with the ticket's `cancel_event`, which
+    is set when the job is cancelled while running.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        fn: Callable[[threading.Event], Any],
+        background: bool = False,
+    ) -> None:
+        self.session_id = session_id
+        self.fn = fn
+        self.background = background
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self.cancel_event = threading.Event()
+
+    @property
+    def wait_seconds(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+    @property
+    def run_seconds(self) -> Optional[float]:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the job to finish. Returns whether it finished.
+        """
+        return self.done.wait(timeout)
+
+    def get_result(self):
+        """
+        Get the return value of the job or raise its exception.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RenderScheduler:
+    """
+    Server-wide queue of render jobs.
+
+    At most `max_concurrent` jobs run at a time and at most `max_queued`
+    jobs wait. New jobs are rejected with a `QueueFullError` when the queue
+    is full or the session already has `max_queued_per_session` jobs waiting.
+
+    Sessions take turns (round-robin), so a session submitting
+    many jobs does not delay the other sessions.
+
+    Background jobs (e.g. pre-rendering) wait in a separate queue of at most
+    `max_background` jobs. They only start when no other jobs are waiting
+    and do not count toward the other limits.
+
+    Jobs can be cancelled. Queued jobs are removed from the queue and
+    running jobs are asked to stop through their `cancel_event`.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 2,
+        max_queued: int = 20,
+        max_queued_per_session: int = 3,
+        max_background: int = 10,
+        num_recent: int = 100,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_session = max_queued_per_session
+        self.max_background = max_background
+        self.background_queue: deque = deque()
+        # Queued tickets per session
+        # The order of the sessions is the round-robin order
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.num_queued = 0
+        self.num_running = 0
+        self.counters = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "cancelled": 0,
+        }
+        self.recent_wait_seconds = deque(maxlen=num_recent)
+        self.recent_run_seconds = deque(maxlen=num_recent)
+        self.condition = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self._work, daemon=True, name=f"render-{i}")
+            for i in range(max_concurrent)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(
+        self,
+        session_id: str,
+        fn: Callable[[threading.Event], Any],
+        background: bool = False,
+    ) -> RenderTicket:
+        if background:
+            return self._submit_background(session_id=session_id, fn=fn)
+        with self.condition:
+            session_queue = self.queues.get(session_id)
+            num_session_queued = 0 if session_queue is None else len(session_queue)
+            if (
+                self.num_queued >= self.max_queued
+                or num_session_queued >= self.max_queued_per_session
+            ):
+                self.counters["rejected"] += 1
+                raise QueueFullError(
+                    "The render queue is full. Please try again in a moment."
+                )
+            ticket = RenderTicket(session_id=session_id, fn=fn)
+            if session_queue is None:
+                session_queue = self.queues[session_id] = deque()
+            session_queue.append(ticket)
+            self.num_queued += 1
+            self.counters["submitted"] += 1
+            self.condition.notify()
+        return ticket
+
+    def _submit_background(
+        self, session_id: str, fn: Callable[[threading.Event], Any]
+    ) -> RenderTicket:
+        with self.condition:
+            if len(self.background_queue) >= self.max_background:
+                self.counters["rejected"] += 1
+                raise QueueFullError("The background queue is full.")
+            ticket = RenderTicket(session_id=session_id, fn=fn, background=True)
+            self.background_queue.append(ticket)
+            self.counters["submitted"] += 1
+            self.condition.notify()
+        return ticket
+
+    def _next_ticket(self) -> RenderTicket:
+        # Must be called with the lock held
+        if not self.num_queued:
+            return self.background_queue.popleft()
+        session_id, session_queue = next(iter(self.queues.items()))
+        ticket = session_queue.popleft()
+        del self.queues[session_id]
+        if session_queue:
+            # Back of the line for the session's next job
+            self.queues[session_id] = session_queue
+        self.num_queued -= 1
+        return ticket
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while not self.num_queued and not self.background_queue:
+                    self.condition.wait()
+                ticket = self._next_ticket()
+                self.num_running += 1
+                ticket.status = "running"
+                ticket.started_at = time.perf_counter()
+            try:
+                ticket.result = ticket.fn(ticket.cancel_event)
+                ticket.status = "done"
+            except BaseException as e:
+                if ticket.cancel_event.is_set():
+                    ticket.error = RenderCancelledError("Render was cancelled.")
+                    ticket.status = "cancelled"
+                else:
+                    ticket.error = e
+                    ticket.status = "failed"
+            ticket.finished_at = time.perf_counter()
+            with self.condition:
+                self.num_running -= 1
+                if ticket.status == "done":
+                    self.counters["completed"] += 1
+                else:
+                    self.counters[ticket.status] += 1
+                self.recent_wait_seconds.append(ticket.wait_seconds)
+                self.recent_run_seconds.append(ticket.run_seconds)
+            ticket.done.set()
+
+    def cancel(self, ticket: RenderTicket) -> None:
+        """
+        Cancel a job. Finished jobs are left as they are.
+        """
+        with self.condition:
+            session_queue = self.queues.get(ticket.session_id)
+            is_queued = False
+            if ticket.background:
+                if ticket in self.background_queue:
+                    self.background_queue.remove(ticket)
+                    is_queued = True
+            elif session_queue is not None and ticket in session_queue:
+                session_queue.remove(ticket)
+                if not session_queue:
+                    del self.queues[ticket.session_id]
+                self.num_queued -= 1
+                is_queued = True
+            if is_queued:
+                self.counters["cancelled"] += 1
+                ticket.error = RenderCancelledError("Render was cancelled.")
+                ticket.status = "cancelled"
+                ticket.done.set()
+            elif ticket.status == "running":
+                ticket.cancel_event.set()
+
+    def position(self, ticket: RenderTicket) -> Optional[int]:
+        """
+        Get the number of jobs that will start before `ticket`
+        (0 means next in line). `None` when the job is no longer queued.
+        """
+        with self.condition:
+            session_queue = self.queues.get(ticket.session_id)
+            if session_queue is None or ticket not in session_queue:
+                return None
+            # Number of jobs the session has ahead of this one
+            rounds = session_queue.index(ticket)
+            session_ids = list(self.queues)
+            session_idx = session_ids.index(ticket.session_id)
+            # Each round, every session with jobs left gets one job started
+            # Sessions before this one also get one in the ticket's round
+            position = 0
+            for idx, other_queue in enumerate(self.queues.values()):
+                position += min(
+                    len(other_queue), rounds + 1 if idx < session_idx else rounds
+                )
+            return position
+
+    def stats(self) -> dict:
+        with self.condition:
+            wait_seconds = list(self.recent_wait_seconds)
+            run_seconds = list(self.recent_run_seconds)
+            return {
+                **self.counters,
+                "queued": self.num_queued,
+                "background_queued": len(self.background_queue),
+                "running": self.num_running,
+                "sessions_queued": len(self.queues),
+                "mean_wait_seconds": sum(wait_seconds) / len(wait_seconds)
+                if wait_seconds
+                else 0.0,
+                "max_wait_seconds": max(wait_seconds, default=0.0),
+                "mean_run_seconds": sum(run_seconds) / len(run_seconds)
+                if run_seconds
+                else 0.0,
+                "max_run_seconds": max(run_seconds, default=0.0),
+            }
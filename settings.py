@@ -0,0 +1,263 @@
+import dataclasses
+import hashlib
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from render_cache import canonical_json
+
+# Options of the select boxes in the design section
+PALETTES = ["Blues", "Greens", "Oranges", "Greys", "Purples", "Reds"]
+INTENSITY_BY_OPTIONS = [
+    "Counts",
+    "Normalized (%)",
+    "Log Counts",
+    "Log2 Counts",
+    "Log10 Counts",
+    "Arcsinh Counts",
+]
+INTENSITY_BEYOND_LIMS_OPTIONS = ["truncate", "grey"]
+LINETYPE_OPTIONS = ["solid", "dashed", "dotted", "dotdash", "longdash", "twodash"]
+
+# Hex colors like "#1F77B4" (optionally with alpha)
+COLOR_PATTERN = re.compile(r"^#[0-9a-fA-F]{6}([0-9a-fA-F]{2})?$")
+
+
+class DesignSettingsError(ValueError):
+    """
+    Raised when design settings are invalid.
+    `errors` holds a message per problem.
+    """
+
+    def __init__(self, errors: List[str]):
+        super().__init__("\n".join(f"- {error}" for error in errors))
+        self.errors = errors
+
+
+def _setting(
+    default: Any,
+    options: Optional[List[Any]] = None,
+    min_value: Optional[float] = None,
+    max_value: Optional[float] = None,
+    color: bool = False,
+):
+    return dataclasses.field(
+        default=default,
+        metadata={
+            "options": options,
+            "min_value": min_value,
+            "max_value": max_value,
+            "color": color,
+        },
+    )
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DesignSettings:
+    """
+    Design settings for plotting a confusion matrix.
+
+    Has a field per setting that `plot.R` reads, with the defaults
+    of the design section. Instances are immutable and hashable.
+    Create them with `from_dict()` to validate the values.
+    """
+
+    # Tiles
+    palette: str = _setting("Blues", options=PALETTES)
+    palette_use_custom: bool = _setting(False)
+    palette_custom_low: str = _setting("#B1F9E8", color=True)
+    palette_custom_high: str = _setting("#239895", color=True)
+    intensity_by: str = _setting("Counts", options=INTENSITY_BY_OPTIONS)
+    darkness: float = _setting(0.8, min_value=0, max_value=1)
+    amount_3d_effect: int = _setting(1, min_value=0, max_value=6)
+    set_intensity_lims: bool = _setting(False)
+    intensity_min: float = _setting(0.0)
+    intensity_max: float = _setting(0.0)
+    intensity_beyond_lims: str = _setting(
+        "truncate", options=INTENSITY_BEYOND_LIMS_OPTIONS
+    )
+    show_tile_border: bool = _setting(False)
+    tile_border_color: str = _setting("#000000", color=True)
+    tile_border_size: float = _setting(0.1, min_value=0, max_value=3)
+    tile_border_linetype: str = _setting("solid", options=LINETYPE_OPTIONS)
+
+    # Sum tiles
+    show_sums: bool = _setting(False)
+    sum_tile_palette: str = _setting("Greens", options=PALETTES)
+    sum_tile_palette_use_custom: bool = _setting(False)
+    sum_tile_palette_custom_low: str = _setting("#e9e1fc", color=True)
+    sum_tile_palette_custom_high: str = _setting("#BE94E6", color=True)
+    sum_tile_label: str = _setting("Σ")
+
+    # Size
+    width: int = _setting(1200, min_value=1)
+    height: int = _setting(1200, min_value=1)
+    dpi: int = _setting(320, min_value=1)
+
+    # Elements
+    show_counts: bool = _setting(True)
+    show_normalized: bool = _setting(True)
+    show_row_percentages: bool = _setting(True)
+    show_col_percentages: bool = _setting(True)
+    diag_percentages_only: bool = _setting(False)
+    show_arrows: bool = _setting(True)
+    arrow_size: float = _setting(0.048)
+    arrow_nudge_from_text: float = _setting(0.065)
+    counts_on_top: bool = _setting(False)
+    num_digits: int = _setting(2, min_value=0)
+    show_zero_shading: bool = _setting(True)
+    show_zero_text: bool = _setting(False)
+    show_zero_percentages: bool = _setting(False)
+
+    # Labels and axes
+    x_label: str = _setting("True Class")
+    y_label: str = _setting("Predicted Class")
+    title_label: str = _setting("")
+    caption_label: str = _setting("")
+    rotate_y_text: bool = _setting(True)
+    place_x_axis_above: bool = _setting(True)
+
+    # Fonts
+    font_top_size: float = _setting(4.3, min_value=0)
+    font_top_color: str = _setting("#000000", color=True)
+    font_top_alpha: float = _setting(1.0, min_value=0, max_value=1)
+    font_top_bold: bool = _setting(False)
+    font_top_italic: bool = _setting(False)
+    font_bottom_size: float = _setting(2.8, min_value=0)
+    font_bottom_color: str = _setting("#000000", color=True)
+    font_bottom_alpha: float = _setting(1.0, min_value=0, max_value=1)
+    font_bottom_bold: bool = _setting(False)
+    font_bottom_italic: bool = _setting(False)
+    font_percentage_size: float = _setting(2.35, min_value=0)
+    font_percentage_color: str = _setting("#000000", color=True)
+    font_percentage_alpha: float = _setting(0.85, min_value=0, max_value=1)
+    font_percentage_bold: bool = _setting(False)
+    font_percentage_italic: bool = _setting(True)
+    font_percentage_prefix: str = _setting("")
+    font_percentage_suffix: str = _setting("%")
+    font_normalized_prefix: str = _setting("")
+    font_normalized_suffix: str = _setting("%")
+    font_counts_prefix: str = _setting("")
+    font_counts_suffix: str = _setting("")
+
+    @classmethod
+    def check_values(cls, data: dict) -> Tuple[dict, List[str]]:
+        """
+        Check the type, options and range of each setting in `data`.
+        Ints are accepted for float settings (e.g. `0` from json).
+
+        Returns the valid (converted) values and an error message per
+        unknown key or invalid value.
+        """
+        fields = {f.name: f for f in dataclasses.fields(cls)}
+        values = {}
+        errors = []
+        for key, value in data.items():
+            field = fields.get(key)
+            if field is None:
+                errors.append(f"`{key}` is not a design setting.")
+                continue
+            error = _check_value(field, value)
+            if error is not None:
+                errors.append(f"`{key}` {error}, got {value!r}.")
+                continue
+            values[key] = field.type(value)
+        return values, errors
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DesignSettings":
+        """
+        Create validated design settings. Missing settings get their default.
+        Raises `DesignSettingsError` with all the problems at once.
+        """
+        if not isinstance(data, dict):
+            raise DesignSettingsError(["The design settings must be a json object."])
+        values, errors = cls.check_values(data)
+        if errors:
+            raise DesignSettingsError(errors)
+        settings = cls(**values)
+        errors = settings.consistency_errors()
+        if errors:
+            raise DesignSettingsError(errors)
+        return settings
+
+    @classmethod
+    def load(cls, path) -> "DesignSettings":
+        """
+        Load and validate design settings from a json file.
+        """
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+    def consistency_errors(self) -> List[str]:
+        """
+        Check combinations of settings.
+        """
+        errors = []
+        if self.show_sums and self.sum_tile_palette == self.palette:
+            errors.append(
+                "The color palettes (background colors) "
+                "for the tiles and sum tiles are identical. "
+                "Please select a different color palette for "
+                "the sum tiles under **Tiles** >> *Sum tile settings*."
+            )
+        if self.set_intensity_lims and not self.intensity_max > self.intensity_min:
+            errors.append(
+                "When specifying an intensity range, "
+                "the maximum value must be greater than the minimum value."
+            )
+        return errors
+
+    def to_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in dataclasses.fields(self)}
+
+    def to_json(self) -> str:
+        """
+        Canonical json (sorted keys, no whitespace).
+        Equal settings give equal strings.
+        """
+        return canonical_json(self.to_dict())
+
+    def digest(self) -> str:
+        """
+        Stable hash of the settings (e.g. for cache keys).
+        """
+        return hashlib.sha256(self.to_json().encode("utf-8")).hexdigest()
+
+    def diff(self, other: "DesignSettings") -> Dict[str, Tuple[Any, Any]]:
+        """
+        Get the settings that differ from `other` as {name: (other value, value)}.
+        """
+        return {
+            f.name: (getattr(other, f.name), getattr(self, f.name))
+            for f in dataclasses.fields(self)
+            if getattr(other, f.name) != getattr(self, f.name)
+        }
+
+
+def _check_value(field: dataclasses.Field, value: Any) -> Optional[str]:
+    """
+    Get an error message (without the key) when a value is invalid.
+    """
+    type_ = field.type
+    # bool is a subclass of int
+    is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if type_ is float:
+        if not is_number:
+            return "must be a number"
+    elif type_ is int:
+        if not (is_number and float(value).is_integer()):
+            return "must be a whole number"
+    elif not isinstance(value, type_):
+        return f"must be {type_.__name__}"
+
+    meta = field.metadata
+    if meta["options"] is not None and value not in meta["options"]:
+        return f"must be one of {', '.join(map(str, meta['options']))}"
+    if meta["min_value"] is not None and value < meta["min_value"]:
+        return f"must be at least {meta['min_value']}"
+    if meta["max_value"] is not None and value > meta["max_value"]:
+        return f"must be at most {meta['max_value']}"
+    if meta["color"] and not COLOR_PATTERN.match(value):
+        return "must be a hex color (e.g. #1F77B4)"
+    return None
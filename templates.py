@@ -1,132 +1,175 @@
+import bisect
+import json
+import os
+import pathlib
+from collections import defaultdict
+from typing import List, Optional
+
+from settings import DesignSettings
+
+# Bundled templates
+TEMPLATES_DIR = pathlib.Path("template_resources")
+
+# User-contributed templates
+# A directory with a `manifest.json` and the files it refers to
+USER_TEMPLATES_DIR = pathlib.Path(
+    os.environ.get("USER_TEMPLATES_DIR", "user_templates")
+)
+
+# Required manifest fields and their types
+TEMPLATE_FIELDS = {
+    "name": str,
+    "collection": str,
+    "num_classes": int,
+    "sums": bool,
+    "settings": str,
+    "image": str,
+}
+
+
+class TemplateError(Exception):
+    pass
+
+
 def get_templates():
-    temps = Templates()
-
-    # Blues
-    temps.add(
-        name="Blues 2-Class",
-        num_classes=2,
-        sums=False,
-        settings_path="design_settings.blues_nc2_1.1.json",
-        image_path="blues_nc2_1.1.png",
-        collection="Blues 1",
-    )
-    temps.add(
-        name="Blues 3-Class",
-        num_classes=3,
-        sums=False,
-        settings_path="design_settings.blues_nc3_1.1.json",
-        image_path="blues_nc3_1.1.png",
-        collection="Blues 1",
-    )
-    temps.add(
-        name="Blues 2-Class w/ Sums",
-        num_classes=2,
-        sums=True,
-        settings_path="design_settings.blues_nc2_sums_1.1.json",
-        image_path="blues_nc2_sums_1.1.png",
-        collection="Blues 1",
-    )
-    temps.add(
-        name="Blues 3-Class w/ Sums",
-        num_classes=3,
-        sums=True,
-        settings_path="design_settings.blues_nc3_sums_1.1.json",
-        image_path="blues_nc3_sums_1.1.png",
-        collection="Blues 1",
-    )
-
-    # Greys
-    temps.add(
-        name="Greys 2-Class",
-        num_classes=2,
-        sums=False,
-        settings_path="design_settings.greys_nc2_1.1.json",
-        image_path="greys_nc2_1.1.png",
-        collection="Greys 1",
-    )
-    temps.add(
-        name="Greys 3-Class",
-        num_classes=3,
-        sums=False,
-        settings_path="design_settings.greys_nc3_1.1.json",
-        image_path="greys_nc3_1.1.png",
-        collection="Greys 1",
-    )
-    temps.add(
-        name="Greys 2-Class w/ Sums",
-        num_classes=2,
-        sums=True,
-        settings_path="design_settings.greys_nc2_sums_1.1.json",
-        image_path="greys_nc2_sums_1.1.png",
-        collection="Greys 1",
-    )
-    temps.add(
-        name="Greys 3-Class w/ Sums",
-        num_classes=3,
-        sums=True,
-        settings_path="design_settings.greys_nc3_sums_1.1.json",
-        image_path="greys_nc3_sums_1.1.png",
-        collection="Greys 1",
-    )
-
-    # Turquoise
-    # Greys
-    temps.add(
-        name="Turquoises 2-Class",
-        num_classes=2,
-        sums=False,
-        settings_path="design_settings.turquoise_nc2_1.1.json",
-        image_path="turquoise_nc2_1.1.png",
-        collection="Turquoises 1",
-    )
-    temps.add(
-        name="Turquoises 3-Class",
-        num_classes=3,
-        sums=False,
-        settings_path="design_settings.turquoise_nc3_1.1.json",
-        image_path="turquoise_nc3_1.1.png",
-        collection="Turquoises 1",
-    )
-    temps.add(
-        name="Turquoises 2-Class w/ Sums",
-        num_classes=2,
-        sums=True,
-        settings_path="design_settings.turquoise_nc2_sums_1.1.json",
-        image_path="turquoise_nc2_sums_1.1.png",
-        collection="Turquoises 1",
-    )
-    temps.add(
-        name="Turquoises 3-Class w/ Sums",
-        num_classes=3,
-        sums=True,
-        settings_path="design_settings.turquoise_nc3_sums_1.1.json",
-        image_path="turquoise_nc3_sums_1.1.png",
-        collection="Turquoises 1",
-    )
-
-    return temps.get_templates()
-
-
-class Templates:
+    registry = TemplateRegistry()
+    registry.load_manifest(TEMPLATES_DIR)
+    if (USER_TEMPLATES_DIR / "manifest.json").exists():
+        # Invalid user templates are skipped instead of breaking the app
+        registry.load_manifest(USER_TEMPLATES_DIR, skip_invalid=True)
+    return registry
+
+
+class TemplateRegistry:
+    """
+    Templates loaded from `manifest.json` files.
+
+    The settings files are parsed and validated once when loading.
+    Templates are indexed by (number of classes, sums) and by collection.
+
+    Each template is a dict with the manifest fields, where `settings`
+    is the loaded design settings and `image` is the path to the image.
+    """
+
     def __init__(self) -> None:
         self.templates = {}
+        self.by_num_classes_and_sums = defaultdict(list)
+        self.by_sums = defaultdict(list)
+        self.by_collection = defaultdict(list)
+        self.available_num_classes = []
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def __getitem__(self, name: str) -> dict:
+        return self.templates[name]
 
-    def get_templates(self) -> dict:
-        return self.templates
+    def load_manifest(self, templates_dir, skip_invalid: bool = False) -> None:
+        templates_dir = pathlib.Path(templates_dir)
+        with open(templates_dir / "manifest.json", "r") as f:
+            manifest = json.load(f)
+        for entry in manifest["templates"]:
+            try:
+                self.add(templates_dir=templates_dir, **self._validate(entry))
+            except (TemplateError, OSError, ValueError) as e:
+                if not skip_invalid:
+                    raise
+                print(f"Skipping invalid template in {templates_dir}: {e}")
+
+    @staticmethod
+    def _validate(entry: dict) -> dict:
+        errors = []
+        for field, type_ in TEMPLATE_FIELDS.items():
+            if field not in entry:
+                errors.append(f"`{field}` is missing")
+            elif not isinstance(entry[field], type_) or (
+                # bool is a subclass of int
+                type_ is int and isinstance(entry[field], bool)
+            ):
+                errors.append(f"`{field}` must be {type_.__name__}")
+        if errors:
+            raise TemplateError(f"{entry.get('name', entry)}: " + "; ".join(errors))
+        return {field: entry[field] for field in TEMPLATE_FIELDS}
 
     def add(
         self,
         name: str,
         num_classes: int,
         sums: bool,
-        settings_path: str,
-        image_path: str,
+        settings: str,
+        image: str,
         collection: str,
+        templates_dir=TEMPLATES_DIR,
     ) -> None:
+        if name in self.templates:
+            raise TemplateError(f"{name}: A template with this name already exists.")
+        image_path = pathlib.Path(templates_dir) / image
+        if not image_path.exists():
+            raise TemplateError(f"{name}: Image file not found: {image_path}")
+        with open(pathlib.Path(templates_dir) / settings, "r") as f:
+            loaded_settings = json.load(f)
+        if not isinstance(loaded_settings, dict):
+            raise TemplateError(f"{name}: Settings file must contain a json object.")
+        _, errors = DesignSettings.check_values(loaded_settings)
+        if errors:
+            raise TemplateError(
+                f"{name}: Invalid design settings:\n"
+                + "\n".join(f"- {error}" for error in errors)
+            )
+
         self.templates[name] = {
+            "name": name,
             "collection": collection,
             "num_classes": num_classes,
             "sums": sums,
-            "settings": settings_path,
-            "image": image_path,
+            "settings": loaded_settings,
+            "image": str(image_path),
         }
+        self.by_num_classes_and_sums[(num_classes, sums)].append(name)
+        self.by_sums[sums].append(name)
+        self.by_collection[collection].append(name)
+        if num_classes not in self.available_num_classes:
+            bisect.insort(self.available_num_classes, num_classes)
+
+    def find(
+        self,
+        num_classes: Optional[int] = None,
+        sums: Optional[bool] = None,
+        collection: Optional[str] = None,
+    ) -> List[dict]:
+        """
+        Get the templates matching the specified filters.
+        """
+        if collection is not None:
+            # Collections are small, so their templates are filtered
+            templates = [
+                self.templates[name] for name in self.by_collection.get(collection, [])
+            ]
+            return [
+                t
+                for t in templates
+                if (num_classes is None or t["num_classes"] == num_classes)
+                and (sums is None or t["sums"] == sums)
+            ]
+        if num_classes is not None and sums is not None:
+            names = self.by_num_classes_and_sums.get((num_classes, sums), [])
+        elif num_classes is not None:
+            names = self.by_num_classes_and_sums.get(
+                (num_classes, False), []
+            ) + self.by_num_classes_and_sums.get((num_classes, True), [])
+        elif sums is not None:
+            names = self.by_sums.get(sums, [])
+        else:
+            names = list(self.templates.keys())
+        return [self.templates[name] for name in names]
+
+    def closest_num_classes(self, num_classes: int) -> Optional[int]:
+        """
+        Get the available number of classes closest to `num_classes`.
+        Ties are resolved in favor of the smaller number.
+        """
+        if not self.available_num_classes:
+            return None
+        idx = bisect.bisect_left(self.available_num_classes, num_classes)
+        candidates = self.available_num_classes[max(idx - 1, 0) : idx + 1]
+        return min(candidates, key=lambda n: abs(n - num_classes))
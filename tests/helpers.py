@@ -0,0 +1,24 @@
+import shutil
+import subprocess
+
+# R packages used by the plotting scripts
+R_PACKAGES = ["cvms", "dplyr", "ggplot2", "jsonlite", "arrow"]
+
+
+def has_r_packages(packages=R_PACKAGES):
+    """
+    Check whether R and the `packages` are installed.
+    """
+    if shutil.which("Rscript") is None:
+        return False
+    check = subprocess.run(
+        [
+            "Rscript",
+            "-e",
+            "for (p in c("
+            + ", ".join(f"'{p}'" for p in packages)
+            + ")) library(p, character.only = TRUE)",
+        ],
+        capture_output=True,
+    )
+    return check.returncode == 0
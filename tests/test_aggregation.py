@@ -0,0 +1,419 @@
+import pathlib
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from aggregation import (  # noqa: E402
+    collapse_classes,
+    count_chunks,
+    count_confusion_matrix,
+    count_csv_in_chunks,
+    count_csv_parallel,
+    count_grouped_confusion_matrices,
+    count_data,
+    count_probability_chunks,
+    get_other_label,
+    get_thresholds,
+    matrix_to_long,
+    parse_count_matrix,
+    partial_probability_counts,
+    rank_classes,
+    select_classes,
+    split_file_by_lines,
+    threshold_confusion_matrices,
+    top_k_classes,
+)
+from data import iter_data_chunks  # noqa: E402
+from utils import clean_str_column  # noqa: E402
+
+
+def test_count_confusion_matrix():
+    targets = pd.Series(["a", "b", "b", "c", "a", "x"])
+    predictions = pd.Series(["a", "b", "a", "c", "c", "a"])
+    # Targets in the rows, predictions in the columns
+    np.testing.assert_array_equal(
+        count_confusion_matrix(targets, predictions, classes=["a", "b", "c"]),
+        [[1, 0, 1], [1, 1, 0], [0, 0, 1]],
+    )
+    # Observations with a class not in `classes` are excluded
+    np.testing.assert_array_equal(
+        count_confusion_matrix(targets, predictions, classes=["b", "a"]),
+        [[1, 1], [0, 1]],
+    )
+    # The classes default to all the sorted targets and predictions
+    np.testing.assert_array_equal(
+        count_confusion_matrix(targets, predictions).sum(axis=1), [2, 2, 1, 1]
+    )
+
+
+def test_matrix_to_long_roundtrip():
+    classes = ["a", "b", "c"]
+    matrix = np.arange(9).reshape(3, 3)
+    counts = matrix_to_long(matrix, classes=classes)
+    assert list(counts.columns) == ["Target", "Prediction", "N"]
+    assert counts.iloc[1].tolist() == ["a", "b", 1]
+    assert counts.iloc[3].tolist() == ["b", "a", 3]
+    np.testing.assert_array_equal(select_classes(counts, classes=classes), matrix)
+    # Missing classes get zero counts and unselected classes are excluded
+    np.testing.assert_array_equal(
+        select_classes(counts, classes=["c", "a", "z"]),
+        [[8, 6, 0], [2, 0, 0], [0, 0, 0]],
+    )
+
+    targets = pd.Series(["a", "b", "b"])
+    predictions = pd.Series(["b", "b", "c"])
+    pd.testing.assert_frame_equal(
+        count_data(targets, predictions),
+        matrix_to_long(
+            [[0, 1, 0], [0, 1, 1], [0, 0, 0]], classes=["a", "b", "c"]
+        ),
+    )
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "1\t2\n3\t4",
+        "1,2\r\n3,4\r\n",
+        "  1; 2\n\n3 ;4  ",
+        "1 2\n3    4",
+        "1.0, 2\n3, 4.0",
+    ],
+)
+def test_parse_count_matrix(text):
+    matrix = parse_count_matrix(text, num_classes=2)
+    assert matrix.dtype == np.int64
+    np.testing.assert_array_equal(matrix, [[1, 2], [3, 4]])
+
+
+@pytest.mark.parametrize(
+    "text, message",
+    [
+        ("1,2\n3,x", "only contain numbers"),
+        ("1,2,3\n4,5,6", "2 rows and 2 columns"),
+        ("1,2\n3", "2 rows and 2 columns"),
+        ("1,2\n3,-4", "non-negative whole numbers"),
+        ("1,2\n3,4.5", "non-negative whole numbers"),
+    ],
+)
+def test_parse_count_matrix_errors(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse_count_matrix(text, num_classes=2)
+
+
+# Targets in the rows, predictions in the columns
+CLASS_MATRIX = np.array(
+    [
+        [5, 0, 0, 1],
+        [0, 9, 0, 0],
+        [3, 0, 2, 3],
+        [0, 0, 0, 2],
+    ]
+)
+
+
+def test_rank_classes():
+    np.testing.assert_array_equal(rank_classes(CLASS_MATRIX), [6, 9, 8, 2])
+    np.testing.assert_array_equal(
+        rank_classes(CLASS_MATRIX, by="Confusion mass"), [4, 0, 6, 4]
+    )
+    with pytest.raises(ValueError):
+        rank_classes(CLASS_MATRIX, by="Unknown")
+
+
+def test_top_k_classes():
+    classes = ["a", "b", "c", "d"]
+    # Both keep the order of the classes
+    assert top_k_classes(CLASS_MATRIX, classes, k=2) == (["b", "c"], ["a", "d"])
+    # Ties are resolved by the class order
+    assert top_k_classes(CLASS_MATRIX, classes, k=2, by="Confusion mass") == (
+        ["a", "c"],
+        ["b", "d"],
+    )
+    assert top_k_classes(CLASS_MATRIX, classes, k=10) == (classes, [])
+
+
+def test_collapse_classes():
+    classes = ["a", "b", "c", "d"]
+    collapsed, collapsed_classes = collapse_classes(
+        CLASS_MATRIX, classes=classes, keep=["a", "c"]
+    )
+    assert collapsed_classes == ["a", "c", "Other"]
+    np.testing.assert_array_equal(
+        collapsed,
+        [
+            [5, 0, 1],
+            [3, 2, 3],
+            [0, 0, 11],
+        ],
+    )
+    # All observations are kept
+    assert collapsed.sum() == CLASS_MATRIX.sum()
+    # The collapsed matrix matches counting with the classes relabeled
+    counts = matrix_to_long(CLASS_MATRIX, classes=classes)
+    relabeled = counts.replace({"b": "Other", "d": "Other"})
+    np.testing.assert_array_equal(
+        select_classes(
+            relabeled.groupby(["Target", "Prediction"], as_index=False)["N"].sum(),
+            classes=collapsed_classes,
+        ),
+        collapsed,
+    )
+
+
+def test_other_label_is_not_a_class():
+    assert get_other_label(["a", "b"]) == "Other"
+    assert get_other_label(["Other", "Other*"]) == "Other**"
+    _, collapsed_classes = collapse_classes(
+        CLASS_MATRIX, classes=["Other", "b", "c", "d"], keep=["Other", "b"]
+    )
+    assert collapsed_classes == ["Other", "b", "Other*"]
+
+
+@pytest.fixture
+def predictions_csv(tmp_path):
+    rng = np.random.default_rng(1)
+    num_rows = 5000
+    classes = np.array(["cat", "dog", "a,b", "", "1"], dtype=object)
+    df = pd.DataFrame(
+        {
+            "Target": rng.choice(classes, size=num_rows),
+            "Other": rng.integers(0, 100, size=num_rows),
+            "Prediction": rng.choice(classes, size=num_rows),
+            "Fold": rng.choice(["f1", "f2", "f3", ""], size=num_rows),
+        }
+    )
+    path = tmp_path / "predictions.csv"
+    df.to_csv(path, index=False)
+    return path
+
+
+def test_split_file_by_lines_covers_file(predictions_csv):
+    ranges = split_file_by_lines(predictions_csv, split_size=1000)
+    assert len(ranges) > 1
+    with open(predictions_csv, "rb") as f:
+        header = f.readline()
+        body = f.read()
+    assert ranges[0][0] == len(header)
+    assert ranges[-1][1] == len(header) + len(body)
+    for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]):
+        assert end == start
+    # Splits end at line breaks
+    with open(predictions_csv, "rb") as f:
+        content = f.read()
+    assert all(content[end - 1 : end] == b"\n" for _, end in ranges)
+
+
+@pytest.mark.parametrize("use_executor", [False, True])
+def test_parallel_counts_equal_chunked_counts(predictions_csv, use_executor):
+    chunked, chunked_rows = count_csv_in_chunks(
+        predictions_csv, target_col="Target", prediction_col="Prediction", chunksize=700
+    )
+    if use_executor:
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            parallel, parallel_rows = count_csv_parallel(
+                predictions_csv,
+                target_col="Target",
+                prediction_col="Prediction",
+                split_size=4000,
+                executor=executor,
+            )
+    else:
+        parallel, parallel_rows = count_csv_parallel(
+            predictions_csv,
+            target_col="Target",
+            prediction_col="Prediction",
+            num_workers=2,
+            split_size=4000,
+        )
+    assert parallel_rows == chunked_rows == 5000
+    pd.testing.assert_frame_equal(parallel, chunked)
+    # Empty cells are the "nan" class in both
+    assert "nan" in set(parallel["Target"])
+
+
+def test_parallel_counts_single_split(predictions_csv):
+    chunked, _ = count_csv_in_chunks(
+        predictions_csv, target_col="Target", prediction_col="Prediction"
+    )
+    parallel, num_rows = count_csv_parallel(
+        predictions_csv, target_col="Target", prediction_col="Prediction"
+    )
+    assert num_rows == 5000
+    pd.testing.assert_frame_equal(parallel, chunked)
+
+
+def test_parallel_counts_unknown_column(predictions_csv):
+    with pytest.raises(ValueError, match="not a column"):
+        count_csv_parallel(predictions_csv, target_col="Nope", prediction_col="Prediction")
+
+
+def test_streamed_group_counts_equal_in_memory_counts(predictions_csv, tmp_path):
+    df = pd.read_csv(predictions_csv)
+    classes = sorted(clean_str_column(df["Target"]).unique())
+    expected, expected_groups = count_grouped_confusion_matrices(
+        groups=clean_str_column(df["Fold"]),
+        targets=clean_str_column(df["Target"]),
+        predictions=clean_str_column(df["Prediction"]),
+        classes=classes,
+    )
+
+    parquet_path = tmp_path / "predictions.parquet"
+    df.to_parquet(parquet_path)
+    columns = ["Target", "Prediction", "Fold"]
+    for group_counts, num_rows in [
+        count_csv_in_chunks(
+            predictions_csv,
+            target_col="Target",
+            prediction_col="Prediction",
+            group_col="Fold",
+            chunksize=700,
+        ),
+        count_csv_parallel(
+            predictions_csv,
+            target_col="Target",
+            prediction_col="Prediction",
+            group_col="Fold",
+            num_workers=2,
+            split_size=4000,
+        ),
+        count_chunks(
+            iter_data_chunks(parquet_path, columns=columns, chunksize=700),
+            target_col="Target",
+            prediction_col="Prediction",
+            group_col="Fold",
+        ),
+    ]:
+        assert num_rows == len(df)
+        assert list(group_counts.columns) == ["Group", "Target", "Prediction", "N"]
+        matrices, groups = count_grouped_confusion_matrices(
+            groups=group_counts["Group"],
+            targets=group_counts["Target"],
+            predictions=group_counts["Prediction"],
+            classes=classes,
+            weights=group_counts["N"],
+        )
+        assert groups == expected_groups
+        np.testing.assert_array_equal(matrices, expected)
+
+
+def test_missing_groups_are_a_nan_group():
+    groups = pd.Series(["g2", np.nan, "g1", "g2", None])
+    targets = pd.Series(["a", "b", "a", "b", "a"])
+    predictions = pd.Series(["a", "b", "b", "x", "a"])
+    matrices, group_names = count_grouped_confusion_matrices(
+        groups, targets, predictions, classes=["a", "b"]
+    )
+    assert group_names == ["g1", "g2", "nan"]
+    np.testing.assert_array_equal(
+        matrices, [[[0, 1], [0, 0]], [[1, 0], [0, 0]], [[1, 0], [0, 1]]]
+    )
+    # Same as counting the cleaned groups
+    cleaned_matrices, cleaned_names = count_grouped_confusion_matrices(
+        clean_str_column(groups), targets, predictions, classes=["a", "b"]
+    )
+    assert cleaned_names == group_names
+    np.testing.assert_array_equal(cleaned_matrices, matrices)
+
+
+def test_threshold_confusion_matrices():
+    is_positive = np.array([True, True, False, True, False, False])
+    probabilities = np.array([0.9, 0.6, 0.6, 0.3, 0.1, np.nan])
+    matrices = threshold_confusion_matrices(
+        is_positive, probabilities, thresholds=[0.0, 0.3, 0.6, 0.95]
+    )
+    # (threshold x targets x predictions) with the negative class first
+    # The observation with a missing probability is excluded
+    np.testing.assert_array_equal(
+        matrices,
+        [
+            [[0, 2], [0, 3]],
+            [[1, 1], [0, 3]],
+            [[1, 1], [1, 2]],
+            [[2, 0], [3, 0]],
+        ],
+    )
+    # Each threshold matches counting the thresholded predictions
+    for threshold, matrix in zip([0.0, 0.3, 0.6, 0.95], matrices):
+        keep = ~np.isnan(probabilities)
+        np.testing.assert_array_equal(
+            count_confusion_matrix(
+                pd.Series(is_positive[keep]),
+                pd.Series(probabilities[keep] >= threshold),
+                classes=[False, True],
+            ),
+            matrix,
+        )
+
+    # Weights are the number of observations of each element
+    np.testing.assert_array_equal(
+        threshold_confusion_matrices(
+            np.array([True, False, True]),
+            np.array([0.8, 0.8, 0.2]),
+            thresholds=[0.5],
+            weights=np.array([2, 3, 4]),
+        ),
+        [[[0, 3], [4, 2]]],
+    )
+
+
+def test_get_thresholds():
+    probabilities = np.array([0.2, 0.7, 0.2, np.nan])
+    np.testing.assert_array_equal(get_thresholds(probabilities), [0.2, 0.7])
+    np.testing.assert_allclose(
+        get_thresholds(probabilities, num_thresholds=5), [0, 0.25, 0.5, 0.75, 1]
+    )
+    # The range covers probabilities outside [0, 1]
+    np.testing.assert_allclose(
+        get_thresholds([-1.0, 3.0], num_thresholds=3), [-1, 1, 3]
+    )
+
+
+def test_streamed_threshold_sweep_equals_in_memory_sweep(tmp_path):
+    rng = np.random.default_rng(2)
+    num_rows = 3000
+    probabilities = rng.random(num_rows).round(2)
+    probabilities[::97] = np.nan
+    df = pd.DataFrame(
+        {
+            "Target": rng.choice(["neg", "pos"], size=num_rows),
+            "Probability": probabilities,
+        }
+    )
+    path = tmp_path / "probabilities.csv"
+    df.to_csv(path, index=False)
+
+    observed = ~np.isnan(probabilities)
+    thresholds = get_thresholds(probabilities)
+    expected = threshold_confusion_matrices(
+        is_positive=(df["Target"] == "pos").to_numpy()[observed],
+        probabilities=probabilities[observed],
+        thresholds=thresholds,
+    )
+
+    in_memory_counts = partial_probability_counts(
+        targets=df["Target"], probabilities=df["Probability"]
+    )
+    streamed_counts, streamed_rows = count_probability_chunks(
+        iter_data_chunks(path, columns=["Target", "Probability"], chunksize=700),
+        target_col="Target",
+        prediction_col="Probability",
+    )
+    assert streamed_rows == num_rows
+    for counts in [in_memory_counts, streamed_counts]:
+        assert counts["N"].sum() == observed.sum()
+        np.testing.assert_array_equal(
+            get_thresholds(counts["Probability"].to_numpy()), thresholds
+        )
+        matrices = threshold_confusion_matrices(
+            is_positive=(counts["Target"] == "pos").to_numpy(),
+            probabilities=counts["Probability"].to_numpy(),
+            thresholds=thresholds,
+            weights=counts["N"].to_numpy(),
+        )
+        np.testing.assert_array_equal(matrices, expected)
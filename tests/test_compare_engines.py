@@ -0,0 +1,33 @@
+"""
+Compare the Python engine with the R engine (cvms) on the bundled templates.
+Skipped when R or the R plotting packages are not installed.
+"""
+
+import json
+import pathlib
+import sys
+
+import pytest
+from helpers import has_r_packages
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR / "benchmarks"))
+from compare_engines import compare_engines  # noqa: E402
+
+
+@pytest.mark.skipif(not has_r_packages(), reason="Requires R with cvms installed")
+def test_engines_match_on_templates(tmp_path, monkeypatch):
+    # The R worker sources the plotting functions from the repository root
+    monkeypatch.chdir(ROOT_DIR)
+    results = compare_engines(out_dir=tmp_path)
+
+    with open(ROOT_DIR / "template_resources" / "manifest.json", "r") as f:
+        num_templates = len(json.load(f)["templates"])
+    assert len(results) == num_templates
+    assert (tmp_path / "comparison.json").exists()
+    failed = [
+        f"{r['template']}: {r['diff_fraction']:.2%} differing pixels"
+        for r in results
+        if not r["passed"]
+    ]
+    assert not failed, "Differs from cvms: " + "; ".join(failed)
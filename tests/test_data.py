@@ -0,0 +1,61 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from data import _open_ipc, iter_data_chunks, read_data  # noqa: E402
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.feather  # noqa: E402
+
+
+@pytest.fixture(params=["feather", "arrow"])
+def ipc_path(request, tmp_path):
+    df = pd.DataFrame(
+        {
+            "Target": np.repeat(["a", "b"], 5),
+            "Other": np.arange(10),
+            "Prediction": np.tile(["a", "b"], 5),
+        }
+    )
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if request.param == "feather":
+        path = tmp_path / "data.feather"
+        pyarrow.feather.write_feather(table, path, compression="lz4", chunksize=3)
+    else:
+        # Stream format
+        path = tmp_path / "data.arrow"
+        with pa.ipc.new_stream(path, table.schema) as writer:
+            writer.write_table(table, max_chunksize=4)
+    return path, df
+
+
+def test_ipc_reader_only_reads_requested_columns(ipc_path):
+    path, _ = ipc_path
+    reader = _open_ipc(path, columns=["Prediction", "Target"])
+    assert reader.schema.names == ["Target", "Prediction"]
+    with pytest.raises(KeyError):
+        _open_ipc(path, columns=["Target", "Missing"])
+
+
+@pytest.mark.parametrize("nrows", [None, 4])
+def test_read_ipc_columns(ipc_path, nrows):
+    path, df = ipc_path
+    read = read_data(path, nrows=nrows, columns=["Prediction", "Target"])
+    expected = df.loc[:, ["Prediction", "Target"]].head(nrows)
+    pd.testing.assert_frame_equal(read.astype(str), expected)
+
+
+def test_iter_ipc_chunks_columns(ipc_path):
+    path, df = ipc_path
+    chunks = list(iter_data_chunks(path, columns=["Prediction", "Target"]))
+    assert len(chunks) > 1
+    assert all(list(chunk.columns) == ["Prediction", "Target"] for chunk in chunks)
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks, ignore_index=True).astype(str),
+        df.loc[:, ["Prediction", "Target"]],
+    )
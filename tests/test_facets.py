@@ -0,0 +1,130 @@
+"""
+Smoke test of plotting a confusion matrix per group (facets) with both engines.
+The R engine is skipped when R or the R plotting packages are not installed.
+"""
+
+import json
+import pathlib
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from helpers import R_PACKAGES, has_r_packages
+from PIL import Image
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from aggregation import (  # noqa: E402
+    count_grouped_confusion_matrices,
+    grouped_matrices_to_long,
+)
+from data import write_plot_data  # noqa: E402
+from python_plotting import (  # noqa: E402
+    get_facet_grid,
+    get_shared_intensity_lims,
+    render_job,
+)
+from utils import PlotWorker  # noqa: E402
+
+CLASSES = ["a", "b", "c"]
+GROUPS = ["g1", "g2", "g3", "g4", "g5"]
+
+
+def make_grouped_job(out_dir):
+    rng = np.random.default_rng(1)
+    num_observations = 500
+    targets = rng.choice(CLASSES, size=num_observations)
+    # Mostly correct predictions
+    predictions = np.where(
+        rng.uniform(size=num_observations) < 0.7,
+        targets,
+        rng.choice(CLASSES, size=num_observations),
+    )
+    matrices, groups = count_grouped_confusion_matrices(
+        groups=pd.Series(rng.choice(GROUPS, size=num_observations)),
+        targets=pd.Series(targets),
+        predictions=pd.Series(predictions),
+        classes=CLASSES,
+    )
+    data_path = out_dir / "data.feather"
+    write_plot_data(
+        grouped_matrices_to_long(
+            matrices, groups=groups, classes=CLASSES, group_col="Fold"
+        ),
+        data_path,
+    )
+
+    with open(
+        ROOT_DIR / "template_resources" / "design_settings.blues_nc3_1.1.json", "r"
+    ) as f:
+        design_settings = json.load(f)
+    settings_path = out_dir / "design_settings.json"
+    with open(settings_path, "w") as f:
+        json.dump(design_settings, f)
+
+    size = {
+        "width": design_settings["width"],
+        "height": design_settings["height"],
+        "dpi": design_settings["dpi"],
+    }
+    return {
+        "data_path": str(data_path),
+        "out_path": str(out_dir / "grid.png"),
+        "settings_path": str(settings_path),
+        "target_col": "Target",
+        "prediction_col": "Prediction",
+        "n_col": "N",
+        "classes": ",".join(CLASSES),
+        "data_are_counts": True,
+        "group_col": "Fold",
+        "intensity_lims": get_shared_intensity_lims(
+            matrices, intensity_by=design_settings["intensity_by"]
+        ),
+        "facet_pages": True,
+        "exports": [
+            {"path": str(out_dir / "grid.png"), "bg": "white", **size},
+            {"path": str(out_dir / "pages.pdf"), "bg": "white", **size},
+        ],
+    }, size
+
+
+def render_with_r(job):
+    worker = PlotWorker(script_path="plot_worker.R")
+    try:
+        worker.render(job)
+    finally:
+        worker.stop()
+
+
+@pytest.mark.parametrize(
+    "engine",
+    [
+        "python",
+        pytest.param(
+            "r",
+            marks=pytest.mark.skipif(
+                not has_r_packages(R_PACKAGES + ["patchwork"]),
+                reason="Requires R with cvms and patchwork installed",
+            ),
+        ),
+    ],
+)
+def test_facets(engine, tmp_path, monkeypatch):
+    # The R worker sources the plotting functions from the repository root
+    monkeypatch.chdir(ROOT_DIR)
+    job, size = make_grouped_job(tmp_path)
+    {"python": render_job, "r": render_with_r}[engine](job)
+
+    # A grid of the groups
+    grid_dims = get_facet_grid(len(GROUPS))
+    with Image.open(tmp_path / "grid.png") as image:
+        assert image.size == (
+            size["width"] * grid_dims[1],
+            size["height"] * grid_dims[0],
+        )
+
+    # A pdf page per group
+    pdf = (tmp_path / "pages.pdf").read_bytes()
+    assert len(re.findall(rb"/Type\s*/Page\b", pdf)) == len(GROUPS)
@@ -0,0 +1,97 @@
+"""
+Test which engine renders the bundled templates and that the Python engine
+renders them (arrows and 3D effect included) without R.
+"""
+
+import json
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from aggregation import matrix_to_long  # noqa: E402
+from data import write_plot_data  # noqa: E402
+from python_plotting import (  # noqa: E402
+    get_arrow_vertices,
+    get_unsupported_features,
+    render_with_engine,
+    resolve_engine,
+)
+from settings import DesignSettings  # noqa: E402
+
+TEMPLATES_DIR = ROOT_DIR / "template_resources"
+with open(TEMPLATES_DIR / "manifest.json", "r") as f:
+    TEMPLATES = json.load(f)["templates"]
+
+
+class FailingWorkerPool:
+    """
+    Fails the test when a job is sent to R.
+    """
+
+    def render(self, job, timeout=None, cancel_event=None):
+        pytest.fail("The job was rendered with R")
+
+
+def make_job(template, out_dir, data_are_counts=True):
+    classes = [f"class {i + 1}" for i in range(template["num_classes"])]
+    matrix = np.arange(1, len(classes) ** 2 + 1).reshape(len(classes), len(classes))
+    matrix[-1, 0] = 0
+    data_path = out_dir / "data.feather"
+    write_plot_data(matrix_to_long(matrix, classes=classes), data_path)
+    return {
+        "data_path": str(data_path),
+        "out_path": str(out_dir / "plot.png"),
+        "settings_path": str(TEMPLATES_DIR / template["settings"]),
+        "target_col": "Target",
+        "prediction_col": "Prediction",
+        "n_col": "N",
+        "classes": ",".join(classes),
+        "data_are_counts": data_are_counts,
+        "engine": "python",
+    }
+
+
+@pytest.mark.parametrize("template", TEMPLATES, ids=lambda t: t["name"])
+def test_templates_use_python_engine(template, tmp_path):
+    design_settings = DesignSettings.load(
+        TEMPLATES_DIR / template["settings"]
+    ).to_dict()
+    job = make_job(template, tmp_path)
+    assert get_unsupported_features(job, design_settings) == []
+    assert resolve_engine(job, design_settings) == "python"
+    assert resolve_engine(job) == "python"
+    assert resolve_engine({**job, "engine": "r"}, design_settings) == "r"
+    # Predictions (not counts) are only supported by R
+    predictions_job = {**job, "data_are_counts": False}
+    assert get_unsupported_features(predictions_job, design_settings) == [
+        "predictions (not counts)"
+    ]
+    assert resolve_engine(predictions_job, design_settings) == "r"
+
+
+@pytest.mark.parametrize("template", TEMPLATES[:4], ids=lambda t: t["name"])
+def test_python_engine_renders_templates(template, tmp_path):
+    job = make_job(template, tmp_path)
+    render_with_engine(job, worker_pool=FailingWorkerPool())
+    design_settings = DesignSettings.load(job["settings_path"])
+    with Image.open(job["out_path"]) as image:
+        assert image.size == (design_settings.width, design_settings.height)
+
+
+@pytest.mark.parametrize(
+    "direction, tip",
+    [("up", [0, -1]), ("down", [0, 1]), ("left", [-1, 0]), ("right", [1, 0])],
+)
+def test_arrow_vertices_point_in_direction(direction, tip):
+    vertices = get_arrow_vertices(5, 5, direction=direction, width=2)
+    # The tip is the vertex furthest in the direction (y-axis points down)
+    tip_vertex = vertices[np.argmax(vertices @ np.array(tip))]
+    assert list(tip_vertex - [5, 5]) == pytest.approx(list(np.array(tip) * 0.55))
+    # The base is perpendicular to the direction
+    base = np.delete(vertices, np.argmax(vertices @ np.array(tip)), axis=0)
+    assert base[0] @ np.array(tip) == pytest.approx(base[1] @ np.array(tip))
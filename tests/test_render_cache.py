@@ -0,0 +1,205 @@
+import json
+import pathlib
+import sys
+import threading
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from render_cache import RenderCache, make_render_key  # noqa: E402
+
+TIMEOUT = 5
+
+
+class Cancelled(Exception):
+    pass
+
+
+def make_render_fn(out_path, content, calls=None, started=None, release=None):
+    def render_fn():
+        if calls is not None:
+            calls.append(content)
+        if started is not None:
+            started.set()
+        if release is not None:
+            release.wait(TIMEOUT)
+        out_path.write_bytes(content)
+
+    return render_fn
+
+
+def test_get_or_render_caches_files(tmp_path):
+    cache = RenderCache(tmp_path / "cache")
+    out_path = tmp_path / "plot.png"
+    calls = []
+    out_paths = {"plot.png": out_path}
+    for content, is_cached in [(b"a", False), (b"b", True)]:
+        render_fn = make_render_fn(out_path, content, calls)
+        assert cache.get_or_render("key", render_fn, out_paths) == is_cached
+        if not is_cached:
+            out_path.unlink()
+    assert calls == [b"a"]
+    assert out_path.read_bytes() == b"a"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    # Other files than the cached ones are a miss
+    assert not cache.get("key", {"plot.jpg": tmp_path / "plot.jpg"})
+
+
+def test_concurrent_requests_render_once(tmp_path):
+    cache = RenderCache(tmp_path / "cache")
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+    leader_out = tmp_path / "leader.png"
+    results = {}
+
+    def request(name, render_fn, out_path):
+        results[name] = cache.get_or_render(
+            "key", render_fn, out_paths={"plot.png": out_path}
+        )
+
+    leader = threading.Thread(
+        target=request,
+        args=(
+            "leader",
+            make_render_fn(leader_out, b"a", calls, started, release),
+            leader_out,
+        ),
+    )
+    leader.start()
+    assert started.wait(TIMEOUT)
+    follower_outs = [tmp_path / f"{i}.png" for i in range(3)]
+    followers = [
+        threading.Thread(
+            target=request, args=(i, make_render_fn(out, b"b", calls), out)
+        )
+        for i, out in enumerate(follower_outs)
+    ]
+    for thread in followers:
+        thread.start()
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(TIMEOUT)
+
+    assert calls == [b"a"]
+    assert results == {"leader": False, 0: True, 1: True, 2: True}
+    assert all(out.read_bytes() == b"a" for out in follower_outs)
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_render_errors_are_shared_unless_retried(tmp_path):
+    cache = RenderCache(tmp_path / "cache", retry_errors=(Cancelled,))
+    out_paths = {"plot.png": tmp_path / "plot.png"}
+
+    def fail():
+        raise ValueError("Failed")
+
+    with pytest.raises(ValueError):
+        cache.get_or_render("key", fail, out_paths)
+    # Failures are not cached
+    assert not cache.contains("key")
+
+    # A waiting request renders the key when the leader was cancelled
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def cancelled_render():
+        started.set()
+        release.wait(TIMEOUT)
+        raise Cancelled()
+
+    def leader():
+        try:
+            cache.get_or_render("key", cancelled_render, out_paths)
+        except Cancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=leader)
+    thread.start()
+    assert started.wait(TIMEOUT)
+    follower_out = tmp_path / "follower.png"
+    follower_result = []
+    follower = threading.Thread(
+        target=lambda: follower_result.append(
+            cache.get_or_render(
+                "key",
+                make_render_fn(follower_out, b"b"),
+                {"plot.png": follower_out},
+            )
+        )
+    )
+    follower.start()
+    release.set()
+    thread.join(TIMEOUT)
+    follower.join(TIMEOUT)
+    assert len(errors) == 1
+    assert follower_result == [False]
+    assert follower_out.read_bytes() == b"b"
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = RenderCache(tmp_path / "cache", max_size_bytes=25)
+    out_path = tmp_path / "plot.png"
+    out_paths = {"plot.png": out_path}
+    for key in ["a", "b"]:
+        out_path.write_bytes(b"x" * 10)
+        cache.put(key, out_paths)
+    # Accessing "a" makes "b" the least recently used
+    assert cache.get("a", out_paths)
+    cache.index["b"]["last_access"] -= 1
+    out_path.write_bytes(b"x" * 10)
+    cache.put("c", out_paths)
+    assert set(cache.index) == {"a", "c"}
+    assert not (tmp_path / "cache" / "b").exists()
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size_bytes"] == 20
+
+    # The most recent entry is kept even when it is too large
+    out_path.write_bytes(b"x" * 30)
+    cache.put("d", out_paths)
+    assert set(cache.index) == {"d"}
+
+
+def test_index_survives_restart_and_hits_save_lazily(tmp_path):
+    cache = RenderCache(tmp_path / "cache", save_interval=3600)
+    out_path = tmp_path / "plot.png"
+    out_path.write_bytes(b"a")
+    cache.put("key", {"plot.png": out_path})
+    index_path = tmp_path / "cache" / "index.json"
+
+    def saved_access():
+        return json.loads(index_path.read_text())["key"]["last_access"]
+
+    put_access = saved_access()
+    cache.index["key"]["last_access"] -= 10
+    assert cache.get("key", {"plot.png": tmp_path / "copy.png"})
+    # The hit is only saved when flushing
+    assert saved_access() == put_access
+    cache.flush()
+    assert saved_access() == cache.index["key"]["last_access"] >= put_access
+
+    restarted = RenderCache(tmp_path / "cache")
+    assert restarted.get("key", {"plot.png": tmp_path / "restarted.png"})
+    # Entries whose files were removed are dropped
+    (tmp_path / "cache" / "key" / "plot.png").unlink()
+    assert not RenderCache(tmp_path / "cache").contains("key")
+
+
+def test_render_key_depends_on_inputs(tmp_path):
+    data_path = tmp_path / "data.csv"
+    data_path.write_text("Target,Prediction\na,b\n")
+    args = {
+        "design_settings": {"palette": "Blues"},
+        "classes": ["a", "b"],
+        "columns": {"target_col": "Target"},
+        "version": "1",
+    }
+    key = make_render_key(data_path, **args)
+    assert key == make_render_key(data_path, **args)
+    assert key != make_render_key(data_path, **{**args, "classes": ["b", "a"]})
+    assert key != make_render_key(data_path, **args, engine="python")
+    data_path.write_text("Target,Prediction\na,a\n")
+    assert key != make_render_key(data_path, **args)
@@ -0,0 +1,152 @@
+import pathlib
+import sys
+import threading
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from scheduler import (  # noqa: E402
+    QueueFullError,
+    RenderCancelledError,
+    RenderScheduler,
+)
+
+TIMEOUT = 5
+
+
+def block(scheduler, session_id="blocker"):
+    """
+    Occupy the worker until the returned event is set.
+    """
+    release = threading.Event()
+    started = threading.Event()
+
+    def fn(cancel_event):
+        started.set()
+        release.wait(TIMEOUT)
+
+    ticket = scheduler.submit(session_id, fn)
+    assert started.wait(TIMEOUT)
+    return release, ticket
+
+
+def record(order, name):
+    def fn(cancel_event):
+        order.append(name)
+        return name
+
+    return fn
+
+
+def test_sessions_take_turns():
+    scheduler = RenderScheduler(max_concurrent=1, max_queued_per_session=5)
+    release, _ = block(scheduler)
+    order = []
+    tickets = [
+        scheduler.submit(session_id, record(order, name))
+        for session_id, name in [
+            ("a", "a1"),
+            ("a", "a2"),
+            ("a", "a3"),
+            ("b", "b1"),
+            ("b", "b2"),
+        ]
+    ]
+    assert [scheduler.position(t) for t in tickets] == [0, 2, 4, 1, 3]
+
+    release.set()
+    assert [t.get_result() for t in tickets] == ["a1", "a2", "a3", "b1", "b2"]
+    assert order == ["a1", "b1", "a2", "b2", "a3"]
+    assert all(scheduler.position(t) is None for t in tickets)
+    stats = scheduler.stats()
+    assert stats["completed"] == 6
+    assert stats["queued"] == 0
+
+
+def test_queue_limits():
+    scheduler = RenderScheduler(
+        max_concurrent=1, max_queued=3, max_queued_per_session=2, max_background=1
+    )
+    release, _ = block(scheduler)
+    tickets = [scheduler.submit("a", lambda e: None) for _ in range(2)]
+    with pytest.raises(QueueFullError):
+        scheduler.submit("a", lambda e: None)
+    tickets.append(scheduler.submit("b", lambda e: None))
+    with pytest.raises(QueueFullError):
+        scheduler.submit("c", lambda e: None)
+    # Background jobs have their own limit
+    tickets.append(scheduler.submit("c", lambda e: None, background=True))
+    with pytest.raises(QueueFullError):
+        scheduler.submit("c", lambda e: None, background=True)
+    assert scheduler.stats()["rejected"] == 3
+
+    release.set()
+    for ticket in tickets:
+        ticket.get_result()
+    # Finished jobs free their places in the queue
+    scheduler.submit("a", lambda e: None).get_result()
+
+
+def test_background_jobs_wait_for_other_jobs():
+    scheduler = RenderScheduler(max_concurrent=1)
+    release, _ = block(scheduler)
+    order = []
+    background = scheduler.submit("a", record(order, "background"), background=True)
+    foreground = scheduler.submit("b", record(order, "foreground"))
+    release.set()
+    background.get_result()
+    foreground.get_result()
+    assert order == ["foreground", "background"]
+
+
+def test_cancel_queued_job():
+    scheduler = RenderScheduler(max_concurrent=1)
+    release, _ = block(scheduler)
+    order = []
+    cancelled = scheduler.submit("a", record(order, "cancelled"))
+    kept = scheduler.submit("a", record(order, "kept"))
+    scheduler.cancel(cancelled)
+    assert cancelled.status == "cancelled"
+    assert cancelled.wait(0)
+    with pytest.raises(RenderCancelledError):
+        cancelled.get_result()
+    assert scheduler.position(kept) == 0
+
+    release.set()
+    kept.get_result()
+    assert order == ["kept"]
+    assert scheduler.stats()["cancelled"] == 1
+
+
+def test_cancel_running_job():
+    scheduler = RenderScheduler(max_concurrent=1)
+    started = threading.Event()
+
+    def fn(cancel_event):
+        started.set()
+        assert cancel_event.wait(TIMEOUT)
+        raise RuntimeError("Stopped")
+
+    ticket = scheduler.submit("a", fn)
+    assert started.wait(TIMEOUT)
+    scheduler.cancel(ticket)
+    with pytest.raises(RenderCancelledError):
+        ticket.get_result()
+    assert ticket.status == "cancelled"
+    # Finished jobs are left as they are
+    scheduler.cancel(ticket)
+    assert scheduler.stats()["cancelled"] == 1
+
+
+def test_failed_job_raises_its_error():
+    scheduler = RenderScheduler(max_concurrent=1)
+
+    def fn(cancel_event):
+        raise ValueError("Failed")
+
+    ticket = scheduler.submit("a", fn)
+    with pytest.raises(ValueError, match="Failed"):
+        ticket.get_result()
+    assert ticket.status == "failed"
+    assert scheduler.stats()["failed"] == 1
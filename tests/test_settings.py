@@ -0,0 +1,86 @@
+import pathlib
+import sys
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from settings import DesignSettings, DesignSettingsError  # noqa: E402
+
+
+def test_from_dict_defaults_and_conversion():
+    settings = DesignSettings.from_dict({})
+    assert settings == DesignSettings()
+    # Ints are accepted for float settings and whole floats for int settings
+    settings = DesignSettings.from_dict({"darkness": 1, "amount_3d_effect": 2.0})
+    assert settings.darkness == 1.0 and isinstance(settings.darkness, float)
+    assert settings.amount_3d_effect == 2 and isinstance(settings.amount_3d_effect, int)
+    assert settings.diff(DesignSettings()) == {
+        "darkness": (0.8, 1.0),
+        "amount_3d_effect": (1, 2),
+    }
+
+
+def test_from_dict_reports_all_errors():
+    with pytest.raises(DesignSettingsError) as info:
+        DesignSettings.from_dict(
+            {
+                "unknown": 1,
+                "palette": "Rainbow",
+                "darkness": 2,
+                "show_sums": "yes",
+                "amount_3d_effect": 1.5,
+                "tile_border_color": "red",
+                "dpi": True,
+            }
+        )
+    errors = info.value.errors
+    assert len(errors) == 7
+    assert any("`unknown` is not a design setting" in e for e in errors)
+    assert any("`palette` must be one of" in e for e in errors)
+    assert any("`darkness` must be at most 1" in e for e in errors)
+    assert any("`show_sums` must be bool" in e for e in errors)
+    assert any("`amount_3d_effect` must be a whole number" in e for e in errors)
+    assert any("`tile_border_color` must be a hex color" in e for e in errors)
+    # bool is not accepted as a number
+    assert any("`dpi` must be a whole number" in e for e in errors)
+
+    with pytest.raises(DesignSettingsError):
+        DesignSettings.from_dict(["not", "a", "dict"])
+
+
+def test_consistency_errors():
+    settings = DesignSettings(
+        show_sums=True, palette="Greens", sum_tile_palette="Greens"
+    )
+    assert len(settings.consistency_errors()) == 1
+    # The palettes only need to differ when the sums are shown
+    assert DesignSettings(palette="Greens").consistency_errors() == []
+
+    settings = DesignSettings(set_intensity_lims=True, intensity_min=5, intensity_max=5)
+    assert len(settings.consistency_errors()) == 1
+    assert (
+        DesignSettings(
+            set_intensity_lims=True, intensity_min=1, intensity_max=5
+        ).consistency_errors()
+        == []
+    )
+    with pytest.raises(DesignSettingsError, match="identical"):
+        DesignSettings.from_dict({"show_sums": True, "sum_tile_palette": "Blues"})
+
+
+def test_digest_is_stable():
+    settings = DesignSettings.from_dict({"palette": "Reds", "dpi": 300})
+    same = DesignSettings.from_dict({"dpi": 300, "palette": "Reds"})
+    assert settings == same
+    assert hash(settings) == hash(same)
+    assert settings.digest() == same.digest()
+    assert settings.digest() != DesignSettings().digest()
+    assert DesignSettings.from_dict(settings.to_dict()) == settings
+
+
+def test_templates_are_valid():
+    paths = sorted((ROOT_DIR / "template_resources").glob("design_settings.*.json"))
+    assert paths
+    for path in paths:
+        DesignSettings.load(path)
@@ -0,0 +1,41 @@
+import itertools
+import pathlib
+import sys
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from templates import TemplateRegistry  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def registry():
+    registry = TemplateRegistry()
+    registry.load_manifest(ROOT_DIR / "template_resources")
+    return registry
+
+
+def test_find_matches_filters(registry):
+    collections = sorted({t["collection"] for t in registry.templates.values()})
+    for num_classes, sums, collection in itertools.product(
+        [None] + registry.available_num_classes,
+        [None, False, True],
+        [None, "Unknown"] + collections,
+    ):
+        found = registry.find(num_classes=num_classes, sums=sums, collection=collection)
+        expected = [
+            t
+            for t in registry.templates.values()
+            if (num_classes is None or t["num_classes"] == num_classes)
+            and (sums is None or t["sums"] == sums)
+            and (collection is None or t["collection"] == collection)
+        ]
+        assert sorted(t["name"] for t in found) == sorted(t["name"] for t in expected)
+
+
+def test_closest_num_classes(registry):
+    assert registry.available_num_classes == [2, 3]
+    assert registry.closest_num_classes(1) == 2
+    assert registry.closest_num_classes(3) == 3
+    assert registry.closest_num_classes(10) == 3
@@ -0,0 +1,69 @@
+import os
+import pathlib
+import sys
+import time
+
+import pytest
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR))
+from workspaces import WorkspaceManager, WorkspaceQuotaError  # noqa: E402
+
+
+@pytest.fixture
+def manager(tmp_path):
+    # The background sweeps are not part of the tests
+    return WorkspaceManager(
+        tmp_path / "workspaces", quota_bytes=100, ttl_seconds=60, sweep_interval=3600
+    )
+
+
+def test_workspaces_are_per_session(manager):
+    workspace = manager.get("session/1")
+    assert workspace.path.parent == manager.root_dir
+    assert workspace.path.name == "session_1"
+    assert workspace.path.is_dir()
+    assert manager.get("session/1").path == workspace.path
+    assert manager.get("session-2").path != workspace.path
+    assert manager.stats()["created"] == 2
+    assert manager.stats()["workspaces"] == 2
+
+
+def test_quota(manager):
+    workspace = manager.get("session")
+    (workspace.path / "data.csv").write_bytes(b"x" * 60)
+    manager.record_usage(workspace)
+    assert manager.stats()["disk_bytes"] == 60
+
+    (workspace.path / "plot.png").write_bytes(b"x" * 60)
+    with pytest.raises(WorkspaceQuotaError):
+        manager.record_usage(workspace)
+    # The usage is recorded when the quota is exceeded
+    assert manager.stats()["disk_bytes"] == 120
+    assert manager.stats()["peak_disk_bytes"] == 120
+
+    (workspace.path / "plot.png").unlink()
+    assert workspace.check_quota() == 60
+    assert manager.measure() == 60
+    assert manager.stats()["peak_disk_bytes"] == 120
+
+
+def test_expired_workspaces_are_removed(manager):
+    expired = manager.get("expired")
+    active = manager.get("active")
+    manager.last_access["expired"] = time.time() - 120
+    # Workspace from a previous server run
+    previous = manager.root_dir / "previous"
+    previous.mkdir()
+    (previous / "data.csv").write_bytes(b"x" * 10)
+    os.utime(previous, (time.time() - 120, time.time() - 120))
+
+    manager.sweep()
+    assert not expired.path.exists()
+    assert not previous.exists()
+    assert active.path.exists()
+    assert manager.stats()["removed"] == 2
+    assert manager.stats()["workspaces"] == 1
+
+    # Using an expired session again creates a new workspace
+    assert manager.get("expired").path.is_dir()
@@ -88,7 +88,7 @@ def intro_text():
     with col1:
         st.subheader("Have your data ready?")
         st.markdown(  # TODO: Make A,B, etc. icons
-            "Upload a csv file with either: \n\n"
+            "Upload a csv (or parquet/feather/arrow) file with either: \n\n"
             f"{insert_chart_icon(1)} **Targets** and **predictions** \n\n"
             f"{insert_chart_icon(0)} Existing confusion matrix **counts** \n\n"
             f"{insert_arrow()} Specify the columns to use\n\n"
@@ -151,7 +151,7 @@ def upload_counts_text():
     col1, col2 = st.columns([5, 4])
     with col1:
         st.markdown(
-            "The application expects a `.csv` file with: \n"
+            "The application expects a `.csv`, `.parquet`, `.feather` or `.arrow` file with: \n"
             "1) A `target classes` column. \n\n"
             "2) A `predicted classes` column. \n\n"
             "3) A `combination count` column for the "
@@ -171,10 +171,13 @@ def upload_predictions_text():
     col1, col2 = st.columns([5, 4])
     with col1:
         st.markdown(
-            "The application expects a `.csv` file with:  \n"
+            "The application expects a `.csv`, `.parquet`, `.feather` or `.arrow` file with:  \n"
             "1) A `target` column.  \n"
             "2) A `prediction` column.  \n"
-            "Predictions should be class predictions (not probabilities). \n\n"
+            "3) Optionally, a `group` column (e.g. the fold or site) to plot a confusion matrix per group.  \n"
+            "Predictions should be class predictions. For binary classification, "
+            "they can also be the probabilities of the positive class, "
+            "and you can choose the decision threshold. \n\n"
             "Other columns are currently ignored.  \n\n"
             "In the next step, you will be asked to select the names of these two columns. "
         )
@@ -1,8 +1,16 @@
 import subprocess
 import re
+import select
+import queue
+import time
 import streamlit as st
 import json
+import threading
 from typing import Optional
+import numpy as np
+import pandas as pd
+
+from metrics import record_span, span
 
 
 def show_error(msg, action):
@@ -11,32 +19,40 @@ def show_error(msg, action):
     )
 
 
+# Error messages printed by the plotting script and
+# the action that failed for each of them
+PLOTTING_ERRORS = {
+    "Failed to create plot from confusion matrix.": "plot confusion matrix",
+    "Failed to read design settings as a json file": "read design settings",
+    "Failed to read data from": "read data",
+    "Failed to ggsave plot to:": "save plot",
+    "Failed to save plot to:": "save plot",
+}
+
+
+def show_plotting_error(output):
+    """
+    Show the relevant part of the output from a failed plotting script.
+    """
+    for error_msg, action in PLOTTING_ERRORS.items():
+        if error_msg in output:
+            msg = output.split(error_msg)[-1]
+            show_error(msg=msg, action=action)
+            return
+    msg = output.split("\n\n")[-1]
+    st.error(
+        f"Unknown type of error: {msg}.\n\n"
+        "Please [report](https://github.com/LudvigOlsen/plot_confusion_matrix/issues) this issue."
+    )
+
+
 def call_subprocess(call_, message, return_output=False, encoding="UTF-8"):
     # With capturing of output
     if return_output:
         try:
             out = subprocess.check_output(call_, shell=True, encoding=encoding)
         except subprocess.CalledProcessError as e:
-            if "Failed to create plot from confusion matrix." in e.output:
-                msg = e.output.split("Failed to create plot from confusion matrix.")[-1]
-                show_error(msg=msg, action="plot confusion matrix")
-            elif "Failed to read design settings as a json file" in e.output:
-                msg = e.output.split("Failed to read design settings as a json file")[
-                    -1
-                ]
-                show_error(msg=msg, action="read design settings")
-            elif "Failed to read data from" in e.output:
-                msg = e.output.split("Failed to read data from")[-1]
-                show_error(msg=msg, action="read data")
-            elif "Failed to ggsave plot to:" in e.output:
-                msg = e.output.split("Failed to ggsave plot to:")[-1]
-                show_error(msg=msg, action="save plot")
-            else:
-                msg = e.output.split("\n\n")[-1]
-                st.error(
-                    f"Unknown type of error: {msg}.\n\n"
-                    "Please [report](https://github.com/LudvigOlsen/plot_confusion_matrix/issues) this issue."
-                )
+            show_plotting_error(e.output)
             print(e.output)
             print(f"{message}: {call_}")
             raise e
@@ -50,20 +66,262 @@ def call_subprocess(call_, message, return_output=False, encoding="UTF-8"):
         raise e
 
 
+class PlotRenderError(Exception):
+    """
+    Raised when the plotting worker fails to render a job.
+    `output` holds the captured output from the R process.
+    """
+
+    def __init__(self, output: str):
+        super().__init__(output.split("\n\n")[-1])
+        self.output = output
+
+    def __reduce__(self):
+        # Keep the full output when raised in another process
+        return (type(self), (self.output,))
+
+
+class PlotWorkerCrashedError(Exception):
+    pass
+
+
+class PlotRenderCancelledError(Exception):
+    pass
+
+
+# Seconds between checks for cancellation while waiting for a render
+CANCEL_POLL_INTERVAL = 0.1
+
+
+class PlotWorker:
+    """
+    Long-lived R process for plotting confusion matrices.
+
+    The R packages are loaded once at startup. Jobs are sent as
+    json lines to the stdin of `plot_worker.R` and the status is read
+    from its stdout. A job has the same keys as the arguments of `plot.R`
+    (without the `--` prefix).
+    """
+
+    def __init__(
+        self,
+        script_path: str = "plot_worker.R",
+        max_jobs: int = 100,
+        max_memory_mb: float = 1024,
+        startup_timeout: float = 120,
+    ) -> None:
+        self.script_path = script_path
+        self.max_jobs = max_jobs
+        self.max_memory_mb = max_memory_mb
+        self.startup_timeout = startup_timeout
+        self.num_jobs = 0
+        self.process = None
+
+    def start(self) -> None:
+        self.num_jobs = 0
+        with span("r_startup"):
+            self.process = subprocess.Popen(
+                ["Rscript", self.script_path],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                encoding="UTF-8",
+                bufsize=1,
+            )
+            response = self._read_response(timeout=self.startup_timeout)
+        if response.get("status") != "ready":
+            self.stop()
+            raise PlotWorkerCrashedError(
+                f"Plotting worker failed to start: {response}"
+            )
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def memory_mb(self) -> Optional[float]:
+        """
+        Resident memory of the R process in MB.
+        Only available on Linux (reads `/proc`).
+        """
+        if not self.is_alive():
+            return None
+        try:
+            with open(f"/proc/{self.process.pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        return None
+
+    @property
+    def needs_recycling(self) -> bool:
+        if not self.is_alive():
+            return True
+        if self.max_jobs is not None and self.num_jobs >= self.max_jobs:
+            return True
+        memory = self.memory_mb()
+        return (
+            self.max_memory_mb is not None
+            and memory is not None
+            and memory > self.max_memory_mb
+        )
+
+    def render(
+        self,
+        job: dict,
+        timeout: Optional[float] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> str:
+        """
+        Render a single job. Returns the captured output of the R process.
+        When `cancel_event` is set during the render, the R process
+        is killed and `PlotRenderCancelledError` is raised.
+        """
+        if not self.is_alive():
+            self.start()
+        try:
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            self.stop()
+            raise PlotWorkerCrashedError("Plotting worker is not running.") from e
+        self.num_jobs += 1
+        with span("r_render"):
+            response = self._read_response(timeout=timeout, cancel_event=cancel_event)
+        # Stages timed by the R process
+        for stage, timing in response.get("timings", {}).items():
+            record_span(
+                f"r_{stage}", wall_seconds=timing["wall"], cpu_seconds=timing["cpu"]
+            )
+        if response["status"] != "ok":
+            raise PlotRenderError(response.get("output", ""))
+        return response.get("output", "")
+
+    def _wait_for_output(
+        self, timeout: Optional[float], cancel_event: Optional[threading.Event]
+    ) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                # Don't wait for R to finish the stale job
+                self.kill()
+                raise PlotRenderCancelledError("Render was cancelled.")
+            wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if cancel_event is not None:
+                wait = (
+                    CANCEL_POLL_INTERVAL
+                    if wait is None
+                    else min(wait, CANCEL_POLL_INTERVAL)
+                )
+            if wait is None:
+                return
+            ready, _, _ = select.select([self.process.stdout], [], [], wait)
+            if ready:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                self.stop()
+                raise TimeoutError(f"Plotting worker did not respond in {timeout}s.")
+
+    def _read_response(
+        self,
+        timeout: Optional[float],
+        cancel_event: Optional[threading.Event] = None,
+    ) -> dict:
+        self._wait_for_output(timeout=timeout, cancel_event=cancel_event)
+        line = self.process.stdout.readline()
+        if not line:
+            self.stop()
+            raise PlotWorkerCrashedError("Plotting worker exited unexpectedly.")
+        return json.loads(line)
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def kill(self) -> None:
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.wait()
+        self.process = None
+
+
+class PlotWorkerPool:
+    """
+    Pool of plotting workers shared between threads (i.e. sessions).
+
+    Workers are started lazily. Crashed workers are restarted and
+    workers are recycled after `max_jobs` jobs or when their memory
+    usage exceeds `max_memory_mb`.
+    """
+
+    def __init__(self, num_workers: int = 2, **worker_kwargs) -> None:
+        self.idle_workers = queue.LifoQueue()
+        for _ in range(num_workers):
+            self.idle_workers.put(PlotWorker(**worker_kwargs))
+
+    def render(
+        self,
+        job: dict,
+        timeout: Optional[float] = None,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> str:
+        worker = self.idle_workers.get()
+        try:
+            try:
+                return worker.render(job, timeout=timeout, cancel_event=cancel_event)
+            except PlotWorkerCrashedError:
+                # Retry once with a fresh process
+                worker.stop()
+                return worker.render(job, timeout=timeout, cancel_event=cancel_event)
+        finally:
+            if worker.needs_recycling:
+                worker.stop()
+            self.idle_workers.put(worker)
+
+    def shutdown(self) -> None:
+        while not self.idle_workers.empty():
+            self.idle_workers.get().stop()
+
+
+# Non-alphanumerics (keep spaces)
+NON_ALPHANUMERICS_PATTERN = re.compile(r"[^0-9a-zA-Z\s]+")
+# Multiple spaces
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
 def clean_string_for_non_alphanumerics(s):
     # Remove non-alphanumerics (keep spaces)
-    pattern1 = re.compile("[^0-9a-zA-Z\s]+")
+    s = NON_ALPHANUMERICS_PATTERN.sub("", s)
     # Replace multiple spaces with a single space
-    pattern2 = re.compile("\s+")
-    # Apply replacements
-    s = pattern1.sub("", s)
-    s = pattern2.sub(" ", s)
+    s = WHITESPACE_PATTERN.sub(" ", s)
     # Trim whitespace in start and end
     return s.strip()
 
 
 def clean_str_column(x):
-    return x.astype(str).apply(lambda x: clean_string_for_non_alphanumerics(x))
+    """
+    Clean the string version of each value in a column.
+    Only the unique values (e.g. the classes) are cleaned. The
+    cleaned values are then mapped back to the rows by their codes.
+    """
+    with span("clean_str_column"):
+        codes, uniques = pd.factorize(x, use_na_sentinel=False)
+        cleaned = np.array(
+            [clean_string_for_non_alphanumerics(str(u)) for u in uniques],
+            dtype=object,
+        )
+        return pd.Series(cleaned[codes], index=x.index, name=x.name)
 
 
 def min_max_scale_list(
@@ -75,7 +333,8 @@ def min_max_scale_list(
 ) -> list:
     """
     MinMax scaler for lists.
-    Why: Currently we don't require numpy as dependency.
+    Used for a few scalar values (e.g. the image size), where
+    plain Python is simpler than converting to a numpy array.
     """
     if old_min is None:
         old_min = min(x)
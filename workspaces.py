@@ -0,0 +1,164 @@
+import os
+import pathlib
+import re
+import shutil
+import threading
+import time
+from typing import Dict, Optional
+
+
+class WorkspaceQuotaError(Exception):
+    pass
+
+
+def get_dir_size(path) -> int:
+    size = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+            except OSError:
+                # Removed while walking
+                pass
+    return size
+
+
+class Workspace:
+    """
+    Directory with the input and output files of a single session.
+    """
+
+    def __init__(self, path: pathlib.Path, quota_bytes: Optional[int]) -> None:
+        self.path = path
+        self.quota_bytes = quota_bytes
+
+    def size_bytes(self) -> int:
+        return get_dir_size(self.path)
+
+    def check_quota(self) -> int:
+        """
+        Raise a `WorkspaceQuotaError` when the files take up more than the quota.
+        Returns the size of the workspace.
+        """
+        size = self.size_bytes()
+        if self.quota_bytes is not None and size > self.quota_bytes:
+            raise WorkspaceQuotaError(
+                f"The files for this session take up {size / 1024**2:.1f}MB, "
+                f"which exceeds the limit of {self.quota_bytes / 1024**2:.0f}MB."
+            )
+        return size
+
+
+class WorkspaceManager:
+    """
+    Per-session workspaces in `root_dir`.
+
+    A background thread removes workspaces that have not been
+    used for `ttl_seconds` (e.g. the browser tab was closed). This includes
+    workspaces left by previous server runs. Disk usage is measured on
+    every sweep and when a quota is checked.
+    """
+
+    def __init__(
+        self,
+        root_dir,
+        quota_bytes: Optional[int] = 200 * 1024**2,
+        ttl_seconds: float = 3600,
+        sweep_interval: float = 300,
+    ) -> None:
+        self.root_dir = pathlib.Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.quota_bytes = quota_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self.last_access: Dict[str, float] = {}
+        self.counters = {"created": 0, "removed": 0}
+        self.disk_bytes = 0
+        self.peak_disk_bytes = 0
+        self.lock = threading.Lock()
+        self.sweeper = threading.Thread(
+            target=self._sweep_forever, daemon=True, name="workspace-sweeper"
+        )
+        self.sweeper.start()
+
+    @staticmethod
+    def _dir_name(session_id: str) -> str:
+        return re.sub(r"[^0-9a-zA-Z_-]+", "_", session_id)
+
+    def get(self, session_id: str) -> Workspace:
+        """
+        Get (or create) the workspace for a session and mark it as used.
+        """
+        name = self._dir_name(session_id)
+        path = self.root_dir / name
+        with self.lock:
+            if not path.exists():
+                self.counters["created"] += 1
+            path.mkdir(exist_ok=True)
+            self.last_access[name] = time.time()
+        return Workspace(path=path, quota_bytes=self.quota_bytes)
+
+    def record_usage(self, workspace: Workspace) -> None:
+        """
+        Check the quota of a workspace and update the disk usage.
+        Raises `WorkspaceQuotaError` when the quota is exceeded.
+        """
+        try:
+            workspace.check_quota()
+        finally:
+            self.measure()
+
+    def measure(self) -> int:
+        disk_bytes = get_dir_size(self.root_dir)
+        with self.lock:
+            self.disk_bytes = disk_bytes
+            self.peak_disk_bytes = max(self.peak_disk_bytes, disk_bytes)
+        return disk_bytes
+
+    def sweep(self) -> int:
+        """
+        Remove expired workspaces. Returns the number of removed workspaces.
+        """
+        now = time.time()
+        num_removed = 0
+        for path in self.root_dir.iterdir():
+            if not path.is_dir():
+                continue
+            with self.lock:
+                last_access = self.last_access.get(path.name)
+                if last_access is None:
+                    # From a previous server run
+                    try:
+                        last_access = path.stat().st_mtime
+                    except OSError:
+                        continue
+                if now - last_access < self.ttl_seconds:
+                    continue
+                # Remove with the lock held so `get()` can't reuse it meanwhile
+                shutil.rmtree(path, ignore_errors=True)
+                self.last_access.pop(path.name, None)
+                self.counters["removed"] += 1
+            num_removed += 1
+        self.measure()
+        return num_removed
+
+    def _sweep_forever(self) -> None:
+        while True:
+            try:
+                num_removed = self.sweep()
+                if num_removed:
+                    print(f"Removed {num_removed} expired workspaces: {self.stats()}")
+            except Exception as e:
+                print(f"Failed to sweep workspaces: {e}")
+            time.sleep(self.sweep_interval)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                **self.counters,
+                "workspaces": len(
+                    [p for p in self.root_dir.iterdir() if p.is_dir()]
+                ),
+                "disk_bytes": self.disk_bytes,
+                "peak_disk_bytes": self.peak_disk_bytes,
+            }